@@ -5,7 +5,8 @@ major modules:
 
 Factor Generation:
 
-- 'gen': factor geneartor 
+- 'gen': factor geneartor (--incremental: append the dates after those stored; --check_incremental 5: compare a sample with a full recompute;
+    --force: recompute the factors unchanged since saved)
     - config in 'factor_generation/raw_factor/config.py'
 
 Backtest: 
@@ -41,8 +42,43 @@ other modules:
 - 'pairs': run pairs factor generation
     - config in 'factor_generation/raw_factor/pairs_modified.py'
 
-- 'gen_risk': risk factor generator 
+- 'gen_risk': risk factor generator (--force: recompute even if the code, config and inputs did not change)
     - config in 'factor_generation/raw_factor/style_factor_config.py'
+
+- 'bench_ops': benchmark the numpy factor operators against pandas rolling (--tickers 1000 --dates 500 --windows 5 20 60)
+    - config in 'factor_generation/tools/operator_benchmark.py'
+
+Data: 
+
+- 'convert_panel': convert the feather data into memory-mapped panels (for the 'mmap' backend)
+    - config in 'data_ingestion/PqiDataSdk_Offline.py'
+
+- 'chunk_feather': rewrite feather files in ticker chunks with row indices (ticker-subset pushdown)
+    - config in 'data_ingestion/RowIndex.py'
+
+- 'compact_partitions': fold the date partitions of appended features back into their files
+    - config in 'data_ingestion/PartitionStore.py'
+
+- 'precision_report': max abs / rel error of holding the features of a destination as float32 (--des factor)
+    - config in 'data_ingestion/PqiDataSdk_Offline.py' (PRECISION_POLICY)
+
+- 'bench_io': benchmark serial vs threaded eod loading (--workers 1 2 4 8)
+    - config in 'data_ingestion/IOBenchmark.py'
+
+- 'bench_codec': size, write and read throughput of feather codecs on sample feature files (--des factor --sample 5)
+    - config in 'data_ingestion/PqiDataSdk_Offline.py' (COMPRESSION_POLICY)
+
+- 'io_report': per-method I/O statistics of a run recorded with PQI_IO_STATS=1 (--run, default: the latest)
+    - config in 'data_ingestion/IOStats.py'
+
+- 'data_server': serve eod data, index weights and the calendar from shared memory (--stop to shut down)
+    - config in 'data_ingestion/DataServer.py'
+
+- 'build_derived': materialize adjusted prices and returns (run after each data refresh)
+    - config in 'data_ingestion/DerivedStore.py'
+
+- 'data_service': serve the local data to other boxes as Arrow record batches over TCP (--host, --port)
+    - config in 'data_ingestion/ArrowService.py' (clients: DATA_SERVICE in 'data_ingestion/PqiDataSdk_Offline.py')
 """
 
 # load packages 
@@ -59,7 +95,21 @@ def generator_factor():
     """ run factor generation """
     from src.factor_generation.raw_factor.FactorGenerator import FactorGenerator
 
+    # accept arguments for meta control 
+    parser = argparse.ArgumentParser(description='factor generation config')
+    parser.add_argument('--incremental', action='store_true', help='compute and append only the dates after those stored')
+    parser.add_argument('--check_incremental', type=int, default=0, help='recompute a sample of n factors over the full history and compare')
+    parser.add_argument('--force', action='store_true', help='recompute the factors whose code, params and inputs did not change')
+    args, _ = parser.parse_known_args()
+
     fg = FactorGenerator()
+    if args.incremental:
+        fg.incremental = True
+    if args.force:
+        fg.skip_unchanged = False
+    if args.check_incremental > 0:
+        print(fg.check_incremental(sample=args.check_incremental))
+        return
     fg.run()
 
 
@@ -242,10 +292,170 @@ def run_risk_factor_gen():
     """
     from src.factor_generation.raw_factor.StyleFactorGenerator import StyleFactorGenerator
 
+    # accept arguments for meta control
+    parser = argparse.ArgumentParser(description='risk factor generation config')
+    parser.add_argument('--force', action='store_true', help='recompute even if the code, config and inputs did not change')
+    args, _ = parser.parse_known_args()
+
+    if not args.force and StyleFactorGenerator.is_up_to_date():
+        print('risk factors up to date (unchanged code, config and inputs), use --force to recompute')
+        return
     loading_process = StyleFactorGenerator()
     loading_process.start_loading_data_process()
 
 
+def bench_ops():
+    """
+    benchmark the factor operators against pandas
+    """
+    from src.factor_generation.tools.operator_benchmark import bench_operators
+
+    parser = argparse.ArgumentParser(description='operator benchmark config')
+    parser.add_argument('--tickers', type=int, default=1000, help='tickers of the random panel')
+    parser.add_argument('--dates', type=int, default=500, help='dates of the random panel')
+    parser.add_argument('--windows', type=int, nargs='+', default=[5, 20, 60], help='windows of the time-series operators')
+    args, _ = parser.parse_known_args()
+
+    print(bench_operators(n_tickers=args.tickers, n_dates=args.dates, windows=args.windows))
+
+
+# =======================
+# ------ data -----------
+# =======================
+
+def convert_panel():
+    """
+    convert feather eod data and features into memory-mapped panels
+    """
+    from src.data_ingestion.PanelStore import convert_feather_to_panel
+
+    convert_feather_to_panel()
+
+
+def chunk_feather():
+    """
+    rewrite feather eod data and features in ticker chunks, with row indices
+    """
+    from src.data_ingestion.RowIndex import convert_feather_to_chunked
+
+    convert_feather_to_chunked()
+
+
+def compact_partitions():
+    """
+    fold the date partitions written by save_eod_feature(..., mode='append') into the feature files
+    """
+    from src.data_ingestion.PqiDataSdk_Offline import PqiDataSdkOffline
+
+    ds = PqiDataSdkOffline()
+    ds.compact_partitions()
+
+
+def precision_report():
+    """
+    report the error introduced by a lower float precision, per feature
+    """
+    from src.data_ingestion.PqiDataSdk_Offline import PqiDataSdkOffline
+
+    parser = argparse.ArgumentParser(description='precision report config')
+    parser.add_argument('--des', default='factor', help='destination of the features to check')
+    parser.add_argument('--dtype', default='float32', help='precision to evaluate')
+    args, _ = parser.parse_known_args()
+
+    ds = PqiDataSdkOffline()
+    report = ds.get_precision_report(des=args.des, dtype=args.dtype)
+    print(report.sort_values('max_rel_err', ascending=False).to_string())
+
+
+def bench_io():
+    """
+    benchmark eod loading
+    """
+    from src.data_ingestion.IOBenchmark import bench_eod_load
+
+    parser = argparse.ArgumentParser(description='io benchmark config')
+    parser.add_argument('--start_date', default='20150101', help='start date to read')
+    parser.add_argument('--end_date', default='20211231', help='end date to read')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8], help='numbers of reader threads')
+    args, _ = parser.parse_known_args()
+
+    bench_eod_load(start_date=args.start_date, end_date=args.end_date, workers_list=args.workers)
+
+
+def bench_codec():
+    """
+    benchmark feather codecs on existing features
+    """
+    from src.data_ingestion.IOBenchmark import bench_codecs
+
+    parser = argparse.ArgumentParser(description='codec benchmark config')
+    parser.add_argument('--des', nargs='+', default=['factor', 'support_factor', 'risk_factor', 'ml_factor', 'dynamic_ind'], help='destinations to sample from')
+    parser.add_argument('--sample', type=int, default=5, help='files per destination')
+    args, _ = parser.parse_known_args()
+
+    bench_codecs(des_list=args.des, sample=args.sample)
+
+
+def io_report():
+    """
+    print the merged I/O statistics of a run
+    """
+    import os
+    import pandas as pd
+    from src.data_ingestion.IOStats import io_report as get_io_report, IO_STATS_PATH
+
+    parser = argparse.ArgumentParser(description='io report config')
+    parser.add_argument('--run', default=None, help='the run folder under out/io_stats (default: the latest)')
+    args, _ = parser.parse_known_args()
+
+    run = args.run if args.run is not None else sorted(os.listdir(IO_STATS_PATH))[-1]
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(run)
+        print(get_io_report(os.path.join(IO_STATS_PATH, run)))
+
+
+def data_server():
+    """
+    run the shared-memory data server (blocks until SIGINT / SIGTERM)
+    """
+    from src.data_ingestion.DataServer import DataServer, stop_server
+
+    parser = argparse.ArgumentParser(description='data server config')
+    parser.add_argument('--stop', action='store_true', help='shut down the running data server')
+    args, _ = parser.parse_known_args()
+
+    if args.stop:
+        stop_server()
+    else:
+        DataServer().run()
+
+
+def build_derived():
+    """
+    materialize adjusted prices and returns served by get_adj_price / get_returns
+    """
+    from src.data_ingestion.PqiDataSdk_Offline import PqiDataSdkOffline
+
+    ds = PqiDataSdkOffline()
+    ds.build_derived()
+
+
+def data_service():
+    """
+    run the arrow data service (blocks until SIGINT)
+    """
+    from src.data_ingestion.PqiDataSdk_Offline import PqiDataSdkOffline
+    from src.data_ingestion.ArrowService import ArrowDataService, SERVICE_HOST, SERVICE_PORT
+
+    parser = argparse.ArgumentParser(description='data service config')
+    parser.add_argument('--host', default=SERVICE_HOST, help='address to listen on (0.0.0.0 for other boxes)')
+    parser.add_argument('--port', type=int, default=SERVICE_PORT, help='port to listen on')
+    args, _ = parser.parse_known_args()
+
+    ds = PqiDataSdkOffline(data_service='')  # serve the local data
+    ArrowDataService(ds, host=args.host, port=args.port).run()
+
+
 # =======================
 # ------ main -----------
 # =======================
@@ -292,10 +502,44 @@ def main(targets):
     elif 'gen_risk' in targets:
         run_risk_factor_gen()
 
+    elif 'bench_ops' in targets:
+        bench_ops()
+
+    # ---------- data ------------
+    elif 'convert_panel' in targets:
+        convert_panel()
+
+    elif 'chunk_feather' in targets:
+        chunk_feather()
+
+    elif 'compact_partitions' in targets:
+        compact_partitions()
+
+    elif 'precision_report' in targets:
+        precision_report()
+
+    elif 'bench_io' in targets:
+        bench_io()
+
+    elif 'bench_codec' in targets:
+        bench_codec()
+
+    elif 'io_report' in targets:
+        io_report()
+
+    elif 'data_server' in targets:
+        data_server()
+
+    elif 'build_derived' in targets:
+        build_derived()
+
+    elif 'data_service' in targets:
+        data_service()
+
     else:
         raise NotImplementedError(
             'Target not Found / Module not Defined. Please pick from the following modes: \n' +
-            '\t{}\n\t{}\n\t{}\n\t{}\n\t{}\n\t{}\n\t{}\n\t{}\n\t{}\n'.format(
+            '\t' + '\n\t'.join([
                 'gen',
                 'backtest_factor',
                 'backtest_signal',
@@ -305,8 +549,19 @@ def main(targets):
                 'opt_weight',
                 'cluster_train',
                 'pairs',
-                'gen_risk'
-            )
+                'gen_risk',
+                'bench_ops',
+                'convert_panel',
+                'chunk_feather',
+                'compact_partitions',
+                'precision_report',
+                'bench_io',
+                'bench_codec',
+                'io_report',
+                'data_server',
+                'build_derived',
+                'data_service'
+            ]) + '\n'
         )
 
 
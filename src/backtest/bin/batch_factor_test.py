@@ -1,9 +1,10 @@
 """
 batch factor test procedure:
-    - init Single_factor_test, read eod_data_dict 
-    - convert dataframes in eod_data_dict to ndarray and save to SharedMemory 
+    - init Single_factor_test, read eod_data_dict once
+    - share it read-only (see tools/shmtools.py): the eod fields served by the data server 
+      are attached from it, the other dataframes are saved to one SharedMemory segment
     - inside each process:
-        - reconstruct eod_data_dict,
+        - attach eod_data_dict (see init_worker),
         - re-init Single_factor_test to use run() 
 """
 
@@ -15,8 +16,6 @@ import traceback
 
 import numpy as np
 import pandas as pd
-import multiprocessing as mp
-from multiprocessing.shared_memory import SharedMemory
 
 # sys.path.append("..")
 logging.basicConfig(level=logging.CRITICAL)
@@ -27,6 +26,15 @@ from src.backtest.tools.datatools import DataAssist
 from src.backtest.bin.single_factor_test import SingleFactorBacktest
 
 from src.data_ingestion.PqiDataSdk_Offline import PqiDataSdkOffline
+from src.data_ingestion.TaskScheduler import MemoryAwareScheduler
+from src.backtest.tools.shmtools import publish_data_dict, attach_data_dict
+
+# per worker: the eod_data_dict published by the parent (dataframes as (read-only values, index, columns))
+worker_data = {}
+# per worker: the attached segment, kept open
+worker_segments = []
+# per worker: set once a backtest wrote into its inputs, the next ones run on private copies
+worker_flags = {'copy': False}
 
 
 class BasicBatchTest:
@@ -43,13 +51,10 @@ class BasicBatchTest:
         self.fix_stocks = cfg.fix_stocks
         self.fixed_stock_pool = cfg.fixed_stock_pool
         print(f'Stock Pool: {self.pool_type}')
-        self.usr = cfg.user
         self.max_processes = cfg.max_processes
-        self.shape = []
-        self.ind_shape = []
         self.factor_dict = {}
-        self.key_list = []
-        self.all_key_list = []
+        self.segment = None
+        self.layout = None
         self.namespace = ""
         self.name_list = []
 
@@ -64,57 +69,24 @@ class BasicBatchTest:
         print("SHM ready")
 
     def load_data(self):
-        # load eod_data_dict
+        # load eod_data_dict once, shared read-only with the workers (see tools/shmtools.py)
         tester = SingleFactorBacktest()
         eod_data_dict = tester.get_data()
-        # convert to ndarray and save to shm 
-        df_sample = eod_data_dict["ClosePrice"]
-        self.date_list = list(df_sample.columns)
-        self.shape = df_sample.shape
-        self.ind_shape = eod_data_dict["ind_df"].shape
-        self.index_shape = eod_data_dict["index_data"].shape
-        index_index_data_array = np.array(eod_data_dict["index_data"].index.T).astype("int")
-        columns_index_data_array = np.array(eod_data_dict["index_data"].columns.T).astype("int")
-        self.calendar_shape = eod_data_dict["calendar"].shape
-        index_array = np.array(df_sample.index.T).astype("int")
-        columns_array = np.array(df_sample.columns.T).astype("int")
-        index_array_ind = np.array(eod_data_dict["ind_df"].index.T).astype("int")
-        columns_array_ind = np.array(eod_data_dict["ind_df"].columns.T).astype("int")
-        calendar = np.array(eod_data_dict["calendar"].astype("int"))
-        abnormal_keys = []
-        for k in eod_data_dict.keys():
-            if k != "ind_df" and k != "calendar" and k != "index_data":
-                if eod_data_dict[k].shape != self.shape:
-                    print("delete {}  with shape {}".format(k, eod_data_dict[k].shape))
-                    abnormal_keys.append(k)
-        for k in abnormal_keys:
-            del eod_data_dict[k]
-
-        self.key_list = list(eod_data_dict.keys())
-        self.all_key_list = self.key_list.copy()
-        self.all_key_list.extend(["index", "columns", "index_ind", "columns_ind"])
-        self.save_to_shm(index_array, "index")
-        self.save_to_shm(columns_array, "columns")
-        self.save_to_shm(index_array_ind, "index_ind")
-        self.save_to_shm(columns_array_ind, "columns_ind")
-        self.save_to_shm(calendar,"calendar")
-        
-        self.all_key_list.extend(["index_index_data", "columns_index_data"])
-        self.save_to_shm(index_index_data_array, "index_index_data")
-        self.save_to_shm(columns_index_data_array, "columns_index_data")
-
-        for k in self.key_list:
-            if k != 'calendar':
-                data = eod_data_dict[k].values
-                self.save_to_shm(data, k)
+        self.date_list = list(eod_data_dict["ClosePrice"].columns)
+        self.segment, self.layout = publish_data_dict(eod_data_dict, self.myconnector)
 
+    def shmClean(self):
+        # erase the shared memory (the data server owns its own segments)
+        if self.segment is not None:
+            self.segment.close()
+            self.segment.unlink()
 
     def read_factor(self):
         """ 
         read all factors, pack into a dict of dataframes
         """
 
-        self.factor_dict = self.read_factor_data(self.name_list, self.stock_pool, self.date_list)
+        self.factor_dict = self.read_factor_data(self.name_list, self.stock_pool, self.trade_dates)
 
     # TODO: edited here
     def read_factor_data(self, test_factor_list, tickers, date_list):
@@ -140,106 +112,56 @@ class BasicBatchTest:
 
         return factor_dict
 
+# subprocess functions (do not defined as class functions)
+def init_worker(layout):
+    """
+    pool initializer: attach to the eod_data_dict published by the parent (see tools/shmtools.py), 
+    without copies. The values are read-only, so that a backtest cannot leak changes into the next one
+    """
+    data, segment = attach_data_dict(layout)
+    worker_data.update(data)
+    worker_segments.append(segment)
 
-    def save_to_shm(self, data_nd, name):
-        """
-        save ndarray to SharedMemory
-        :param data_nd:
-        :param name:
-        :return:
-        """
-        name = name + "," + self.usr
-        shm_address = SharedMemory(name=name, create=True, size=data_nd.nbytes)
-        shm_nd_data = np.ndarray(data_nd.shape, dtype=data_nd.dtype, buffer=shm_address.buf)
-        shm_nd_data[:] = data_nd[:]
 
-    def shmClean(self):
-        # erase all shared memory
-        for k in self.all_key_list:
-            try:
-                shm = SharedMemory(name=k + "," + self.usr)
-                shm.close()
-                shm.unlink()
-            except Exception as e:
-                print(e)
-
-# subprocess function (do not defined as a class function)
-def processor(factor, shape, ind_shape, index_shape, calendar_shape, usr, key_list):
+def reassemble_data_dict(copy=False):
     """
-    a single factor backtest
-    :param factor:
-    :param key_list:
-    :param usr:
-    :param ind_shape:
-    :param index_shape:
-    :param shape:
-    :return:
+    eod_data_dict over the worker's data (see init_worker): fresh dataframes per backtest,
+    sharing the index, columns and read-only values
+    :param copy: copy the values (writable)
     """
-    # 重构data_dict
     data_dict = dict()
-    try:
-        shm_index = SharedMemory(name='index' + "," + usr)
-        index = np.ndarray((shape[0],), dtype='int', buffer=shm_index.buf)
-        index = [str(x).zfill(6) for x in index]
-        shm_columns = SharedMemory(name='columns' + "," + usr)
-        columns = np.ndarray((shape[1],), dtype='int', buffer=shm_columns.buf)
-        columns = [str(x) for x in columns]
-
-        shm_index_ind = SharedMemory(name='index_ind' + "," + usr)
-        index_ind = np.ndarray((ind_shape[0],), dtype='int', buffer=shm_index_ind.buf)
-        index_ind = [str(x).zfill(6) for x in index_ind]
-        shm_columns_ind = SharedMemory(name='columns_ind' + "," + usr)
-        columns_ind = np.ndarray((ind_shape[1],), dtype='int', buffer=shm_columns_ind.buf)
-        columns_ind = [str(x).zfill(6) for x in columns_ind]
-
-        shm_index_index_data = SharedMemory(name='index_index_data' + "," + usr)
-        index_index_data = np.ndarray((index_shape[0],), dtype='int', buffer=shm_index_index_data.buf)
-        index_index_data = [str(x) for x in index_index_data]
-        shm_columns_index_data = SharedMemory(name='columns_index_data' + "," + usr)
-        columns_index_data = np.ndarray((index_shape[1],), dtype='int', buffer=shm_columns_index_data.buf)
-        columns_index_data = [str(x) for x in columns_index_data]
-
-        for key in key_list:
-            key = key + "," + usr
-            # industry dataframe
-            if key == "ind_df" + "," + usr:
-                shm_temp = SharedMemory(name=key)
-                data_temp = np.ndarray(ind_shape, dtype='float64', buffer=shm_temp.buf).copy()
-                key = key.split(",")[0]
-                data_dict[key] = pd.DataFrame(data=data_temp, index=index_ind, columns=columns_ind)
-
-            # index EOD dataframe
-            elif key == "index_data" + "," + usr:
-                shm_temp = SharedMemory(name=key)
-                data_temp = np.ndarray(index_shape, dtype='float64', buffer=shm_temp.buf).copy()
-                key = key.split(",")[0]
-                data_dict[key] = pd.DataFrame(data=data_temp, index=index_index_data, columns=columns_index_data)
-            
-            # calendar dataframe
-            elif key == "calendar" + "," + usr:
-                shm_temp = SharedMemory(name=key)
-                data_temp = np.ndarray(calendar_shape, dtype='float64', buffer=shm_temp.buf).copy()
-                key = key.split(",")[0]
-                data_dict[key] = data_temp
-
-            # eod_data_dict
-            else:
-                shm_temp = SharedMemory(name=key)
-                data_temp = np.ndarray(shape, dtype='float64', buffer=shm_temp.buf).copy()
-                key = key.split(",")[0]
-                data_dict[key] = pd.DataFrame(data=data_temp, index=index, columns=columns)
+    for key, data in worker_data.items():
+        if isinstance(data, tuple):
+            values, index, columns = data
+            data = pd.DataFrame(values.copy() if copy else values, index=index, columns=columns, copy=False)
+        data_dict[key] = data
+    return data_dict
+
+
+def backtest_factor(factor, copy):
+    """ run a single factor backtest over the worker's eod_data_dict """
+    backtester = SingleFactorBacktest(offline=True) # daemonic processes are not allowed to have children
+    backtester.get_data_multi(reassemble_data_dict(copy=copy))
+    return (backtester.run_ds_factor(factor[0], factor[1]))  # factor_df, factor_name
 
-    except Exception as e:
-        error_message = "Factor {} shm failed: {}".format(factor[1], e) 
-        print(error_message)
-        error_message_complete = error_message + '\n' +  traceback.format_exc()
-        return error_message_complete
 
-    # start back test 
+def processor(factor):
+    """
+    a single factor backtest. A backtest writing into its inputs fails on the read-only
+    values; it is then run again (and from then on in this worker) on private copies
+    :param factor: [factor_df, factor_name]
+    :return: the backtest summary, or the error message
+    """
     try:
-        backtester = SingleFactorBacktest(offline=True) # daemonic processes are not allowed to have children
-        backtester.get_data_multi(data_dict)
-        return (backtester.run_ds_factor(factor[0], factor[1]))  # factor_df, factor_name
+        copy = worker_flags['copy']
+        try:
+            return backtest_factor(factor, copy)
+        except ValueError as e:
+            if copy or 'read-only' not in str(e):
+                raise
+            worker_flags['copy'] = True
+            print('the backtest writes into its inputs, running on copies')
+            return backtest_factor(factor, True)
 
     except Exception as e:
         error_message = "Factor {} backtest failed: {}".format(factor[1], e)
@@ -270,36 +192,25 @@ def run():
     start batch testing
     """
     factor_name_list = cfg.factor_name_list
-    res_list = []
     batch_tester = BasicBatchTest()
     try:
         batch_tester.run(namespace="", name_list=factor_name_list)
 
-        # define pool 
-        pool = mp.Pool(processes=cfg.max_processes)
-        for i in range(len(batch_tester.factor_dict.keys())):
-            factor_name = list(batch_tester.factor_dict.keys())[i]
-            factor_df = batch_tester.factor_dict[factor_name]
-            res_list.append(
-                pool.apply_async(
-                    processor, args=(
-                        [factor_df, factor_name],
-                        batch_tester.shape,
-                        batch_tester.ind_shape,
-                        batch_tester.index_shape,
-                        batch_tester.calendar_shape,
-                        batch_tester.usr,
-                        batch_tester.key_list,
-                    )))
-
-        time.sleep(1)
+        # define processes: concurrency sized from the peak memory of the first backtests (see TaskScheduler.py)
+        task_list = []
+        for factor_name, factor_df in batch_tester.factor_dict.items():
+            task_list.append(([factor_df, factor_name], ))
+        scheduler = MemoryAwareScheduler(
+            memory_budget_gb=cfg.memory_budget_gb, max_workers=cfg.max_processes, 
+            initializer=init_worker, initargs=(batch_tester.layout, )
+        )
 
         res_group_list = []
-        for res in res_list:
-            res_group_list.append(res.get())
-
-        pool.close()
-        pool.join()
+        for (factor, ), (succeeded, res) in zip(task_list, scheduler.run(processor, task_list)):
+            if succeeded:
+                res_group_list.append(res)
+            else:
+                print("Factor {} backtest failed: {}".format(factor[1], res))
 
         final_res_group_list = []
         for res in res_group_list:
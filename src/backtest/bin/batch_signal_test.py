@@ -11,8 +11,6 @@ import logging
 
 import numpy as np
 import pandas as pd
-import multiprocessing as mp
-from multiprocessing.shared_memory import SharedMemory
 
 # load files 
 from src.backtest.configuration import config as cfg
@@ -21,6 +19,15 @@ from src.backtest.bin.single_signal_test import SingleSignalBacktest
 
 # init data
 from src.data_ingestion.PqiDataSdk_Offline import PqiDataSdkOffline
+from src.data_ingestion.TaskScheduler import MemoryAwareScheduler
+from src.backtest.tools.shmtools import publish_data_dict, attach_data_dict
+
+# per worker: the eod_data_dict published by the parent (dataframes as (read-only values, index, columns))
+worker_data = {}
+# per worker: the attached segment, kept open
+worker_segments = []
+# per worker: set once a backtest wrote into its inputs, the next ones run on private copies
+worker_flags = {'copy': False}
 
 
 logging.basicConfig(level=logging.CRITICAL)
@@ -33,7 +40,6 @@ class BasicBatchTest:
         self.start_date = cfg.start_date
         self.end_date = cfg.end_date
         self.stock_pool = self.myconnector.get_ticker_list()  # read all and mask later
-        self.usr = cfg.user
         self.index_list = cfg.index_list
         pool_type = " + ".join(self.index_list) + ', ' + ('fmv weighted' if cfg.weight_index_by_fmv else 'equally weighted')
         self.pool_type = pool_type
@@ -41,11 +47,9 @@ class BasicBatchTest:
         self.fixed_stock_pool = cfg.fixed_stock_pool
         print(f'Stock Pool: {self.pool_type}')
         self.max_processes = cfg.max_processes
-        self.shape = []
-        self.ind_shape = []
         self.factor_dict = {}
-        self.key_list = []
-        self.all_key_list = []
+        self.segment = None
+        self.layout = None
         self.namespace = ""
         self.name_list = []
         self.factor_path = cfg.factor_path
@@ -60,51 +64,20 @@ class BasicBatchTest:
         print("SHM ready")
 
     def load_data(self):
-        # read data
+        # read data once, shared read-only with the workers (see tools/shmtools.py)
         tester = SingleSignalBacktest()
         eod_data_dict = tester.get_data()
-        # save ndarray to shm
         df_sample = eod_data_dict["ClosePrice"]
         self.df_sample = df_sample
         self.date_list = list(df_sample.columns)
-        self.shape = df_sample.shape
-        self.ind_shape = eod_data_dict["ind_df"].shape
-        self.index_shape = eod_data_dict["index_data"].shape
-        self.calendar_shape = eod_data_dict["calendar"].shape
-        index_array = np.array(df_sample.index.T).astype("int")
-        columns_array = np.array(df_sample.columns.T).astype("int")
-        index_array_ind = np.array(eod_data_dict["ind_df"].index.T).astype("int")
-        columns_array_ind = np.array(eod_data_dict["ind_df"].columns.T).astype("int")        
-        index_index_data_array = np.array(eod_data_dict["index_data"].index.T).astype("int")
-        columns_index_data_array = np.array(eod_data_dict["index_data"].columns.T).astype("int")
-        calendar = np.array(eod_data_dict["calendar"].astype("int"))
-        abnormal_keys = []
-        for k in eod_data_dict.keys():
-            if eod_data_dict[k].shape != self.shape and k != "ind_df" and k != 'calendar' and k != 'index_data':
-                print("delete {}  with shape {}".format(k, eod_data_dict[k].shape))
-                abnormal_keys.append(k)
-
-        for k in abnormal_keys:
-            del eod_data_dict[k]
-
-        self.key_list = list(eod_data_dict.keys())
-        self.all_key_list = self.key_list.copy()
-        self.all_key_list.extend(["index", "columns", "index_ind", "columns_ind"])
-        self.save_to_shm(index_array, "index"),
-        self.save_to_shm(columns_array, "columns")
-        self.save_to_shm(index_array_ind, "index_ind")
-        self.save_to_shm(columns_array_ind, "columns_ind")
-        self.save_to_shm(calendar,"calendar")
-
-        self.all_key_list.extend(["index_index_data", "columns_index_data"])
-        self.save_to_shm(index_index_data_array, "index_index_data")
-        self.save_to_shm(columns_index_data_array, "columns_index_data")
-
-        for k in self.key_list:
-            if k != 'calendar':
-                data = eod_data_dict[k].values
-                self.save_to_shm(data, k)
-    
+        self.segment, self.layout = publish_data_dict(eod_data_dict, self.myconnector)
+
+    def shmClean(self):
+        # erase the shared memory (the data server owns its own segments)
+        if self.segment is not None:
+            self.segment.close()
+            self.segment.unlink()
+
     def read_factor(self):
         """
         load factors
@@ -171,108 +144,56 @@ class BasicBatchTest:
                     factor_dict[factor] = raw_factor_df + (raw_factor_df.loc[self.fixed_stock_pool] - raw_factor_df.loc[self.fixed_stock_pool])
         return factor_dict
 
+# subprocess functions (do not defined as class functions)
+def init_worker(layout):
+    """
+    pool initializer: attach to the eod_data_dict published by the parent (see tools/shmtools.py), 
+    without copies. The values are read-only, so that a backtest cannot leak changes into the next one
+    """
+    data, segment = attach_data_dict(layout)
+    worker_data.update(data)
+    worker_segments.append(segment)
 
 
-    def save_to_shm(self, data_nd, name):
-        """
-        read ndarray and save to shm 
-
-        :param data_nd:
-        :param name:
-        :return:
-        """
-        name = name + "," + self.usr
-        shm_address = SharedMemory(name=name, create=True, size=data_nd.nbytes)
-        shm_nd_data = np.ndarray(data_nd.shape, dtype=data_nd.dtype, buffer=shm_address.buf)
-        shm_nd_data[:] = data_nd[:]
-
-    def shmClean(self):
-        # earse shm 
-        for k in self.all_key_list:
-            try:
-                shm = SharedMemory(name=k + "," + self.usr)
-                shm.close()
-                shm.unlink()
-            except Exception as e:
-                print(e)
-
-# do not append to the class as a class method. 
-def processor(factor, shape, ind_shape, index_shape, calendar_shape, usr, key_list):
+def reassemble_data_dict(copy=False):
     """
-    single process
-    :param factor:
-    :param from_ds:
-    :param key_list:
-    :param usr:
-    :param ind_shape:
-    :param shape:
-    :return:
+    eod_data_dict over the worker's data (see init_worker): fresh dataframes per backtest,
+    sharing the index, columns and read-only values
+    :param copy: copy the values (writable)
     """
-# reconstruct data_dict
     data_dict = dict()
-    try:
-        shm_index = SharedMemory(name='index' + "," + usr)
-        index = np.ndarray((shape[0],), dtype='int', buffer=shm_index.buf)
-        index = [str(x).zfill(6) for x in index]
-        shm_columns = SharedMemory(name='columns' + "," + usr)
-        columns = np.ndarray((shape[1],), dtype='int', buffer=shm_columns.buf)
-        columns = [str(x) for x in columns]
-
-        shm_index_ind = SharedMemory(name='index_ind' + "," + usr)
-        index_ind = np.ndarray((ind_shape[0],), dtype='int', buffer=shm_index_ind.buf)
-        index_ind = [str(x).zfill(6) for x in index_ind]
-        shm_columns_ind = SharedMemory(name='columns_ind' + "," + usr)
-        columns_ind = np.ndarray((ind_shape[1],), dtype='int', buffer=shm_columns_ind.buf)
-        columns_ind = [str(x).zfill(6) for x in columns_ind]
-
-        shm_index_index_data = SharedMemory(name='index_index_data' + "," + usr)
-        index_index_data = np.ndarray((index_shape[0],), dtype='int', buffer=shm_index_index_data.buf)
-        index_index_data = [str(x) for x in index_index_data]
-        shm_columns_index_data = SharedMemory(name='columns_index_data' + "," + usr)
-        columns_index_data = np.ndarray((index_shape[1],), dtype='int', buffer=shm_columns_index_data.buf)
-        columns_index_data = [str(x) for x in columns_index_data]
-
-        for key in key_list:
-            key = key + "," + usr
-            # industry dataframe
-            if key == "ind_df" + "," + usr:
-                shm_temp = SharedMemory(name=key)
-                data_temp = np.ndarray(ind_shape, dtype='float64', buffer=shm_temp.buf).copy()
-                key = key.split(",")[0]
-                data_dict[key] = pd.DataFrame(data=data_temp, index=index_ind, columns=columns_ind)
-
-            # index return ataframe
-            elif key == "index_data" + "," + usr:
-                shm_temp = SharedMemory(name=key)
-                data_temp = np.ndarray(index_shape, dtype='float64', buffer=shm_temp.buf).copy()
-                key = key.split(",")[0]
-                data_dict[key] = pd.DataFrame(data=data_temp, index=index_index_data, columns=columns_index_data)
-            
-            # calendar ataframe
-            elif key == "calendar" + "," + usr:
-                shm_temp = SharedMemory(name=key)
-                data_temp = np.ndarray(calendar_shape, dtype='float64', buffer=shm_temp.buf).copy()
-                key = key.split(",")[0]
-                data_dict[key] = data_temp
-
-            # eod_data_dict
-            else:
-                shm_temp = SharedMemory(name=key)
-                data_temp = np.ndarray(shape, dtype='float64', buffer=shm_temp.buf).copy()
-                key = key.split(",")[0]
-                data_dict[key] = pd.DataFrame(data=data_temp, index=index, columns=columns)
+    for key, data in worker_data.items():
+        if isinstance(data, tuple):
+            values, index, columns = data
+            data = pd.DataFrame(values.copy() if copy else values, index=index, columns=columns, copy=False)
+        data_dict[key] = data
+    return data_dict
 
-    except Exception as e:
-        error_message = "Signal {} shm failed: {}".format(factor[1], e) 
-        print(error_message)
-        error_message_complete = error_message + '\n' +  traceback.format_exc()
-        return error_message_complete
 
-    # signal backtest
+def backtest_signal(factor, copy):
+    """ run a single signal backtest over the worker's eod_data_dict """
+    backtester = SingleSignalBacktest(offline=True) # daemonic processes are not allowed to have children
+    backtester.get_data_multi(reassemble_data_dict(copy=copy))
+    return (backtester.run_signal(factor[0], factor[1]))
+
+
+def processor(factor):
+    """
+    single process. A backtest writing into its inputs fails on the read-only values; 
+    it is then run again (and from then on in this worker) on private copies
+    :param factor: [signal_df, signal_name]
+    :return: the backtest summary, or the error message
+    """
     try:
-        backtester = SingleSignalBacktest(offline=True) # daemonic processes are not allowed to have children
-        backtester.get_data_multi(data_dict)
-        return (backtester.run_signal(factor[0], factor[1]))
+        copy = worker_flags['copy']
+        try:
+            return backtest_signal(factor, copy)
+        except ValueError as e:
+            if copy or 'read-only' not in str(e):
+                raise
+            worker_flags['copy'] = True
+            print('the backtest writes into its inputs, running on copies')
+            return backtest_signal(factor, True)
 
     except Exception as e:
         error_message = "Signal {} backtest failed: {}".format(factor[1], e)
@@ -299,34 +220,25 @@ def run():
     main function
     """
     signal_name_list = cfg.signal_name_list
-    res_list = []
     batch_tester = BasicBatchTest()
     try: 
         batch_tester.run(namespace="", name_list=signal_name_list)
 
-        # define processes
-        pool = mp.Pool(processes=cfg.max_processes)
-        for i in range(len(batch_tester.factor_dict.keys())):
-            factor_name = list(batch_tester.factor_dict.keys())[i]
-            factor_df = batch_tester.factor_dict[factor_name]
-            res_list.append(pool.apply_async(processor, args=(
-                [factor_df, factor_name], 
-                batch_tester.shape,
-                batch_tester.ind_shape, 
-                batch_tester.index_shape, 
-                batch_tester.calendar_shape, 
-                batch_tester.usr, 
-                batch_tester.key_list,
-            )))
-
-        time.sleep(1)
+        # define processes: concurrency sized from the peak memory of the first backtests (see TaskScheduler.py)
+        task_list = []
+        for factor_name, factor_df in batch_tester.factor_dict.items():
+            task_list.append(([factor_df, factor_name], ))
+        scheduler = MemoryAwareScheduler(
+            memory_budget_gb=cfg.memory_budget_gb, max_workers=cfg.max_processes, 
+            initializer=init_worker, initargs=(batch_tester.layout, )
+        )
 
         res_group_list = []
-        for res in res_list:
-            res_group_list.append(res.get())
-
-        pool.close()
-        pool.join()
+        for (factor, ), (succeeded, res) in zip(task_list, scheduler.run(processor, task_list)):
+            if succeeded:
+                res_group_list.append(res)
+            else:
+                print("Signal {} backtest failed: {}".format(factor[1], res))
 
         final_res_group_list = []
         for res in res_group_list:
@@ -346,5 +258,5 @@ def run():
         print(e)
         print(traceback.format_exc())
     finally:
-        # clean shm
+        # clean shm 
         batch_tester.shmClean()
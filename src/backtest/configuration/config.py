@@ -19,7 +19,8 @@ test_name = 'short_experiment'
 '''
 ======= BackTest System Config ========
 '''
-max_processes = 8  # batch testing max processors to use
+max_processes = None  # batch testing max processors to use (None: all cores; fewer if the memory budget requires)
+memory_budget_gb = None  # memory the batch testing processes may use together (None: 80% of the memory available at start)
 ds_max_processes = 12  # Dataserver读取数据的最大进程数
 
 # init data server 
@@ -12,6 +12,8 @@ import pandas as pd
 # load files 
 from src.backtest.configuration import config as cfg
 from src.data_ingestion.PqiDataSdk_Offline import PqiDataSdkOffline
+from src.data_ingestion.IndexMembership import IndexMembership
+from src.data_ingestion.TradeCalendar import TradeCalendar
 
 class DataAssist:
 
@@ -34,6 +36,7 @@ class DataAssist:
             self.eod_data_dict = eod_data_dict
             self.stock_pool = list(self.eod_data_dict["ClosePrice"].index)
             self.calendar = [str(x) for x in self.eod_data_dict['calendar']]
+            self.trade_calendar = TradeCalendar(self.calendar)
         else: 
             # self.myconnector = PqiDataSdk(user=cfg.user, size=cfg.ds_max_processes, pool_type="mp", log=False,
             #                               offline=True)
@@ -45,7 +48,8 @@ class DataAssist:
             for k in self.eod_data_dict.keys():
                 self.eod_data_dict[k].columns = [str(x) for x in self.eod_data_dict[k].columns]
             self.eod_data_dict["ind_df"] = self.ind_df
-            self.calendar = np.array(sorted([int(x) for x in self.myconnector.select_trade_dates(start_date='20010101',end_date='21000101')]))
+            self.trade_calendar = self.myconnector.calendar
+            self.calendar = np.array(self.trade_calendar.dates.astype(int))
             self.eod_data_dict["calendar"] = self.calendar
 
         # 未赋值变量
@@ -118,14 +122,9 @@ class DataAssist:
         :param index_list: 一个装有指数的列表，支持组合指数
         :return 指数mask
         """
-        agg_index_mask = False
-        # 读入和拼接多个index
-        for index in index_list:
-            index_weight = DataAssist.get_stock_weight(index)
-            index_mask = index_weight.notna()
-            agg_index_mask = agg_index_mask | index_mask
-        # 将dataframe转换为1和nan的矩阵
-        agg_index_mask = agg_index_mask.astype(int) / agg_index_mask.astype(int)
+        # 由bit-packed的成分股索引直接生成1和nan的矩阵
+        index_membership = IndexMembership(cfg.index_member_stock_path)
+        agg_index_mask = index_membership.get_nan_mask(index_list, cfg.trade_dates)
         return agg_index_mask        
 
     # TODO: 更改eod data 读取方式
@@ -146,6 +145,17 @@ class DataAssist:
                 print(k + " has special shape")
                 print(self.eod_data_dict[k].shape)
 
+    def get_adj_price(self, field):
+        '''
+        复权价格 (field * AdjFactor), 在线时从预先计算的derived store读取 (see data_ingestion/DerivedStore.py)
+        :param field: 'OpenPrice', 'ClosePrice', 'VWAP', ...
+        :return:
+        '''
+        if self.offline:
+            return self.eod_data_dict[field] * self.eod_data_dict['AdjFactor']
+        template = self.eod_data_dict['ClosePrice']
+        return self.myconnector.get_adj_price(field, dates=list(template.columns), tickers=list(template.index))
+
     def get_return_data(self):
         """
         得到不同版本的return数据
@@ -156,14 +166,14 @@ class DataAssist:
 
         price_df = pd.DataFrame()
         if self.return_type == 'open_to_open':
-            price_df = self.eod_data_dict['OpenPrice'] * self.eod_data_dict['AdjFactor']
+            price_df = self.get_adj_price('OpenPrice')
             self.eod_data_dict["OpenToOpenReturn"] = price_df.shift(-2, axis=1) / price_df.shift(-1, axis=1) - 1
         elif self.return_type == 'close_to_close':
             raise NotImplementedError
-            price_df = self.eod_data_dict['ClosePrice'] * self.eod_data_dict['AdjFactor']
+            price_df = self.get_adj_price('ClosePrice')
             self.eod_data_dict['CloseToCloseReturn'] = price_df.shift(-2, axis=1) / price_df.shift(-1, axis=1) - 1
         elif self.return_type == 'vwap_to_vwap':
-            price_df = self.eod_data_dict['VWAP'] * self.eod_data_dict['AdjFactor']
+            price_df = self.get_adj_price('VWAP')
             self.eod_data_dict['VwapToVwapReturn'] = price_df.shift(-2, axis=1) / price_df.shift(-1, axis=1) - 1
 
         self.ret_df = price_df.shift(-2, axis=1) / price_df.shift(-1, axis=1) - 1
@@ -196,12 +206,12 @@ class DataAssist:
 
         # get split return df
         self.split_ret_dict = {}
-        price_close_0 = (self.eod_data_dict['ClosePrice']*self.eod_data_dict['AdjFactor']).shift(1,axis=1)
-        price_open_1 = self.eod_data_dict['OpenPrice']*self.eod_data_dict['AdjFactor']
-        price_vwap_1 = self.eod_data_dict['VWAP']*self.eod_data_dict['AdjFactor']
-        price_close_1 = self.eod_data_dict['ClosePrice']*self.eod_data_dict['AdjFactor']
-        price_open_2 = (self.eod_data_dict['OpenPrice']*self.eod_data_dict['AdjFactor']).shift(-1,axis=1)
-        price_vwap_2 = (self.eod_data_dict['VWAP']*self.eod_data_dict['AdjFactor']).shift(-1,axis=1)
+        price_open_1 = self.get_adj_price('OpenPrice')
+        price_vwap_1 = self.get_adj_price('VWAP')
+        price_close_1 = self.get_adj_price('ClosePrice')
+        price_close_0 = price_close_1.shift(1,axis=1)
+        price_open_2 = price_open_1.shift(-1,axis=1)
+        price_vwap_2 = price_vwap_1.shift(-1,axis=1)
         self.split_ret_type_list = ['cto','otv','vtc','cto1','o1tv1']
         self.split_ret_dict["cto"] = price_open_1/price_close_0 - 1
         self.split_ret_dict['otv'] = price_vwap_1/price_close_0 - 1
@@ -226,13 +236,13 @@ class DataAssist:
         # ticker_basic_df = self.myconnector.get_ticker_basic(tickers=self.stock_pool, source='stock')
         # issue_date_dict = ticker_basic_df['listDate'].to_dict()
         issue_date_dict = self.myconnector.get_ticker_list_date()
-        issue_status_df = pd.DataFrame(np.ones_like(self.eod_data_dict['ClosePrice']),
-                                       index=self.eod_data_dict['ClosePrice'].index,
-                                       columns=self.eod_data_dict['ClosePrice'].columns).T
-        for ticker in self.stock_pool:
-            # ! the following is a very dangerous operation. Revise later
-            issue_status_df[ticker].loc[:self.get_previous_N_tradedate(issue_date_dict[ticker], -60)] = np.nan
-        return issue_status_df.T
+        close_df = self.eod_data_dict['ClosePrice']
+        # first tradable date of every stock in one shot: list date + 60 trade days
+        list_dates = [issue_date_dict[ticker] for ticker in close_df.index]
+        last_untradable = self.trade_calendar.shift(list_dates, 60)
+        dates = np.asarray(close_df.columns).astype(str)
+        issue_status = np.where(dates[None, :] <= last_untradable[:, None], np.nan, 1.)
+        return pd.DataFrame(issue_status, index=close_df.index, columns=close_df.columns)
 
     def get_valid_df(self):
 
@@ -284,22 +294,11 @@ class DataAssist:
     def get_previous_N_tradedate(self, date, N=1):
         """
         get trade days N days ago 
-        :param date: must be a trade date
+        :param date: must be a trade date (if not in the calendar, return itself)
         :param N:
         :return:
         """
-        # find index
-        cur_date_idx = np.where(self.calendar == int(date))[0]
-        # if not in the current calendar, the solution is imperfect: just return itself.
-        if len(cur_date_idx) == 0:
-            return date
-        
-        prev_date_idx = cur_date_idx[0] - N 
-        # put in range
-        prev_date_idx_aligned = max(0, min(len(self.calendar) - 1, prev_date_idx)) 
-        # select date
-        pre_date = str(self.calendar[prev_date_idx_aligned])
-        return pre_date
+        return self.trade_calendar.shift_one(date, -N)
 
     # TODO: 
     def get_status(self, up_down):
@@ -438,9 +437,9 @@ class DataAssist:
         else:
             price_df = pd.DataFrame()
             if self.return_type == 'open_to_open':
-                price_df = self.eod_data_dict['OpenPrice'] * self.eod_data_dict['AdjFactor']
+                price_df = self.get_adj_price('OpenPrice')
             elif self.return_type == 'vwap_to_vwap':
-                price_df = self.eod_data_dict['VWAP'] * self.eod_data_dict['AdjFactor']
+                price_df = self.get_adj_price('VWAP')
             
             # TODO: 清除不必要的代码，如下一行
             self.eod_data_dict['index_data'] = price_df  # 这一行是没有用但必须的，因为自建指数的时候是不通过‘index_data’算的，但batch需要有它
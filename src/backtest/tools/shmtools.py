@@ -0,0 +1,96 @@
+"""
+Share the eod_data_dict of a batch backtest with the pool workers, read-only and loaded once
+
+The parent builds eod_data_dict once (DataAssist: the eod fields and the derived frames) and publishes it:
+- eod fields served by the data server (python run.py data_server) are not copied: the workers
+  attach to the server segments directly;
+- every other dataframe (returns, masks, status, industries, index data, and all eod fields when
+  no server is running) is packed into one segment owned by the parent;
+- other values (the calendar) travel with the layout.
+
+    segment, layout = publish_data_dict(eod_data_dict, myconnector)  # parent
+    ... pool initializer: data, segment = attach_data_dict(layout)   # key -> (read-only values, index, columns)
+    segment.close(); segment.unlink()                                  # parent, once the pool is done
+"""
+
+# load packages
+import os
+import getpass
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, Tuple
+
+from src.data_ingestion.DataServer import attach_segment, connect_server
+
+# the eod fields looked up on the data server
+SERVED_GROUP = 'stock_eod_data'
+
+
+def is_served(myconnector, key: str, df: pd.DataFrame) -> bool:
+    """ whether df is a view of a data server panel (and not a copy, e.g. cast by the precision policy) """
+    if myconnector.server is None or not myconnector.use_server(SERVED_GROUP, key):
+        return False
+    served_df = myconnector.server.read(SERVED_GROUP, key, dates=list(df.columns), tickers=list(df.index))
+    return np.may_share_memory(df.to_numpy(), served_df.to_numpy())
+
+
+def publish_data_dict(eod_data_dict: Dict, myconnector) -> Tuple[SharedMemory, Dict]:
+    """
+    publish eod_data_dict for attach_data_dict
+
+    :param myconnector: the PqiDataSdkOffline the eod fields were read with
+    :return the segment packing the frames not served (None if none; the caller unlinks it), the layout
+    """
+    layout = {'segment': None, 'frames': {}, 'objects': {}}
+    packed = []
+    nbytes = 0
+    for key, data in eod_data_dict.items():
+        if not isinstance(data, pd.DataFrame) or any(dtype == object for dtype in data.dtypes):
+            layout['objects'][key] = data
+        elif is_served(myconnector, key, data):
+            layout['frames'][key] = (('server', ), data.index, data.columns)
+        else:
+            values = data.to_numpy()
+            offset = -(-nbytes // 8) * 8  # 8-byte aligned
+            layout['frames'][key] = (('shm', offset, values.shape, values.dtype.str), data.index, data.columns)
+            packed.append((offset, values))
+            nbytes = offset + values.nbytes
+
+    if len(packed) == 0:
+        return None, layout
+    segment = SharedMemory(name=f'backtest_{getpass.getuser()}_{os.getpid()}', create=True, size=nbytes)
+    for offset, values in packed:
+        np.ndarray(values.shape, dtype=values.dtype, buffer=segment.buf, offset=offset)[:] = values
+    layout['segment'] = segment.name
+    return segment, layout
+
+
+def attach_data_dict(layout: Dict) -> Tuple[Dict, SharedMemory]:
+    """
+    子进程: the published eod_data_dict, without copies
+
+    :return key -> (read-only values, index, columns) for the dataframes, the other values as they are;
+        the attached segment (None if none), to keep open for the life of the worker
+    """
+    data = dict(layout['objects'])
+    segment = None
+    if layout['segment'] is not None:
+        # forked workers share the resource tracker of the parent, which owns the segment
+        forked = mp.get_start_method() == 'fork'
+        segment = SharedMemory(name=layout['segment']) if forked else attach_segment(layout['segment'])
+    server = None
+    for key, (source, index, columns) in layout['frames'].items():
+        if source[0] == 'server':
+            server = connect_server() if server is None else server
+            if server is None:
+                raise RuntimeError('the data server stopped after the eod data was published, restart the backtest')
+            values = server.read(SERVED_GROUP, key, dates=list(columns), tickers=list(index)).to_numpy()
+        else:
+            _, offset, shape, dtype = source
+            values = np.ndarray(shape, dtype=dtype, buffer=segment.buf, offset=offset)
+        values = values.view()
+        values.flags.writeable = False
+        data[key] = (values, index, columns)
+    return data, segment
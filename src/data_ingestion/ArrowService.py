@@ -0,0 +1,237 @@
+"""
+Arrow IPC data service for PqiDataSdkOffline, over TCP
+
+For backtest / optimizer sweeps on several boxes: one box holding the data runs
+
+    python run.py data_service --host 0.0.0.0 --port 8815
+
+and the others set DATA_SERVICE = 'host:8815' in PqiDataSdk_Offline.py (or pass
+PqiDataSdkOffline(data_service='host:8815')). The SDK interface stays the same; the reads
+of the client are answered by the PqiDataSdkOffline of the server, which slices the
+requested dates / tickers and streams only that slice back as Arrow record batches:
+
+- eod fields ({source}_eod_data), features (with their date partitions), dynamic
+  industries, index stock weights, derived adjusted prices / returns;
+- the trade dates and tickers, ListDate and SWClass tables, feature statistics.
+
+Wire format, per request on a persistent connection:
+    client -> server:  4-byte big-endian length, JSON request {'op': ..., ...}
+    server -> client:  4-byte big-endian length, JSON header {'ok': bool, ...}
+                       then, if ok, one Arrow IPC stream (a table with an 'index' column)
+Errors raised on the server (e.g. KeyError for a missing date) are raised again on the
+client with the same type when it is a builtin one. Writes stay local to each box.
+"""
+
+# load packages
+import os
+import json
+import socket
+import struct
+import builtins
+import threading
+import socketserver
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from typing import List
+
+# default address
+SERVICE_HOST = '127.0.0.1'
+SERVICE_PORT = 8815
+
+# tickers per record batch on the wire
+STREAM_CHUNK_SIZE = 512
+
+# plain tables served by name (relative to the parsed data)
+SERVICE_TABLES = {
+    'ListDate': 'stock_basics/ListDate',
+    'SWClass': 'industry_class/SWClass'
+}
+
+
+# ===================================
+# ---------- framing ----------------
+# ===================================
+
+def send_json(wfile, message: dict) -> None:
+    """ a length-prefixed JSON message """
+    payload = json.dumps(message).encode()
+    wfile.write(struct.pack('>I', len(payload)) + payload)
+
+
+def recv_json(rfile) -> dict:
+    """ the next length-prefixed JSON message, None at end of connection """
+    head = rfile.read(4)
+    if len(head) < 4:
+        return None
+    (length,) = struct.unpack('>I', head)
+    return json.loads(rfile.read(length))
+
+
+def send_frame(wfile, df: pd.DataFrame) -> None:
+    """ a ticker x date dataframe (or a plain table) as an Arrow IPC stream """
+    table = pa.Table.from_pandas(df.reset_index(), preserve_index=False)
+    with pa.ipc.new_stream(wfile, table.schema) as writer:
+        writer.write_table(table, max_chunksize=STREAM_CHUNK_SIZE)
+
+
+def recv_frame(rfile) -> pd.DataFrame:
+    """ the dataframe of the next Arrow IPC stream """
+    return pa.ipc.open_stream(rfile).read_all().to_pandas()
+
+
+# ===================================
+# ------------ server ---------------
+# ===================================
+
+class ServiceHandler(socketserver.StreamRequestHandler):
+    """ answers the requests of one client connection, in order """
+
+    def handle(self) -> None:
+        while True:
+            request = recv_json(self.rfile)
+            if request is None:
+                return
+            try:
+                df = self.server.answer(request)
+            except Exception as e:
+                message = str(e.args[0]) if len(e.args) == 1 else str(e)
+                send_json(self.wfile, {'ok': False, 'error': type(e).__name__, 'message': message})
+            else:
+                send_json(self.wfile, {'ok': True})
+                send_frame(self.wfile, df)
+            self.wfile.flush()
+
+
+class ArrowDataService(socketserver.ThreadingTCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, ds, host: str = SERVICE_HOST, port: int = SERVICE_PORT) -> None:
+        """
+        :param ds: the PqiDataSdkOffline answering the requests (reading local data)
+        :param host, port: the address to listen on (port 0: any free port, see self.address)
+        """
+        super().__init__((host, port), ServiceHandler)
+        self.ds = ds
+        self.address = '{}:{}'.format(*self.server_address[:2])
+
+    def answer(self, request: dict) -> pd.DataFrame:
+        """ the dataframe answering a request """
+        ds, op = self.ds, request['op']
+        dates, tickers = request.get('dates', []), request.get('tickers', [])
+
+        if op == 'trade_dates':
+            return pd.DataFrame(index=pd.Index(np.asarray(ds.trade_dates).astype(str), name='index'))
+        if op == 'tickers':
+            return pd.DataFrame(index=pd.Index(np.asarray(ds.tickers).astype(str), name='index'))
+        if op == 'table':
+            return ds.get_table(request['name'])
+        if op == 'stats':
+            return ds.get_feature_stats(request['des'], request['file_name'])[request['axis']]
+        if op != 'panel':
+            raise ValueError(f'op {op} not supported')
+
+        group, name = request['group'], request['name']
+        if group.endswith('_eod_data'):
+            if len(dates) == 0:
+                dates = ds.trade_dates
+            return ds.read_eod_field(name, group[:-len('_eod_data')], dates, tickers if len(tickers) > 0 else ds.tickers)
+        if group == 'index_stock_weight':
+            return ds.get_stock_weight(name, dates if len(dates) > 0 else None)
+        if group == 'derived/adj_price':
+            return ds.get_adj_price(name, dates=dates, tickers=tickers)
+        if group == 'derived/returns':
+            return ds.get_returns(name, dates=dates, tickers=tickers)
+        return ds.read_feature(group, name, dates=dates, tickers=tickers)
+
+    def run(self) -> None:
+        """ serve until SIGINT / SIGTERM """
+        print(f'data service listening on {self.address}')
+        try:
+            self.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.server_close()
+
+
+# ===================================
+# ------------ client ---------------
+# ===================================
+
+class ArrowServiceClient:
+
+    def __init__(self, address: str) -> None:
+        """ :param address: 'host:port' of a running ArrowDataService """
+        host, port = address.rsplit(':', 1)
+        self.address = (host, int(port))
+        self.local = threading.local()  # one connection per thread (and per process, after a fork)
+
+    def connection(self):
+        """ (socket, rfile, wfile) of the current thread, connecting on first use """
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.local.conn = None  # inherited from the parent: not ours to use
+            self.local.pid = os.getpid()
+        if self.local.conn is None:
+            sock = socket.create_connection(self.address)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.local.conn = (sock, sock.makefile('rb'), sock.makefile('wb'))
+        return self.local.conn
+
+    def request(self, **request) -> pd.DataFrame:
+        """ send a request, return the dataframe streamed back """
+        _, rfile, wfile = self.connection()
+        try:
+            send_json(wfile, request)
+            wfile.flush()
+            header = recv_json(rfile)
+            if header is None:
+                raise ConnectionError(f'data service {self.address} closed the connection')
+        except OSError:
+            self.close()
+            raise
+        if not header['ok']:
+            error = getattr(builtins, header['error'], None)
+            if not (isinstance(error, type) and issubclass(error, Exception)):
+                error = RuntimeError
+            raise error(header['message'])
+        return recv_frame(rfile)
+
+    def read(
+            self,
+            group: str,
+            name: str,
+            dates: List[str] = [],
+            tickers: List[str] = []
+        ) -> pd.DataFrame:
+        """ a ticker x date slice of a panel """
+        df = self.request(
+            op='panel', group=group, name=name,
+            dates=[str(x) for x in dates], tickers=[str(x) for x in tickers]
+        )
+        return df.set_index('index')
+
+    def get_trade_dates(self) -> np.ndarray:
+        return self.request(op='trade_dates')['index'].to_numpy(dtype=object)
+
+    def get_tickers(self) -> np.ndarray:
+        return self.request(op='tickers')['index'].to_numpy(dtype=object)
+
+    def get_table(self, name: str) -> pd.DataFrame:
+        """ one of SERVICE_TABLES """
+        return self.request(op='table', name=name).set_index('index').rename_axis(None)
+
+    def get_feature_stats(self, des: str, file_name: str) -> tuple:
+        """ date_stats, ticker_stats of a feature (see PanelStats.py) """
+        return tuple(
+            self.request(op='stats', des=des, file_name=file_name, axis=axis).set_index('index') for axis in [0, 1]
+        )
+
+    def close(self) -> None:
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            for handle in conn[::-1]:
+                handle.close()
+            self.local.conn = None
@@ -0,0 +1,154 @@
+"""
+Write-behind queue for feature persistence
+
+    ds.save_eod_feature_async('mom_20', factor_df, des='factor')  # returns once queued
+    ...
+    ds.flush_writes()  # barrier: everything queued is on disk. Raises if some writes failed
+
+Writes run on background threads of each process (feather encoding and disk writes release the GIL),
+so computing the next panels overlaps writing the previous ones. Writes of the same feature go to
+the same thread, in the order submitted. At most max_pending panels are queued or being written:
+submitting one more blocks until one is done (back-pressure, bounding the memory held by the queue).
+
+Panels are written as they are when their turn comes: they must not be modified after being submitted.
+
+Stats per process: panels and bytes written, seconds spent writing (on the threads) and seconds the
+caller was blocked (on a full queue or in a flush). At exit each process flushes what is left, so
+writes still pending in a worker are done when the pool has shut down (not if the worker is killed).
+Their errors are only printed then: to report them, wait for them in an exit hook of the pool that
+runs first (see TaskScheduler.init_reporting_worker).
+"""
+
+# load packages
+import os
+import time
+import queue
+import threading
+import traceback
+import pandas as pd
+from multiprocessing import util
+from typing import Callable, List, Tuple
+
+STATS = ['panels', 'bytes', 'write_seconds', 'blocked_seconds', 'failed']
+
+
+class AsyncWriter:
+
+    def __init__(self, workers: int = 2, max_pending: int = 4) -> None:
+        """
+        :param workers: writer threads. 0 to write synchronously in submit
+        :param max_pending: panels queued or being written at most
+        """
+        self.workers = workers
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.pid = None  # the process the threads run in
+        self.stats = dict.fromkeys(STATS, 0)
+        self.errors = []  # (name, traceback) of the failed writes not reported yet
+
+    def start(self) -> None:
+        """ start the threads, once per process (threads do not survive a fork) """
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.stats = dict.fromkeys(STATS, 0)
+        self.errors = []
+        self.slots = threading.Semaphore(self.max_pending)
+        self.queues = [queue.Queue() for _ in range(self.workers)]
+        for write_queue in self.queues:
+            threading.Thread(target=self.work, args=(write_queue,), daemon=True).start()
+        util.Finalize(None, self.close, exitpriority=20)
+
+    # ===================================
+    # ------------ write ----------------
+    # ===================================
+
+    def write(self, name: str, func: Callable, args: tuple, nbytes: int) -> None:
+        """ run a write, recording its stats or its error """
+        start = time.time()
+        try:
+            func(*args)
+        except:
+            with self.lock:
+                self.errors.append((name, traceback.format_exc()))
+                self.stats['failed'] += 1
+        else:
+            with self.lock:
+                self.stats['panels'] += 1
+                self.stats['bytes'] += nbytes
+        finally:
+            with self.lock:
+                self.stats['write_seconds'] += time.time() - start
+
+    def work(self, write_queue: queue.Queue) -> None:
+        """ writer thread """
+        while True:
+            item = write_queue.get()
+            try:
+                if item is None:
+                    return
+                self.write(*item)
+                self.slots.release()
+            finally:
+                write_queue.task_done()
+
+    def submit(self, name: str, func: Callable, *args) -> None:
+        """
+        queue func(*args), blocking while max_pending writes are pending
+
+        :param name: the feature written (writes of the same name run in order)
+        """
+        nbytes = sum(int(x.memory_usage(index=False).sum()) for x in args if isinstance(x, pd.DataFrame))
+        if self.workers == 0:
+            return self.write(name, func, args, nbytes)
+        self.start()
+        start = time.time()
+        self.slots.acquire()
+        with self.lock:
+            self.stats['blocked_seconds'] += time.time() - start
+        self.queues[hash(name) % self.workers].put((name, func, args, nbytes))
+
+    # ===================================
+    # ------------ barrier --------------
+    # ===================================
+
+    def take_errors(self) -> List[Tuple[str, str]]:
+        """ the (name, traceback) of the writes failed since the last call """
+        with self.lock:
+            errors, self.errors = self.errors, []
+        return errors
+
+    def wait(self) -> None:
+        """ wait for all writes submitted so far (their errors are kept for take_errors) """
+        if self.pid == os.getpid():
+            start = time.time()
+            for write_queue in self.queues:
+                write_queue.join()
+            with self.lock:
+                self.stats['blocked_seconds'] += time.time() - start
+
+    def flush(self) -> None:
+        """ wait for all writes submitted so far. Raise RuntimeError if some failed (since the last report) """
+        self.wait()
+        errors = self.take_errors()
+        if len(errors) > 0:
+            raise RuntimeError(
+                f'{len(errors)} writes failed: {[name for name, _ in errors]}\n' + '\n'.join(message for _, message in errors)
+            )
+
+    def get_stats(self) -> dict:
+        """ panels, bytes, write_seconds, blocked_seconds, failed of this process """
+        with self.lock:
+            return dict(self.stats)
+
+    def close(self) -> None:
+        """ exit hook: flush and stop the threads, printing the failed writes """
+        if self.pid != os.getpid():
+            return
+        try:
+            self.flush()
+        except RuntimeError as e:
+            print(e)
+        for write_queue in self.queues:
+            write_queue.put(None)
+        self.pid = None
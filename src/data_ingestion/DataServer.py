@@ -0,0 +1,376 @@
+"""
+Local shared-memory data server for PqiDataSdkOffline
+
+`python run.py data_server` loads, once:
+- the eod cubes ({source}_eod_data, every field),
+- the index stock weights (index_stock_weight, source of the index masks),
+- the trading calendar,
+into named shared memory, and publishes a JSON manifest:
+
+    {SERVER_PATH}/{user}/manifest.json   server pid, segment names, shapes, dtypes, labels
+    {SERVER_PATH}/{user}/leases/{pid}    one file per attached client process
+
+Segments are named pqi_{user}_{i}, so several users can each run their own server.
+PqiDataSdkOffline attaches automatically when the server is alive, and reads become
+zero-copy, read-only views of the segments.
+
+Reference counting and cleanup:
+- each attached process holds a lease file; the server reaps leases of dead pids;
+- on SIGINT / SIGTERM (or `python run.py data_server --stop`) the manifest is withdrawn first,
+  then the server waits up to SHUTDOWN_GRACE seconds for the leases to drain and unlinks
+  every segment;
+- on startup, segments of a manifest whose server pid is dead (a crashed server) are unlinked.
+"""
+
+# load packages
+import os
+import json
+import time
+import atexit
+import signal
+import getpass
+import numpy as np
+import pandas as pd
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import List, Dict
+
+from src.data_ingestion.PanelStore import slice_panel
+
+# Specify paths
+SERVER_PATH = 'data/server'
+
+# content to serve
+SERVER_EOD_SOURCES = ['stock', 'index', 'fund']
+SERVER_INDEX_WEIGHTS = ['000905', '000852', '000985', '000016', '000300']
+
+# timings (seconds)
+REAP_INTERVAL = 5
+SHUTDOWN_GRACE = 60
+
+
+# ===================================
+# ---------- shm helpers ------------
+# ===================================
+
+def pid_alive(pid: int) -> bool:
+    """ whether a process is still running """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def create_segment(name: str, array: np.ndarray) -> SharedMemory:
+    """ create a named segment holding a copy of array """
+    shm = SharedMemory(name=name, create=True, size=max(array.nbytes, 1))
+    shm_array = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    shm_array[:] = array[:]
+    return shm
+
+
+def attach_segment(name: str) -> SharedMemory:
+    """
+    attach to an existing segment without taking ownership
+    (otherwise the resource tracker of this process unlinks it at exit)
+    """
+    shm = SharedMemory(name=name)
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+def unlink_segment(name: str) -> None:
+    """ unlink a segment if it still exists """
+    try:
+        shm = SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+
+def server_dir(server_path: str = SERVER_PATH, namespace: str = None) -> str:
+    """ the folder holding the manifest and leases of a namespace (default: current user) """
+    namespace = getpass.getuser() if namespace is None else namespace
+    return os.path.join(server_path, namespace)
+
+
+def read_manifest(server_path: str = SERVER_PATH, namespace: str = None) -> dict:
+    """ the manifest of a running server, None if absent or stale """
+    manifest_path = os.path.join(server_dir(server_path, namespace), 'manifest.json')
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if not pid_alive(manifest['pid']):
+        return None
+    return manifest
+
+
+# ===================================
+# ------------ server ---------------
+# ===================================
+
+class DataServer:
+
+    def __init__(
+            self,
+            parsed_path: str = 'data/parsed',
+            server_path: str = SERVER_PATH,
+            namespace: str = None
+        ) -> None:
+        self.parsed_path = parsed_path
+        self.namespace = getpass.getuser() if namespace is None else namespace
+        self.server_dir = server_dir(server_path, self.namespace)
+        self.manifest_path = os.path.join(self.server_dir, 'manifest.json')
+        self.lease_dir = os.path.join(self.server_dir, 'leases')
+        self.segments = {}  # shm name -> SharedMemory
+        self.stop_requested = False
+
+    def cleanup_stale(self) -> None:
+        """ unlink the segments left by a crashed server of this namespace """
+        try:
+            with open(self.manifest_path, 'r') as f:
+                manifest = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            manifest = None
+
+        if manifest is not None:
+            if manifest['pid'] != os.getpid() and pid_alive(manifest['pid']):
+                raise RuntimeError(f'data server already running (pid {manifest["pid"]})')
+            for group_dict in manifest['panels'].values():
+                for entry in group_dict.values():
+                    unlink_segment(entry['shm'])
+            unlink_segment(manifest['calendar']['shm'])
+            os.remove(self.manifest_path)
+            print(f'cleaned up stale segments of pid {manifest["pid"]}')
+
+        # leases of the previous run are meaningless now
+        if os.path.isdir(self.lease_dir):
+            for lease in os.listdir(self.lease_dir):
+                os.remove(os.path.join(self.lease_dir, lease))
+
+    def publish(self, array: np.ndarray) -> dict:
+        """ copy an array into a new segment, return its manifest entry """
+        name = f'pqi_{self.namespace}_{len(self.segments)}'
+        unlink_segment(name)  # left over without a manifest
+        self.segments[name] = create_segment(name, array)
+        return {'shm': name, 'shape': list(array.shape), 'dtype': array.dtype.str}
+
+    def load(self) -> dict:
+        """ load everything into shared memory, return the manifest """
+        folders = [(f'{source}_eod_data', None) for source in SERVER_EOD_SOURCES]
+        folders.append(('index_stock_weight', SERVER_INDEX_WEIGHTS))
+
+        labels = []  # deduplicated ticker / date labels
+        label_ids = {}
+        def label_id(values: np.ndarray) -> int:
+            key = tuple(values.tolist())
+            if key not in label_ids:
+                label_ids[key] = len(labels)
+                labels.append(list(key))
+            return label_ids[key]
+
+        panels = {}
+        for group, names in folders:
+            folder = os.path.join(self.parsed_path, group)
+            if not os.path.isdir(folder):
+                continue
+            if names is None:
+                names = sorted(os.listdir(folder))
+            panels[group] = {}
+            for name in names:
+                file_path = os.path.join(folder, name)
+                if not os.path.isfile(file_path):
+                    continue
+                df = pd.read_feather(file_path).set_index('index')
+                df = df.sort_index(axis=1)  # dates ascending, so that ranges are views
+                entry = self.publish(np.ascontiguousarray(df.to_numpy(dtype=float)))
+                entry['tickers'] = label_id(df.index.astype(str).to_numpy())
+                entry['dates'] = label_id(df.columns.astype(str).to_numpy())
+                panels[group][name] = entry
+            print(f'loaded {len(panels[group])} panels of {group}')
+
+        with open(os.path.join(self.parsed_path, 'dates', 'dates.npy'), 'rb') as f:
+            trade_dates = np.load(f, allow_pickle=True)
+        calendar = self.publish(trade_dates.astype(int))
+
+        return {
+            'pid': os.getpid(),
+            'namespace': self.namespace,
+            'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'panels': panels,
+            'calendar': calendar,
+            'labels': labels
+        }
+
+    def write_manifest(self, manifest: dict) -> None:
+        """ publish the manifest atomically """
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def live_leases(self) -> List[int]:
+        """ reap leases of dead processes, return the live pids """
+        live_pids = []
+        for lease in os.listdir(self.lease_dir):
+            pid = int(lease)
+            if pid_alive(pid):
+                live_pids.append(pid)
+            else:
+                try:
+                    os.remove(os.path.join(self.lease_dir, lease))
+                except FileNotFoundError:
+                    pass
+        return live_pids
+
+    def shutdown(self) -> None:
+        """ withdraw the manifest, wait for clients to detach, unlink everything """
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+
+        deadline = time.time() + SHUTDOWN_GRACE
+        live_pids = self.live_leases()
+        while live_pids and time.time() < deadline:
+            print(f'waiting for {len(live_pids)} clients: {live_pids}')
+            time.sleep(1)
+            live_pids = self.live_leases()
+
+        for shm in self.segments.values():
+            shm.close()
+            shm.unlink()
+        self.segments = {}
+        print('data server: all segments unlinked')
+
+    def request_stop(self, signum, frame) -> None:
+        self.stop_requested = True
+
+    def run(self) -> None:
+        """ load, publish and serve until SIGINT / SIGTERM """
+        os.makedirs(self.lease_dir, exist_ok=True)
+        self.cleanup_stale()
+
+        signal.signal(signal.SIGINT, self.request_stop)
+        signal.signal(signal.SIGTERM, self.request_stop)
+
+        try:
+            start = time.time()
+            manifest = self.load()
+            nbytes = sum(shm.size for shm in self.segments.values())
+            self.write_manifest(manifest)
+            print(f'data server ready: {len(self.segments)} segments, {nbytes / 1024 ** 3:.2f} GB, '
+                  f'taking {time.time() - start:.3f}s (pid {os.getpid()})')
+
+            num_clients = 0
+            while not self.stop_requested:
+                time.sleep(REAP_INTERVAL)
+                live_pids = self.live_leases()
+                if len(live_pids) != num_clients:
+                    num_clients = len(live_pids)
+                    print(f'{num_clients} clients attached')
+        finally:
+            self.shutdown()
+
+
+def stop_server(server_path: str = SERVER_PATH, namespace: str = None) -> None:
+    """ ask the running server of a namespace to shut down """
+    manifest = read_manifest(server_path, namespace)
+    if manifest is None:
+        print('no data server running')
+        return
+    os.kill(manifest['pid'], signal.SIGTERM)
+    print(f'sent SIGTERM to data server (pid {manifest["pid"]})')
+
+
+# ===================================
+# ------------ client ---------------
+# ===================================
+
+class DataServerClient:
+
+    def __init__(self, manifest: dict, server_path: str = SERVER_PATH) -> None:
+        self.manifest = manifest
+        self.lease_dir = os.path.join(server_dir(server_path, manifest['namespace']), 'leases')
+        self.segments = {}  # shm name -> SharedMemory
+        self.arrays = {}    # (group, name) -> (tickers, ticker_pos, dates, values)
+        self.labels = [np.array(x, dtype=object) for x in manifest['labels']]
+        self.pid = None
+        self.acquire_lease()
+
+    def acquire_lease(self) -> None:
+        """ register this process (also re-run in forked children) """
+        self.pid = os.getpid()
+        with open(os.path.join(self.lease_dir, str(self.pid)), 'w') as f:
+            f.write(str(self.pid))
+
+    def release_lease(self) -> None:
+        try:
+            os.remove(os.path.join(self.lease_dir, str(os.getpid())))
+        except FileNotFoundError:
+            pass
+
+    def attach(self, entry: dict) -> np.ndarray:
+        """ read-only view of a segment """
+        if self.pid != os.getpid():
+            self.acquire_lease()
+        if entry['shm'] not in self.segments:
+            self.segments[entry['shm']] = attach_segment(entry['shm'])
+        array = np.ndarray(tuple(entry['shape']), dtype=entry['dtype'], buffer=self.segments[entry['shm']].buf)
+        array.flags.writeable = False
+        return array
+
+    def has(self, group: str, name: str) -> bool:
+        return name in self.manifest['panels'].get(group, {})
+
+    def read(
+            self,
+            group: str,
+            name: str,
+            dates: List[str] = None,
+            tickers: List[str] = None
+        ) -> pd.DataFrame:
+        """ read a panel slice (a zero-copy view for a date range and all tickers) """
+        key = (group, name)
+        if key not in self.arrays:
+            entry = self.manifest['panels'][group][name]
+            tickers_all = self.labels[entry['tickers']]
+            ticker_pos = dict(zip(tickers_all, range(len(tickers_all))))
+            self.arrays[key] = (tickers_all, ticker_pos, self.labels[entry['dates']], self.attach(entry))
+        tickers_all, ticker_pos, dates_all, values = self.arrays[key]
+        return slice_panel(tickers_all, ticker_pos, dates_all, values, dates=dates, tickers=tickers, name=name)
+
+    def get_trade_dates(self) -> np.ndarray:
+        """ the trading calendar, as str """
+        return self.attach(self.manifest['calendar']).astype(str).astype(object)
+
+    def close(self) -> None:
+        """ detach and drop the lease """
+        self.arrays = {}
+        for shm in self.segments.values():
+            try:
+                shm.close()
+            except BufferError:
+                pass  # views still exported; the mapping goes away at exit
+        self.segments = {}
+        self.release_lease()
+
+
+clients = {}  # pid -> DataServerClient, one per process
+
+
+def connect_server(server_path: str = SERVER_PATH, namespace: str = None) -> DataServerClient:
+    """ attach to the running data server of a namespace, None if there is none """
+    manifest = read_manifest(server_path, namespace)
+    if manifest is None:
+        return None
+    client = clients.get(os.getpid())
+    if client is None or client.manifest['pid'] != manifest['pid']:
+        client = DataServerClient(manifest, server_path)
+        clients[os.getpid()] = client
+        atexit.register(client.close)
+    return client
@@ -0,0 +1,146 @@
+"""
+Derived eod panels: adjusted prices and returns
+
+Adjusted prices (field * AdjFactor) and the standard returns are materialized once per
+data refresh (`python run.py build_derived`) over the full history, and served by name:
+
+    ds.get_adj_price('ClosePrice', dates, tickers)
+    ds.get_returns('o2next_o', dates, tickers)
+
+The panels are written next to (not inside) the parsed data, as chunked feather files
+(see RowIndex.py), so the panel / pushdown / cache read paths apply to them as well:
+
+    {DERIVED_PATH}/adj_price/{field}
+    {DERIVED_PATH}/returns/{return_type}
+
+The stamps of the source eod files are kept in {META_PATH}/derived/stamp.npz. When the
+eod data changes, the store is stale and get_returns / get_adj_price compute the
+requested dates from the eod data directly until it is rebuilt.
+
+Returns on date t (adjusted prices, O: open, C: close, V: vwap):
+    o2c:      C[t] / O[t] - 1
+    o2next_o: O[t+1] / O[t] - 1
+    c2next_o: O[t+1] / C[t] - 1
+    c2next_c: C[t+1] / C[t] - 1
+    v2next_v: V[t+1] / V[t] - 1
+    c2c:      C[t] / C[t-1] - 1     (last close to close)
+Since the store spans the full history, the forward returns on the last requested date
+(and c2c on the first one) are filled from the neighbouring trade date, not nan.
+"""
+
+# load packages
+import os
+import numpy as np
+import pandas as pd
+from typing import Dict, List, Tuple
+
+# Specify paths
+DERIVED_PATH = 'data/derived'
+META_PATH = 'data/meta'
+
+# eod fields stored adjusted
+ADJ_PRICE_FIELDS = ['OpenPrice', 'ClosePrice', 'HighestPrice', 'LowestPrice', 'VWAP']
+
+# return type -> (numerator field, numerator shift, denominator field, denominator shift)
+# shift k: the price k trade days later (-1: the day before)
+RETURN_TYPES = {
+    'o2c': ('ClosePrice', 0, 'OpenPrice', 0),
+    'o2next_o': ('OpenPrice', 1, 'OpenPrice', 0),
+    'c2next_o': ('OpenPrice', 1, 'ClosePrice', 0),
+    'c2next_c': ('ClosePrice', 1, 'ClosePrice', 0),
+    'v2next_v': ('VWAP', 1, 'VWAP', 0),
+    'c2c': ('ClosePrice', 0, 'ClosePrice', -1)
+}
+
+# eod files the store is derived from
+SOURCE_FIELDS = ADJ_PRICE_FIELDS + ['AdjFactor']
+
+
+# ===================================
+# ---------- computation ------------
+# ===================================
+
+def adjust_prices(eod_data_dict: Dict[str, pd.DataFrame], fields: List[str] = ADJ_PRICE_FIELDS) -> Dict[str, pd.DataFrame]:
+    """ field * AdjFactor for each price field """
+    return {field: eod_data_dict[field] * eod_data_dict['AdjFactor'] for field in fields}
+
+
+def compute_return(adj_price_dict: Dict[str, pd.DataFrame], return_type: str) -> pd.DataFrame:
+    """
+    a return panel from adjusted prices
+
+    :param adj_price_dict: field -> adjusted price (ticker x date)
+    :param return_type: a key of RETURN_TYPES
+    :return a ticker x date dataframe, nan where the window has no neighbouring date
+    """
+    num_field, num_shift, den_field, den_shift = RETURN_TYPES[return_type]
+    numerator = adj_price_dict[num_field].shift(-num_shift, axis=1)
+    denominator = adj_price_dict[den_field].shift(-den_shift, axis=1)
+    return numerator / denominator - 1
+
+
+def compute_returns(adj_price_dict: Dict[str, pd.DataFrame], return_types: List[str] = list(RETURN_TYPES)) -> Dict[str, pd.DataFrame]:
+    """ several return panels from adjusted prices """
+    return {return_type: compute_return(adj_price_dict, return_type) for return_type in return_types}
+
+
+def required_fields(return_type: str) -> List[str]:
+    """ adjusted price fields a return type is computed from """
+    num_field, _, den_field, _ = RETURN_TYPES[return_type]
+    return sorted({num_field, den_field})
+
+
+# ===================================
+# ------------ store ----------------
+# ===================================
+
+class DerivedStore:
+
+    def __init__(self, parsed_path: str = 'data/parsed', derived_path: str = DERIVED_PATH, meta_path: str = META_PATH) -> None:
+        self.parsed_path = parsed_path
+        self.derived_path = derived_path
+        self.meta_path = meta_path
+
+    @staticmethod
+    def group(kind: str) -> str:
+        """ group of a derived panel ('adj_price' or 'returns') for the row index / panel / cache keys """
+        return f'derived/{kind}'
+
+    def file_path(self, kind: str, name: str) -> str:
+        """ the feather file of a derived panel """
+        return os.path.join(self.derived_path, kind, name)
+
+    def stamp_path(self) -> str:
+        return os.path.join(self.meta_path, 'derived', 'stamp.npz')
+
+    def source_stamp(self) -> np.ndarray:
+        """ (size, mtime_ns) of each source eod file """
+        stamp = []
+        for field in SOURCE_FIELDS:
+            stat = os.stat(os.path.join(self.parsed_path, 'stock_eod_data', field))
+            stamp.append((stat.st_size, stat.st_mtime_ns))
+        return np.array(stamp, dtype=np.int64)
+
+    def is_fresh(self) -> bool:
+        """ whether the store is built and matches the current eod files """
+        stamp_path = self.stamp_path()
+        if not os.path.exists(stamp_path):
+            return False
+        with np.load(stamp_path) as stamp_file:
+            return np.array_equal(stamp_file['stamp'], self.source_stamp())
+
+    def write_stamp(self, stamp: np.ndarray) -> None:
+        """ record the source files the store was built from """
+        stamp_path = self.stamp_path()
+        os.makedirs(os.path.dirname(stamp_path), exist_ok=True)
+        with open(stamp_path, 'wb') as f:
+            np.savez(f, stamp=stamp)
+
+    def remove_stamp(self) -> None:
+        """ mark the store as stale (before rewriting it) """
+        if os.path.exists(self.stamp_path()):
+            os.remove(self.stamp_path())
+
+    def panels(self) -> List[Tuple[str, str]]:
+        """ (kind, name) of all derived panels """
+        return [('adj_price', field) for field in ADJ_PRICE_FIELDS] + [('returns', x) for x in RETURN_TYPES]
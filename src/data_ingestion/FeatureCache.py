@@ -0,0 +1,118 @@
+"""
+Process-wide, byte-budgeted LRU cache for PqiDataSdkOffline
+
+Each entry is one full ticker x date panel (an eod field or a saved feature), kept as
+a read-only numpy array together with its labels. Reads slice the cached panel to
+the requested dates and tickers (see PanelStore.slice_panel), so overlapping date
+ranges in rolling loops only touch disk once.
+
+Entries are keyed by (source, name, des):
+    eod fields: ('stock' | 'index' | 'fund', field, None)
+    features:   ('feature', 'eod_{name}' | 'ind_{name}', des)
+
+When the total size exceeds max_bytes, the least recently used entries are evicted.
+A single panel larger than max_bytes is never cached. max_bytes = 0 disables caching.
+
+Caching is off by default: a miss loads the whole file, which only pays off when the
+same panels are read again over overlapping windows. The rolling loops enable it through
+PqiDataSdkOffline(cache_max_bytes=...) (cluster_train, factor combination).
+The cache is thread-safe (get_eod_history decodes fields on a thread pool).
+"""
+
+# load packages
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import Tuple
+
+# default memory ceiling (bytes): off
+CACHE_MAX_BYTES = 0
+
+
+class FeatureCache:
+
+    def __init__(self, max_bytes: int = CACHE_MAX_BYTES) -> None:
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (tickers, ticker_pos, dates, values)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    def get(self, key: Tuple) -> Tuple[np.ndarray, dict, np.ndarray, np.ndarray]:
+        """ get an entry (None if missing) and mark it as most recently used """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def contains(self, key: Tuple) -> bool:
+        """ whether an entry is cached (does not count as a lookup) """
+        return key in self.entries
+
+    def put(self, key: Tuple, tickers: np.ndarray, dates: np.ndarray, values: np.ndarray) -> Tuple[np.ndarray, dict, np.ndarray, np.ndarray]:
+        """
+        insert a panel, evicting least recently used ones to stay below max_bytes
+
+        :return the cached entry (tickers, ticker -> row dict, dates, read-only values)
+        """
+        values.flags.writeable = False
+        entry = (tickers, dict(zip(tickers, range(len(tickers)))), dates, values)
+
+        # too large (or caching disabled): hand back without keeping
+        if values.nbytes > self.max_bytes:
+            return entry
+
+        with self.lock:
+            self.invalidate(key)
+            while self.entries and self.nbytes + values.nbytes > self.max_bytes:
+                _, (_, _, _, evicted_values) = self.entries.popitem(last=False)
+                self.nbytes -= evicted_values.nbytes
+                self.evictions += 1
+            self.entries[key] = entry
+            self.nbytes += values.nbytes
+            return entry
+
+    def invalidate(self, key: Tuple) -> None:
+        """ drop an entry (e.g. when the file is rewritten) """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.nbytes -= entry[3].nbytes
+
+    def resize(self, max_bytes: int) -> None:
+        """ change the memory ceiling, evicting if needed """
+        with self.lock:
+            self.max_bytes = max_bytes
+            while self.entries and self.nbytes > self.max_bytes:
+                _, (_, _, _, evicted_values) = self.entries.popitem(last=False)
+                self.nbytes -= evicted_values.nbytes
+                self.evictions += 1
+
+    def clear(self) -> None:
+        """ drop all entries (counters are kept) """
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self) -> dict:
+        """ hit / miss / eviction counters and current usage, to size max_bytes """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups > 0 else 0.,
+            'entries': len(self.entries),
+            'nbytes': self.nbytes,
+            'max_bytes': self.max_bytes
+        }
+
+
+# one cache per process, shared by all PqiDataSdkOffline instances
+feature_cache = FeatureCache()
@@ -0,0 +1,145 @@
+"""
+Field projection: load only the eod fields a stage declares
+
+Pipeline classes declare the eod fields they read, per source, as a class attribute
+
+    class WeightOptimizer():
+        REQUIRED_FIELDS = {'stock': ['ClosePrice']}
+
+and load them with
+
+    ds.get_eod_history(..., fields=self.REQUIRED_FIELDS['stock'], stage='WeightOptimizer')
+
+which returns a ProjectedFields dict: reading a field that was not declared raises a
+KeyError at once (instead of a whole history being loaded "just in case"), and the fields
+actually read are recorded. ds.get_field_report() / print_field_report() then list, per
+stage and source, the bytes loaded versus the bytes used, to catch fields that are
+declared but never read.
+
+Fields read through the derived helpers (ds.get_adj_price / ds.get_returns, e.g. HighestPrice
+and AdjFactor for an adjusted high) are declared too, with ds.declare_fields(stage, REQUIRED_FIELDS),
+and the helpers are passed stage=: they raise the same KeyError for an undeclared field, and the
+panels they read are counted in the report (as 'derived/...' entries).
+"""
+
+# load packages
+import pandas as pd
+from typing import Dict, List
+
+# (stage, source) -> {'field_bytes': {field: nbytes}, 'used': set of fields read}
+field_registry = {}
+
+
+def stage_record(stage: str, source: str) -> dict:
+    """ the registry entry of a stage and source """
+    return field_registry.setdefault((stage, source), {'field_bytes': {}, 'used': set()})
+
+
+def undeclared_error(stage: str, source: str, field: str, declared) -> KeyError:
+    return KeyError(
+        f'{stage}: {source} eod field {field!r} not declared in REQUIRED_FIELDS '
+        f'(declared: {sorted(declared)})'
+    )
+
+
+class ProjectedFields(dict):
+    """ an eod_data_dict restricted to the declared fields, recording the fields read """
+
+    def __init__(self, stage: str, source: str, eod_data_dict: Dict[str, pd.DataFrame]) -> None:
+        super().__init__(eod_data_dict)
+        self.stage = stage
+        self.source = source
+        self.used = set()
+
+    def __missing__(self, field):
+        raise undeclared_error(self.stage, self.source, field, self.keys())
+
+    def __getitem__(self, field):
+        value = super().__getitem__(field)
+        self.used.add(field)
+        return value
+
+    def get(self, field, default=None):
+        if field in self:
+            return self[field]
+        return default
+
+    def values(self):
+        self.used.update(self.keys())
+        return super().values()
+
+    def items(self):
+        self.used.update(self.keys())
+        return super().items()
+
+    def __reduce__(self):
+        # pickled as a plain dict (e.g. to pool workers), without the tracking
+        return dict, (dict(super().items()),)
+
+
+def project_fields(stage: str, source: str, eod_data_dict: Dict[str, pd.DataFrame]) -> ProjectedFields:
+    """ wrap a freshly loaded eod_data_dict and register it for the report """
+    projected = ProjectedFields(stage, source, eod_data_dict)
+    record = stage_record(stage, source)
+    for field, df in eod_data_dict.items():
+        record['field_bytes'][field] = record['field_bytes'].get(field, 0) + int(df.memory_usage(index=False).sum())
+    # share the set, so that fields read later show up in the report
+    projected.used = record['used']
+    return projected
+
+
+def declare_fields(stage: str, required_fields: Dict[str, List[str]]) -> None:
+    """ register the fields a stage declares, per source, including those it reads through the derived helpers only """
+    for source, fields in required_fields.items():
+        field_bytes = stage_record(stage, source)['field_bytes']
+        for field in fields:
+            field_bytes.setdefault(field, 0)
+
+
+def check_declared(stage: str, source: str, fields: List[str]) -> None:
+    """ raise KeyError if one of the fields was not declared by the stage """
+    declared = stage_record(stage, source)['field_bytes'].keys()
+    for field in fields:
+        if field not in declared:
+            raise undeclared_error(stage, source, field, [x for x in declared if '/' not in x])
+
+
+def record_derived(stage: str, source: str, name: str, fields: List[str], df: pd.DataFrame) -> None:
+    """ count a derived panel (e.g. 'derived/adj_price/HighestPrice') read by a stage, computed from fields """
+    record = stage_record(stage, source)
+    record['field_bytes'][name] = record['field_bytes'].get(name, 0) + int(df.memory_usage(index=False).sum())
+    record['used'].update([name] + list(fields))
+
+
+def field_report() -> pd.DataFrame:
+    """
+    bytes loaded versus bytes used per stage and source
+
+    :return a dataframe indexed by (stage, source), with the declared / unused fields
+        and bytes_loaded, bytes_used, used_pct
+    """
+    rows = []
+    for (stage, source), record in field_registry.items():
+        field_bytes, used = record['field_bytes'], record['used']
+        bytes_loaded = sum(field_bytes.values())
+        bytes_used = sum(nbytes for field, nbytes in field_bytes.items() if field in used)
+        rows.append({
+            'stage': stage,
+            'source': source,
+            'fields': len(field_bytes),
+            'unused_fields': sorted(set(field_bytes) - used),
+            'bytes_loaded': bytes_loaded,
+            'bytes_used': bytes_used,
+            'used_pct': round(100 * bytes_used / bytes_loaded, 2) if bytes_loaded > 0 else 100.
+        })
+    columns = ['stage', 'source', 'fields', 'unused_fields', 'bytes_loaded', 'bytes_used', 'used_pct']
+    return pd.DataFrame(rows, columns=columns).set_index(['stage', 'source'])
+
+
+def print_field_report(stages: List[str] = None) -> None:
+    """ print the field report (of the given stages only, if any) """
+    report = field_report()
+    if stages is not None:
+        report = report[report.index.get_level_values('stage').isin(stages)]
+    with pd.option_context('display.width', 200, 'display.max_colwidth', 80):
+        print(report)
@@ -0,0 +1,139 @@
+"""
+I/O benchmarks for PqiDataSdkOffline
+
+- bench_eod_load: serial vs threaded get_eod_history over the full stock field set
+- bench_codecs: size, write and read throughput of the feather codecs on sample feature files
+
+The LRU cache, the data server and the mmap panels are bypassed, so that every run
+decodes the feather files. The first (warm-up) run fills the OS page cache, the timed
+runs then measure decoding rather than disk.
+"""
+
+# load packages
+import os
+import time
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from pyarrow import feather
+from typing import List, Tuple
+
+from src.data_ingestion import PqiDataSdk_Offline as sdk
+from src.data_ingestion.FeatureCache import feature_cache
+from src.data_ingestion.RowIndex import ROW_CHUNK_SIZE
+
+
+def bench_eod_load(
+        start_date: str = '20150101',
+        end_date: str = '20211231',
+        workers_list: List[int] = [1, 2, 4, 8],
+        repeat: int = 3,
+        source: str = 'stock'
+    ) -> dict:
+    """
+    time get_eod_history(fields=[]) for different numbers of reader threads
+
+    :param start_date, end_date: the dates to read
+    :param workers_list: numbers of threads to compare (1 is the serial reader)
+    :param repeat: timed runs per setting (the best is reported)
+    :param source: the source of eod to read
+    :return workers -> best time in seconds
+    """
+    # bypass the cache and the data server (and the panels, below)
+    use_data_server = sdk.USE_DATA_SERVER
+    cache_max_bytes = feature_cache.max_bytes
+    sdk.USE_DATA_SERVER = False
+    feature_cache.resize(0)
+
+    try:
+        ds = sdk.PqiDataSdkOffline(backend='feather')
+        eod_data_dict = ds.get_eod_history(start_date=start_date, end_date=end_date, source=source)  # warm-up
+        nbytes = sum(df.to_numpy().nbytes for df in eod_data_dict.values())
+        print(f'{len(eod_data_dict)} fields, {start_date} - {end_date}, {nbytes / 1024 ** 2:.1f} MB')
+
+        results = {}
+        for workers in workers_list:
+            ds.read_workers = workers
+            times = []
+            for _ in range(repeat):
+                start = time.time()
+                ds.get_eod_history(start_date=start_date, end_date=end_date, source=source)
+                times.append(time.time() - start)
+            results[workers] = np.min(times)
+            print(f'workers = {workers}: {results[workers]:.3f}s (x{results[workers_list[0]] / results[workers]:.2f})')
+    finally:
+        sdk.USE_DATA_SERVER = use_data_server
+        feature_cache.resize(cache_max_bytes)
+
+    return results
+
+
+def bench_codecs(
+        des_list: List[str] = ['factor', 'support_factor', 'risk_factor', 'ml_factor', 'dynamic_ind'],
+        sample: int = 5,
+        codecs: List[Tuple[str, int]] = [('uncompressed', None), ('lz4', None), ('zstd', 1), ('zstd', 3), ('zstd', 9)],
+        repeat: int = 3
+    ) -> pd.DataFrame:
+    """
+    compare feather codecs on a sample of existing feature files of each destination
+    (written as the sdk writes them, read back in full)
+
+    :param des_list: destinations to sample from (missing ones are skipped)
+    :param sample: files per destination (the first ones by name)
+    :param codecs: (codec, level) pairs to compare
+    :param repeat: timed runs per file and codec (the best is kept)
+    :return a dataframe indexed by (des, codec, level): MB on disk, ratio to the in-memory size,
+        write and read throughput in MB/s of in-memory data
+    """
+    rows = []
+    tmp_dir = tempfile.mkdtemp(prefix='bench_codec_')
+    try:
+        for des in des_list:
+            feature_dir = os.path.join(sdk.FEATURE_PATH, des)
+            if not os.path.isdir(feature_dir):
+                continue
+            file_names = sorted([
+                x for x in os.listdir(feature_dir) if os.path.isfile(os.path.join(feature_dir, x))
+            ])[:sample]
+            dfs = [pd.read_feather(os.path.join(feature_dir, x)) for x in file_names]
+            if len(dfs) == 0:
+                continue
+            nbytes = sum(int(df.memory_usage(index=True, deep=True).sum()) for df in dfs)
+
+            for codec, level in codecs:
+                write_time, read_time, disk_bytes = 0., 0., 0
+                for i, df in enumerate(dfs):
+                    tmp_path = os.path.join(tmp_dir, str(i))
+                    write_times, read_times = [], []
+                    for _ in range(repeat):
+                        start = time.time()
+                        feather.write_feather(
+                            df, tmp_path, compression=codec, compression_level=level, chunksize=ROW_CHUNK_SIZE
+                        )
+                        write_times.append(time.time() - start)
+                        start = time.time()
+                        feather.read_table(tmp_path).to_pandas()
+                        read_times.append(time.time() - start)
+                    write_time += np.min(write_times)
+                    read_time += np.min(read_times)
+                    disk_bytes += os.path.getsize(tmp_path)
+
+                rows.append({
+                    'des': des,
+                    'codec': codec,
+                    'level': 'default' if level is None else level,
+                    'files': len(dfs),
+                    'size_mb': round(disk_bytes / 1024 ** 2, 2),
+                    'ratio': round(disk_bytes / nbytes, 3),
+                    'write_mb_s': round(nbytes / 1024 ** 2 / write_time, 1),
+                    'read_mb_s': round(nbytes / 1024 ** 2 / read_time, 1)
+                })
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    report = pd.DataFrame(rows, columns=['des', 'codec', 'level', 'files', 'size_mb', 'ratio', 'write_mb_s', 'read_mb_s'])
+    report = report.set_index(['des', 'codec', 'level'])
+    with pd.option_context('display.width', 200, 'display.max_rows', None):
+        print(report)
+    return report
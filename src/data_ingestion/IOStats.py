@@ -0,0 +1,220 @@
+"""
+Opt-in I/O instrumentation for PqiDataSdkOffline
+
+Enabled by the environment variable PQI_IO_STATS=1 (or IO_STATS = True in PqiDataSdk_Offline.py,
+or io_stats.enable()), so that it is inherited by multiprocessing workers. Each call of
+an instrumented SDK method records, aggregated per (method, name) in each process:
+
+    calls, bytes (materialized), rows, cols, seconds (wall, inclusive), cache_hits, cache_misses
+
+Nested calls are recorded on their own (get_returns -> get_eod_history -> read_eod_field),
+so seconds of the outer methods include the inner ones.
+
+At exit every process dumps its counters to
+
+    {IO_STATS_PATH}/{run}/{pid}.json
+
+where run is set by the first process enabling it (the parent) and inherited by the workers.
+The parent then merges all files of the run into {IO_STATS_PATH}/{run}/merged.json
+(`python run.py io_report --run {run}` prints it, and merges again if workers were still
+running at the time).
+"""
+
+# load packages
+import os
+import json
+import time
+import inspect
+import threading
+import functools
+import numpy as np
+import pandas as pd
+from multiprocessing import util
+from typing import Callable, Dict
+
+# Specify paths
+IO_STATS_PATH = 'out/io_stats'
+
+# environment variables (inherited by workers)
+ENV_ENABLE = 'PQI_IO_STATS'
+ENV_RUN = 'PQI_IO_STATS_RUN'
+
+COUNTERS = ['calls', 'bytes', 'rows', 'cols', 'seconds', 'cache_hits', 'cache_misses']
+
+
+class IOStats:
+
+    def __init__(self, io_stats_path: str = IO_STATS_PATH) -> None:
+        self.io_stats_path = io_stats_path
+        self.counters = {}  # (method, name) -> {counter: value}
+        self.lock = threading.Lock()
+        self.local = threading.local()  # stack of the open calls of this thread
+        self.pid = None  # the process the exit hook is registered in
+
+    @staticmethod
+    def enabled() -> bool:
+        return os.environ.get(ENV_ENABLE, '') not in ['', '0']
+
+    def enable(self) -> None:
+        """ turn instrumentation on for this process and the workers it starts """
+        os.environ[ENV_ENABLE] = '1'
+        self.run_name()
+
+    @staticmethod
+    def run_name() -> str:
+        """ the run the counters are dumped under (set once, by the first process) """
+        if ENV_RUN not in os.environ:
+            os.environ[ENV_RUN] = f'{time.strftime("%Y%m%d_%H%M%S")}_{os.getpid()}'
+        return os.environ[ENV_RUN]
+
+    def run_dir(self) -> str:
+        return os.path.join(self.io_stats_path, self.run_name())
+
+    # ===================================
+    # ------------ record ---------------
+    # ===================================
+
+    def register_exit(self) -> None:
+        """ dump (and merge, in the parent) at exit, once per process (workers run their own hooks) """
+        if self.pid == os.getpid():
+            return
+        if self.pid is not None:
+            self.counters = {}  # inherited from the parent on fork
+        self.pid = os.getpid()
+        self.run_name()
+        util.Finalize(None, self.dump_and_merge, exitpriority=10)
+
+    def note(self, **counts) -> None:
+        """ add to the counters of the innermost open call (e.g. cache_hits=1) """
+        stack = getattr(self.local, 'stack', None)
+        if stack:
+            for counter, value in counts.items():
+                stack[-1][counter] += value
+
+    def record(self, method: str, name: str, result, seconds: float, frame: dict) -> None:
+        """ add a finished call """
+        nbytes, rows, cols = 0, 0, 0
+        frames = dict.values(result) if isinstance(result, dict) else [result]  # without marking projected fields as used
+        for df in frames:
+            if isinstance(df, pd.DataFrame):
+                nbytes += int(df.memory_usage(index=False).sum())
+                rows += df.shape[0]
+                cols += df.shape[1]
+        with self.lock:
+            self.register_exit()
+            counter = self.counters.setdefault((method, name), dict.fromkeys(COUNTERS, 0))
+            counter['calls'] += 1
+            counter['bytes'] += nbytes
+            counter['rows'] += rows
+            counter['cols'] += cols
+            counter['seconds'] += seconds
+            counter['cache_hits'] += frame['cache_hits']
+            counter['cache_misses'] += frame['cache_misses']
+
+    def instrument(self, *name_args: str) -> Callable:
+        """
+        decorator of an sdk method; a no-op unless enabled
+
+        :param name_args: the arguments naming the feature / field of a call, joined by '/'
+        """
+        def decorator(method):
+            signature = inspect.signature(method)
+
+            def name_of(*args, **kwargs) -> str:
+                bound = signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                return '/'.join(
+                    '+'.join(map(str, bound.arguments[x])) if isinstance(bound.arguments[x], list) else str(bound.arguments[x])
+                    for x in name_args
+                )
+
+            @functools.wraps(method)
+            def wrapper(*args, **kwargs):
+                if not self.enabled():
+                    return method(*args, **kwargs)
+                if getattr(self.local, 'stack', None) is None:
+                    self.local.stack = []
+                frame = {'cache_hits': 0, 'cache_misses': 0}
+                self.local.stack.append(frame)
+                start = time.time()
+                try:
+                    result = method(*args, **kwargs)
+                finally:
+                    self.local.stack.pop()
+                self.record(method.__name__, name_of(*args, **kwargs), result, time.time() - start, frame)
+                return result
+            return wrapper
+        return decorator
+
+    # ===================================
+    # ------------ dump -----------------
+    # ===================================
+
+    def to_records(self) -> list:
+        with self.lock:
+            return [
+                {'method': method, 'name': name, **counter}
+                for (method, name), counter in sorted(self.counters.items())
+            ]
+
+    def dump(self) -> str:
+        """ write the counters of this process, return the file """
+        run_dir = self.run_dir()
+        os.makedirs(run_dir, exist_ok=True)
+        file_path = os.path.join(run_dir, f'{os.getpid()}.json')
+        with open(file_path + '.tmp', 'w') as f:
+            json.dump({'pid': os.getpid(), 'records': self.to_records()}, f)
+        os.replace(file_path + '.tmp', file_path)
+        return file_path
+
+    def dump_and_merge(self) -> None:
+        """ exit hook: dump, and merge the run if this is the process that started it """
+        if len(self.counters) > 0:
+            self.dump()
+        if self.run_name().endswith(f'_{os.getpid()}') and os.path.isdir(self.run_dir()):
+            merge_run(self.run_dir())
+
+
+def merge_run(run_dir: str) -> Dict:
+    """
+    merge the per-process files of a run into {run_dir}/merged.json
+
+    :return {'processes': [pids], 'records': [per (method, name) totals]}
+    """
+    frames, pids = [], []
+    for file_name in sorted(os.listdir(run_dir)):
+        if not file_name.endswith('.json') or file_name == 'merged.json':
+            continue
+        with open(os.path.join(run_dir, file_name), 'r') as f:
+            process_stats = json.load(f)
+        pids.append(process_stats['pid'])
+        frames.append(pd.DataFrame(process_stats['records'], columns=['method', 'name'] + COUNTERS))
+
+    if len(frames) > 0:
+        merged = pd.concat(frames).groupby(['method', 'name'], as_index=False)[COUNTERS].sum()
+    else:
+        merged = pd.DataFrame(columns=['method', 'name'] + COUNTERS)
+    merged_stats = {
+        'processes': pids,
+        'records': json.loads(merged.to_json(orient='records'))
+    }
+    with open(os.path.join(run_dir, 'merged.json'), 'w') as f:
+        json.dump(merged_stats, f, indent=1)
+    return merged_stats
+
+
+def io_report(run_dir: str) -> pd.DataFrame:
+    """
+    per-method totals of a run (merged again from the per-process files)
+
+    :return a dataframe indexed by method, with the counters and MB/s of materialized bytes
+    """
+    records = pd.DataFrame(merge_run(run_dir)['records'], columns=['method', 'name'] + COUNTERS)
+    report = records.groupby('method')[COUNTERS].sum()
+    report['names'] = records.groupby('method')['name'].nunique()
+    report['mb_per_s'] = (report['bytes'] / 1024 ** 2 / report['seconds'].replace(0, np.nan)).round(1)
+    return report.sort_values('seconds', ascending=False)
+
+
+# one per process
+io_stats = IOStats()
@@ -0,0 +1,201 @@
+"""
+Point-in-time index membership, bit-packed
+
+The weight matrices in parsed/index_stock_weight are only ever used for "is a member
+on that day" (weight not nan). This module keeps that boolean matrix per index,
+packed 8 dates per byte (64x smaller than the float 1/nan masks), in
+
+    {META_PATH}/index_membership/{code}.npz   tickers, dates, packed bits, file stamp
+
+built from the weight file on first use and rebuilt whenever the file changes.
+
+Queries:
+- members_on(index_list, date):                  members on a date
+- members_between(index_list, start_date, end_date): members at any point in the range
+- get_mask(index_list, dates):                   combined boolean mask
+- get_nan_mask(index_list, dates):               the same as a 1 / nan float frame (get_index_mask)
+- get_intervals(index):                          (ticker, entry_date, exit_date) spells
+"""
+
+# load packages
+import os
+import numpy as np
+import pandas as pd
+from typing import List, Tuple
+
+# Specify paths
+WEIGHT_PATH = 'data/parsed/index_stock_weight'
+META_PATH = 'data/meta'
+
+# convert name to code
+INDEX_TO_CODE = {
+    'zz500': '000905',
+    'zz1000': '000852',
+    'zzall': '000985',
+    'sz50': '000016',
+    'hs300': '000300'
+}
+
+
+class IndexMembership:
+
+    def __init__(self, weight_path: str = WEIGHT_PATH, meta_path: str = META_PATH) -> None:
+        self.weight_path = weight_path
+        self.meta_path = meta_path
+        self.handles = {}  # code -> (stamp, tickers, ticker_pos, dates, packed)
+
+    # ===================================
+    # ------------ build ----------------
+    # ===================================
+
+    @staticmethod
+    def to_code(index: str) -> str:
+        """ index name (e.g. 'zz500') or code (e.g. '000905') to code """
+        return INDEX_TO_CODE.get(index, index)
+
+    def packed_path(self, code: str) -> str:
+        return os.path.join(self.meta_path, 'index_membership', f'{code}.npz')
+
+    def build(self, code: str, stamp: Tuple[int, int]) -> None:
+        """ pack the membership of an index from its weight file """
+        index_data = pd.read_feather(os.path.join(self.weight_path, code)).set_index('index')
+        index_data = index_data.sort_index(axis=1)
+        mask = index_data.notna().to_numpy()
+
+        packed_path = self.packed_path(code)
+        os.makedirs(os.path.dirname(packed_path), exist_ok=True)
+        with open(packed_path, 'wb') as f:
+            np.savez(
+                f,
+                tickers=index_data.index.astype(str).to_numpy(dtype=str),
+                dates=index_data.columns.astype(str).to_numpy(dtype=str),
+                packed=np.packbits(mask, axis=1),
+                stamp=np.array(stamp, dtype=np.int64)
+            )
+
+    def open_index(self, index: str) -> Tuple[np.ndarray, dict, np.ndarray, np.ndarray]:
+        """
+        open (and memoize) the packed membership of an index, (re)building it if needed
+        :return tickers, ticker -> row dict, dates (sorted), packed bits (n_tickers, ceil(n_dates / 8))
+        """
+        code = self.to_code(index)
+        stat = os.stat(os.path.join(self.weight_path, code))
+        stamp = (stat.st_size, stat.st_mtime_ns)
+        if code in self.handles and self.handles[code][0] == stamp:
+            return self.handles[code][1:]
+
+        packed_path = self.packed_path(code)
+        if os.path.exists(packed_path):
+            with np.load(packed_path) as packed_file:
+                is_stale = tuple(packed_file['stamp'].tolist()) != stamp
+        else:
+            is_stale = True
+        if is_stale:
+            self.build(code, stamp)
+
+        with np.load(packed_path) as packed_file:
+            tickers = packed_file['tickers']
+            dates = packed_file['dates']
+            packed = packed_file['packed']
+        self.handles[code] = (stamp, tickers, dict(zip(tickers, range(len(tickers)))), dates, packed)
+        return self.handles[code][1:]
+
+    # ===================================
+    # ------------ query ----------------
+    # ===================================
+
+    @staticmethod
+    def date_position(dates: np.ndarray, date: str, side: str = 'left') -> int:
+        """ position of a date among the (sorted) membership dates """
+        return np.searchsorted(dates, str(date), side=side)
+
+    def members_on(self, index_list: List[str], date: str) -> List[str]:
+        """
+        member stocks of any index in index_list on a given date
+
+        :param index_list: index names or codes
+        :param date: the date
+        :return sorted tickers
+        """
+        members = set()
+        for index in index_list:
+            tickers, _, dates, packed = self.open_index(index)
+            pos = self.date_position(dates, date)
+            if pos == len(dates) or dates[pos] != str(date):
+                raise KeyError(f'{index}: date {date} not in membership')
+            bits = (packed[:, pos >> 3] >> (7 - (pos & 7))) & 1
+            members.update(tickers[bits.astype(bool)].tolist())
+        return sorted(members)
+
+    def members_between(self, index_list: List[str], start_date: str, end_date: str) -> List[str]:
+        """
+        stocks that were a member of any index in index_list at any point in [start_date, end_date]
+
+        :param index_list: index names or codes
+        :param start_date, end_date: the range (inclusive)
+        :return sorted tickers
+        """
+        members = set()
+        for index in index_list:
+            tickers, _, dates, packed = self.open_index(index)
+            start_idx = self.date_position(dates, start_date)
+            end_idx = self.date_position(dates, end_date, side='right')
+            if start_idx >= end_idx:
+                continue
+            # unpack only the bytes covering the range
+            first_byte, last_byte = start_idx >> 3, (end_idx - 1) >> 3
+            bits = np.unpackbits(packed[:, first_byte:last_byte + 1], axis=1)
+            bits = bits[:, start_idx - 8 * first_byte:end_idx - 8 * first_byte]
+            members.update(tickers[bits.any(axis=1)].tolist())
+        return sorted(members)
+
+    def get_mask(self, index_list: List[str], dates: List[str] = None) -> pd.DataFrame:
+        """
+        combined membership mask of index_list (True if a member of any)
+
+        :param index_list: index names or codes
+        :param dates: the dates of the mask. If None, all dates of the first index
+        :return a boolean dataframe, stock codes as index, dates as columns
+        """
+        agg_mask = None
+        for index in index_list:
+            tickers, _, all_dates, packed = self.open_index(index)
+            if dates is None:
+                dates = all_dates
+            col_idx = np.searchsorted(all_dates, np.asarray(dates, dtype=str))
+            col_idx[col_idx == len(all_dates)] = 0
+            if not np.array_equal(all_dates[col_idx], np.asarray(dates, dtype=str)):
+                missing = np.setdiff1d(np.asarray(dates, dtype=str), all_dates)
+                raise KeyError(f'{index}: dates {missing[:5].tolist()} not in membership')
+            bits = np.unpackbits(packed, axis=1, count=len(all_dates))[:, col_idx].astype(bool)
+            mask = pd.DataFrame(bits, index=pd.Index(tickers, name='index'), columns=list(dates))
+            agg_mask = mask if agg_mask is None else (agg_mask | mask)  # union of tickers, as before
+        return agg_mask.fillna(False).astype(bool)
+
+    def get_nan_mask(self, index_list: List[str], dates: List[str] = None) -> pd.DataFrame:
+        """
+        combined membership mask of index_list, 1 if a member of any and nan otherwise
+        (what get_index_mask has always returned, for multiplying factor dataframes)
+        """
+        mask = self.get_mask(index_list, dates)
+        return pd.DataFrame(
+            np.where(mask.to_numpy(), 1., np.nan), index=mask.index, columns=mask.columns
+        )
+
+    def get_intervals(self, index: str) -> pd.DataFrame:
+        """
+        membership spells of an index
+
+        :param index: index name or code
+        :return a dataframe with columns ticker, entry_date, exit_date (last date as a member)
+        """
+        tickers, _, dates, packed = self.open_index(index)
+        bits = np.unpackbits(packed, axis=1, count=len(dates)).astype(np.int8)
+        edges = np.diff(np.pad(bits, ((0, 0), (1, 1))), axis=1)
+        entry_rows, entry_cols = np.nonzero(edges == 1)
+        _, exit_cols = np.nonzero(edges == -1)  # same row order as the entries
+        return pd.DataFrame({
+            'ticker': tickers[entry_rows],
+            'entry_date': dates[entry_cols],
+            'exit_date': dates[exit_cols - 1]
+        })
@@ -0,0 +1,167 @@
+"""
+Manifests of generated outputs, to skip recomputing the outputs whose inputs did not change
+
+A manifest describes what an output was computed from, e.g. for a factor:
+
+    {'code': hash of the source of the factor function (and of the functions of its module it calls,
+              and of the project modules it uses, e.g. tools/operators.py),
+     'params': its param list, 'inputs': versions (size, mtime) of the eod files read,
+     'deps': digests of the manifests of the generated inputs, 'dates': [start_date, end_date],
+     'definition': digest of the code and params of the factor and of its generated inputs}
+
+and is stored, with the stamps (size, mtime) of the output files, next to (not inside) the data:
+
+    {META_PATH}/manifest/{group}/{name}.json
+
+An output is current if the stored manifest equals the one of the run and its files were not
+rewritten (by other means) since.
+"""
+
+# load packages
+import os
+import sys
+import json
+import inspect
+import hashlib
+from typing import Dict, List
+
+# Specify paths
+META_PATH = 'data/meta'
+
+# the repository: modules under it are hashed with the code referring to them (not installed packages)
+PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def is_project_module(value) -> bool:
+    """ whether a module is a source file of this repository """
+    file_path = getattr(value, '__file__', None) if inspect.ismodule(value) else None
+    if file_path is None:
+        return False
+    file_path = os.path.abspath(file_path)
+    return file_path.startswith(PROJECT_PATH + os.sep) and 'site-packages' not in file_path
+
+
+def referenced_names(obj) -> set:
+    """ the global names referred to by a function, or by the methods of a class """
+    if inspect.isclass(obj):
+        members = [inspect.unwrap(getattr(x, '__func__', x)) for x in vars(obj).values()]
+        codes = [x.__code__ for x in members if hasattr(x, '__code__')]
+    else:
+        codes = [inspect.unwrap(obj).__code__]
+    names = set()
+    while codes:
+        code = codes.pop()
+        names |= set(code.co_names)
+        codes += [x for x in code.co_consts if inspect.iscode(x)]
+    return names
+
+
+def collect_module(module, sources: Dict[str, str]) -> None:
+    """ the source of a project module and, recursively, of the project modules it imports """
+    key = f'module {module.__name__}'
+    if key in sources:
+        return
+    try:
+        sources[key] = inspect.getsource(module)
+    except (OSError, TypeError):
+        sources[key] = module.__file__
+    for value in list(vars(module).values()):
+        if is_project_module(value):
+            collect_module(value, sources)
+
+
+def collect_sources(obj, sources: Dict[str, str]) -> None:
+    """
+    the source of a function / class and, recursively, of the functions and classes of its module it refers to, 
+    of the functions of other project modules it refers to, and of the project modules it uses (as op in op.ts_mean)
+    """
+    obj = inspect.unwrap(obj)
+    key = f'{obj.__module__}.{obj.__qualname__}'
+    if key in sources:
+        return
+    try:
+        sources[key] = inspect.getsource(obj)
+    except (OSError, TypeError):
+        sources[key] = repr(getattr(obj, '__code__', obj))
+
+    module_vars = vars(sys.modules[obj.__module__]) if obj.__module__ in sys.modules else {}
+    for name in sorted(referenced_names(obj)):
+        value = module_vars.get(name)
+        # functions held in a table (e.g. {'mean': op.ts_mean})
+        values = list(value.values()) if isinstance(value, dict) else list(value) if isinstance(value, (list, tuple)) else [value]
+        for value in values:
+            if (inspect.isfunction(value) or inspect.isclass(value)) and value.__module__ == obj.__module__:
+                collect_sources(value, sources)
+            elif inspect.isfunction(value) and is_project_module(sys.modules.get(value.__module__)):
+                # a function of another project module (classes of other modules, e.g. the sdk, are not followed)
+                collect_sources(value, sources)
+            elif is_project_module(value):
+                collect_module(value, sources)
+
+
+def code_hash(obj) -> str:
+    """ hash of the source of a function / class, of the functions and classes of its module it calls and of the project modules it uses """
+    sources = {}
+    collect_sources(obj, sources)
+    return hashlib.sha256('\n'.join(sources[key] for key in sorted(sources)).encode()).hexdigest()
+
+
+def normalize(manifest: Dict) -> Dict:
+    """ the manifest as stored (json types, sorted keys) """
+    return json.loads(json.dumps(manifest, sort_keys=True, default=str))
+
+
+def manifest_digest(manifest: Dict) -> str:
+    """ hash of a manifest, to include it in the manifests of the outputs computed from it """
+    return hashlib.sha256(json.dumps(normalize(manifest), sort_keys=True).encode()).hexdigest()
+
+
+def file_stamps(files: List[str]) -> List[list]:
+    """ [path, size, mtime_ns] of the files (None for a missing one) """
+    stamps = []
+    for file_path in files:
+        if not os.path.exists(file_path):
+            stamps.append([file_path, None, None])
+            continue
+        stat = os.stat(file_path)
+        stamps.append([file_path, stat.st_size, stat.st_mtime_ns])
+    return stamps
+
+
+class ManifestStore:
+
+    def __init__(self, meta_path: str = META_PATH) -> None:
+        self.meta_path = meta_path
+
+    def manifest_path(self, group: str, name: str) -> str:
+        return os.path.join(self.meta_path, 'manifest', group, f'{name}.json')
+
+    def read(self, group: str, name: str) -> Dict:
+        """ {'manifest', 'files'} as stored, None if not stored """
+        manifest_path = self.manifest_path(group, name)
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+
+    def is_current(self, group: str, name: str, manifest: Dict, files: List[str]) -> bool:
+        """ whether the output was computed from manifest and its files are unchanged since """
+        stored = self.read(group, name)
+        return (
+            stored is not None
+            and stored['manifest'] == normalize(manifest)
+            and stored['files'] == file_stamps(files)
+            and all(size is not None for _, size, _ in stored['files'])
+        )
+
+    def write(self, group: str, name: str, manifest: Dict, files: List[str]) -> None:
+        """ record the manifest of an output, with the stamps of its files as written """
+        manifest_path = self.manifest_path(group, name)
+        os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump({'manifest': normalize(manifest), 'files': file_stamps(files)}, f, indent=1)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    def remove(self, group: str, name: str) -> None:
+        if os.path.exists(self.manifest_path(group, name)):
+            os.remove(self.manifest_path(group, name))
@@ -0,0 +1,168 @@
+"""
+Per-date / per-ticker statistics of ticker x date panels
+
+A small sidecar is written next to (not inside) each feather file saved through
+PqiDataSdkOffline (features, their date partitions, derived panels):
+
+    {META_PATH}/stats/{group}/{name}.npz   tickers, dates, per-date and per-ticker
+                                            non-nan count / min / max / sum, file stamp
+
+so pipelines can tell which dates, tickers and features hold any data before loading them:
+
+    date_stats, ticker_stats = ds.get_eod_feature_stats('mom_252', des='risk_factor')
+    dates = ds.get_valid_dates('mom_252', des='risk_factor', dates=train_dates)
+
+Like the row index, the sidecar records the size and mtime of the file it describes.
+Files rewritten by other means (or written before the sidecar existed) are scanned once
+on first use and the sidecar is written then.
+"""
+
+# load packages
+import os
+import numpy as np
+import pandas as pd
+from typing import List, Tuple
+
+# Specify paths
+META_PATH = 'data/meta'
+
+# statistics kept per date and per ticker
+STAT_NAMES = ['count', 'min', 'max', 'sum']
+
+
+def compute_stats(df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    non-nan count, min, max and sum of a ticker x date panel along both axes
+    (min / max / sum are nan where the count is 0)
+
+    :return date_stats (date x STAT_NAMES), ticker_stats (ticker x STAT_NAMES)
+    """
+    values = df.to_numpy(dtype=np.float64)
+    mask = ~np.isnan(values)
+    stats = []
+    for axis, labels in [(0, df.columns), (1, df.index)]:
+        count = mask.sum(axis=axis)
+        has_value = count > 0
+        stat_df = pd.DataFrame({
+            'count': count,
+            'min': np.where(has_value, np.where(mask, values, np.inf).min(axis=axis, initial=np.inf), np.nan),
+            'max': np.where(has_value, np.where(mask, values, -np.inf).max(axis=axis, initial=-np.inf), np.nan),
+            'sum': np.where(has_value, np.where(mask, values, 0.).sum(axis=axis), np.nan)
+        }, index=pd.Index(np.asarray(labels).astype(str), name='index'))
+        stats.append(stat_df)
+    return stats[0], stats[1]
+
+
+def combine_stats(stats_list: List[Tuple[pd.DataFrame, pd.DataFrame]]) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    statistics of panels stitched along the dates (a base file and its partitions).
+    Later panels win on overlapping dates
+    """
+    date_stats = pd.concat([x[0] for x in stats_list])
+    date_stats = date_stats[~date_stats.index.duplicated(keep='last')].sort_index()
+    if len(stats_list) == 1:
+        return date_stats, stats_list[0][1]
+
+    ticker_stats = pd.concat([x[1] for x in stats_list])
+    grouped = ticker_stats.groupby(level=0, sort=False)
+    ticker_stats = pd.DataFrame({
+        'count': grouped['count'].sum(),
+        'min': grouped['min'].min(),
+        'max': grouped['max'].max(),
+        'sum': grouped['sum'].sum(min_count=1)
+    })
+    ticker_stats.index.name = 'index'
+    return date_stats, ticker_stats
+
+
+class PanelStats:
+
+    def __init__(self, meta_path: str = META_PATH) -> None:
+        self.meta_path = meta_path
+        self.handles = {}  # (group, name) -> (stamp, date_stats, ticker_stats)
+
+    def stats_path(self, group: str, name: str) -> str:
+        """ the sidecar of a feather file """
+        return os.path.join(self.meta_path, 'stats', group, f'{name}.npz')
+
+    @staticmethod
+    def file_stamp(file_path: str) -> Tuple[int, int]:
+        """ (size, mtime_ns) of a file, to detect rewrites """
+        stat = os.stat(file_path)
+        return stat.st_size, stat.st_mtime_ns
+
+    # ===================================
+    # ------------ write ----------------
+    # ===================================
+
+    def write(self, df: pd.DataFrame, file_path: str, group: str, name: str) -> None:
+        """
+        write the sidecar of a feather file just written from df
+
+        :param df: the ticker x date dataframe held by file_path
+        :param file_path: the feather file
+        :param group, name: the source or destination folder, and the name of the file
+        """
+        date_stats, ticker_stats = compute_stats(df)
+        stats_path = self.stats_path(group, name)
+        os.makedirs(os.path.dirname(stats_path), exist_ok=True)
+        stamp = self.file_stamp(file_path)
+        with open(stats_path, 'wb') as f:
+            np.savez(
+                f,
+                dates=date_stats.index.to_numpy(dtype=str),
+                date_stats=date_stats[STAT_NAMES].to_numpy(dtype=np.float64),
+                tickers=ticker_stats.index.to_numpy(dtype=str),
+                ticker_stats=ticker_stats[STAT_NAMES].to_numpy(dtype=np.float64),
+                stamp=np.array(stamp, dtype=np.int64)
+            )
+        self.handles[(group, name)] = (stamp, date_stats, ticker_stats)
+
+    def remove(self, group: str, name: str) -> None:
+        """ drop a sidecar """
+        self.handles.pop((group, name), None)
+        stats_path = self.stats_path(group, name)
+        if os.path.exists(stats_path):
+            os.remove(stats_path)
+
+    # ===================================
+    # ------------ read -----------------
+    # ===================================
+
+    def open_stats(self, file_path: str, group: str, name: str) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """
+        open (and memoize) the sidecar of a file
+        :return date_stats, ticker_stats. None if missing or stale
+        """
+        key = (group, name)
+        stats_path = self.stats_path(group, name)
+        if not os.path.exists(stats_path) or not os.path.exists(file_path):
+            self.handles.pop(key, None)
+            return None
+
+        stamp = self.file_stamp(file_path)
+        if key not in self.handles or self.handles[key][0] != stamp:
+            with np.load(stats_path) as stats_file:
+                if tuple(stats_file['stamp'].tolist()) != stamp:
+                    self.handles.pop(key, None)
+                    return None
+                date_stats = pd.DataFrame(
+                    stats_file['date_stats'], index=pd.Index(stats_file['dates'], name='index'), columns=STAT_NAMES
+                )
+                ticker_stats = pd.DataFrame(
+                    stats_file['ticker_stats'], index=pd.Index(stats_file['tickers'], name='index'), columns=STAT_NAMES
+                )
+            self.handles[key] = (stamp, date_stats, ticker_stats)
+        return self.handles[key][1:]
+
+    def get_stats(self, file_path: str, group: str, name: str) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """
+        the statistics of a file, scanning it once (and writing the sidecar) if missing or stale
+        :return date_stats, ticker_stats
+        """
+        stats = self.open_stats(file_path, group, name)
+        if stats is None:
+            df = pd.read_feather(file_path).set_index('index')
+            self.write(df, file_path, group, name)
+            stats = self.handles[(group, name)][1:]
+        return stats
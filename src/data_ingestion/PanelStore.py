@@ -0,0 +1,231 @@
+"""
+Memory-mapped columnar panel store, a second storage backend for PqiDataSdkOffline
+
+Each panel is a ticker x date array saved as a raw .npy file, with the tickers and
+dates kept in two sidecar .npy files next to it:
+
+    {PANEL_PATH}/{group}/{name}/values.npy   (n_tickers, n_dates), C-order
+    {PANEL_PATH}/{group}/{name}/tickers.npy  str, row labels
+    {PANEL_PATH}/{group}/{name}/dates.npy    str, column labels (sorted)
+
+values.npy is opened with np.load(mmap_mode='r'), so a date range is a strided view
+and a ticker subset only touches the requested rows. Nothing is decoded.
+
+group is 'stock_eod_data' / 'index_eod_data' / 'fund_eod_data' for raw eod fields
+and the feature destination (e.g. 'factor', 'risk_factor/class_factors', 'dynamic_ind')
+for features. Feature names keep the 'eod_' / 'ind_' prefix of the feather files.
+"""
+
+# load packages
+import os
+import shutil
+import numpy as np
+import pandas as pd
+from typing import List, Tuple
+
+# Specify paths
+PANEL_PATH = 'data/panel'
+
+
+class PanelStore:
+
+    def __init__(self, panel_path: str = PANEL_PATH) -> None:
+        self.panel_path = panel_path
+        self.panel_handles = {}  # (group, name) -> (tickers, ticker_pos, dates, values)
+
+    # ===================================
+    # ---------- path utils -------------
+    # ===================================
+
+    def panel_dir(self, group: str, name: str) -> str:
+        """ the folder holding a panel """
+        return os.path.join(self.panel_path, group, name)
+
+    def has_panel(self, group: str, name: str) -> bool:
+        """ whether a panel has been written """
+        return os.path.exists(os.path.join(self.panel_dir(group, name), 'values.npy'))
+
+    # ===================================
+    # ------------ write ----------------
+    # ===================================
+
+    def write_panel(self, group: str, name: str, df: pd.DataFrame, dtype=None) -> None:
+        """
+        write a ticker x date dataframe as a memory-mappable panel
+
+        :param group: source or destination folder of the panel
+        :param name: the name of the panel (same as the feather file name)
+        :param df: ticker as index, dates as columns
+        :param dtype: storage dtype. If None, keep that of the dataframe
+        """
+        panel_dir = self.panel_dir(group, name)
+        tmp_dir = panel_dir + '.tmp'
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        # sort dates so that date ranges are contiguous slices
+        df = df.sort_index(axis=1)
+        values = df.to_numpy(dtype=dtype)
+        np.save(os.path.join(tmp_dir, 'tickers.npy'), df.index.astype(str).to_numpy(dtype=str))
+        np.save(os.path.join(tmp_dir, 'dates.npy'), df.columns.astype(str).to_numpy(dtype=str))
+        np.save(os.path.join(tmp_dir, 'values.npy'), np.ascontiguousarray(values))
+
+        # swap in (readers holding an old memmap keep their own file handle)
+        self.panel_handles.pop((group, name), None)
+        if os.path.exists(panel_dir):
+            shutil.rmtree(panel_dir)
+        os.rename(tmp_dir, panel_dir)
+
+    def remove_panel(self, group: str, name: str) -> None:
+        """ drop a panel (e.g. when the feather source is rewritten) """
+        self.panel_handles.pop((group, name), None)
+        panel_dir = self.panel_dir(group, name)
+        if os.path.exists(panel_dir):
+            shutil.rmtree(panel_dir)
+
+    # ===================================
+    # ------------ read -----------------
+    # ===================================
+
+    def open_panel(self, group: str, name: str) -> Tuple[np.ndarray, dict, np.ndarray, np.ndarray]:
+        """
+        open (and memoize) the memmap of a panel
+        :return tickers, ticker -> row dict, dates, memmapped values
+        """
+        key = (group, name)
+        if key not in self.panel_handles:
+            panel_dir = self.panel_dir(group, name)
+            tickers = np.load(os.path.join(panel_dir, 'tickers.npy'))
+            dates = np.load(os.path.join(panel_dir, 'dates.npy'))
+            values = np.load(os.path.join(panel_dir, 'values.npy'), mmap_mode='r')
+            ticker_pos = dict(zip(tickers, range(len(tickers))))
+            self.panel_handles[key] = (tickers, ticker_pos, dates, values)
+        return self.panel_handles[key]
+
+    def read_panel(
+            self,
+            group: str,
+            name: str,
+            dates: List[str] = None,
+            tickers: List[str] = None
+        ) -> pd.DataFrame:
+        """
+        read a panel slice.
+
+        - dates forming a contiguous range of the stored dates give a view (no copy);
+        - tickers select rows only, so the cost scales with the subset.
+
+        :param dates: the dates to read. If None/empty, read all
+        :param tickers: the tickers to read. If None/empty, read all
+        :return a ticker x date dataframe
+        """
+        all_tickers, ticker_pos, all_dates, values = self.open_panel(group, name)
+        return slice_panel(all_tickers, ticker_pos, all_dates, values, dates=dates, tickers=tickers, name=name)
+
+    def list_panels(self, group: str) -> List[str]:
+        """ list all panels under a group """
+        group_dir = os.path.join(self.panel_path, group)
+        if not os.path.exists(group_dir):
+            return []
+        return sorted([x for x in os.listdir(group_dir) if self.has_panel(group, x)])
+
+
+# ===================================
+# ------------ slicing --------------
+# ===================================
+
+def slice_panel(
+        all_tickers: np.ndarray,
+        ticker_pos: dict,
+        all_dates: np.ndarray,
+        values: np.ndarray,
+        dates: List[str] = None,
+        tickers: List[str] = None,
+        name: str = ''
+    ) -> pd.DataFrame:
+    """
+    slice a ticker x date array by labels.
+
+    - dates forming a contiguous range of the stored (sorted) dates give a view (no copy);
+    - tickers select rows only, so the cost scales with the subset.
+
+    :param all_tickers, ticker_pos, all_dates, values: the panel, its labels and ticker -> row dict
+    :param dates: the dates to read. If None/empty, read all
+    :param tickers: the tickers to read. If None/empty, read all
+    :param name: the panel name, for error messages
+    :return a ticker x date dataframe
+    """
+    # columns
+    if dates is None or len(dates) == 0:
+        col_selector = slice(None)
+        selected_dates = all_dates
+    else:
+        dates = np.asarray(dates, dtype=str)
+        start_idx = np.searchsorted(all_dates, dates[0])
+        end_idx = start_idx + len(dates)
+        if end_idx <= len(all_dates) and np.array_equal(all_dates[start_idx:end_idx], dates):
+            col_selector = slice(start_idx, end_idx)
+        else:
+            col_idx = np.searchsorted(all_dates, dates)
+            col_idx[col_idx == len(all_dates)] = 0
+            if not np.array_equal(all_dates[col_idx], dates):
+                missing = np.setdiff1d(dates, all_dates)
+                raise KeyError(f'{name}: dates {missing[:5].tolist()} not in panel')
+            col_selector = col_idx
+        selected_dates = dates
+
+    # rows (the full, ordered universe stays a view)
+    if tickers is None or len(tickers) == 0 or (
+            len(tickers) == len(all_tickers) and np.array_equal(np.asarray(tickers, dtype=str), all_tickers)):
+        selected_values = values[:, col_selector]
+        selected_tickers = all_tickers
+    else:
+        row_idx = np.array([ticker_pos[ticker] for ticker in tickers], dtype=int)
+        if isinstance(col_selector, slice):
+            selected_values = values[row_idx, col_selector]
+        else:
+            selected_values = values[np.ix_(row_idx, col_selector)]
+        selected_tickers = np.asarray(tickers)
+
+    panel_df = pd.DataFrame(selected_values, index=selected_tickers, columns=selected_dates, copy=False)
+    panel_df.index.name = 'index'
+    return panel_df
+
+
+# ===================================
+# ------- one-shot converter --------
+# ===================================
+
+def convert_feather_to_panel(
+        parsed_path: str = 'data/parsed',
+        feature_path: str = 'data/features',
+        panel_path: str = PANEL_PATH,
+        eod_sources: List[str] = ['stock', 'index', 'fund'],
+        feature_des: List[str] = ['factor', 'support_factor', 'risk_factor', 'risk_factor/class_factors', 'ml_factor', 'dynamic_ind'],
+        derived_path: str = 'data/derived',
+        derived_kinds: List[str] = ['adj_price', 'returns']
+    ) -> None:
+    """
+    convert the existing feather layout into memory-mapped panels:
+    - {parsed_path}/{source}_eod_data/{field} -> {panel_path}/{source}_eod_data/{field}
+    - {feature_path}/{des}/{eod|ind}_{name}   -> {panel_path}/{des}/{eod|ind}_{name}
+    - {derived_path}/{kind}/{name}            -> {panel_path}/derived/{kind}/{name}
+
+    :param eod_sources: eod sources to convert
+    :param feature_des: feature destinations to convert (missing folders are skipped)
+    :param derived_kinds: derived panels to convert (see DerivedStore.py)
+    """
+    store = PanelStore(panel_path)
+    folders = [(os.path.join(parsed_path, f'{source}_eod_data'), f'{source}_eod_data') for source in eod_sources]
+    folders += [(os.path.join(feature_path, des), des) for des in feature_des]
+    folders += [(os.path.join(derived_path, kind), f'derived/{kind}') for kind in derived_kinds]
+
+    for folder, group in folders:
+        if not os.path.isdir(folder):
+            continue
+        file_names = [x for x in sorted(os.listdir(folder)) if os.path.isfile(os.path.join(folder, x))]
+        for file_name in file_names:
+            df = pd.read_feather(os.path.join(folder, file_name)).set_index('index')
+            store.write_panel(group, file_name, df)
+        print(f'converted {len(file_names)} files in {folder}')
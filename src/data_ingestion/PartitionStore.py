@@ -0,0 +1,132 @@
+"""
+Date partitions for incremental feature writes
+
+save_eod_feature(..., mode='append') / save_ind_feature(..., mode='append') write only the
+dates not stored yet, as a small feather file next to (not inside) the feature folder:
+
+    {PARTITION_PATH}/{des}/{eod|ind}_{name}/{first_date}_{last_date}
+
+so a daily update costs one day of data instead of rewriting the whole history.
+read_eod_feature / read_ind_feature stitch the base file and the partitions together;
+`python run.py compact_partitions` folds the partitions back into the base files.
+"""
+
+# load packages
+import os
+import pandas as pd
+import pyarrow as pa
+from pyarrow import feather
+from typing import List, Dict, Tuple
+
+# Specify paths
+PARTITION_PATH = 'data/partitions'
+
+
+class PartitionStore:
+
+    def __init__(self, partition_path: str = PARTITION_PATH) -> None:
+        self.partition_path = partition_path
+        self.date_handles = {}  # partition file -> (mtime_ns, dates)
+
+    # ===================================
+    # ---------- path utils -------------
+    # ===================================
+
+    def partition_dir(self, group: str, name: str) -> str:
+        """ the folder holding the partitions of a feature """
+        return os.path.join(self.partition_path, group, name)
+
+    def list_partitions(self, group: str, name: str) -> List[str]:
+        """ partition files of a feature, oldest first """
+        partition_dir = self.partition_dir(group, name)
+        if not os.path.isdir(partition_dir):
+            return []
+        return [
+            os.path.join(partition_dir, x) for x in sorted(os.listdir(partition_dir))
+            if not x.endswith('.tmp')
+        ]
+
+    def list_features(self) -> List[Tuple[str, str]]:
+        """ (group, name) of all features having partitions """
+        features = []
+        for root, _, files in os.walk(self.partition_path):
+            if len([x for x in files if not x.endswith('.tmp')]) > 0:
+                group, name = os.path.split(os.path.relpath(root, self.partition_path))
+                features.append((group, name))
+        return sorted(features)
+
+    def file_dates(self, file_path: str) -> List[str]:
+        """ the dates (columns) of a feather file, read from its schema only """
+        mtime_ns = os.stat(file_path).st_mtime_ns
+        if file_path not in self.date_handles or self.date_handles[file_path][0] != mtime_ns:
+            with pa.memory_map(file_path, 'r') as source:
+                names = pa.ipc.open_file(source).schema.names
+            self.date_handles[file_path] = (mtime_ns, [x for x in names if x != 'index'])
+        return self.date_handles[file_path][1]
+
+    def partition_dates(self, group: str, name: str) -> Dict[str, str]:
+        """ date -> partition file holding it (later partitions win) """
+        date_to_file = {}
+        for file_path in self.list_partitions(group, name):
+            for date in self.file_dates(file_path):
+                date_to_file[date] = file_path
+        return date_to_file
+
+    # ===================================
+    # ---------- write / read -----------
+    # ===================================
+
+    def append(
+            self,
+            group: str,
+            name: str,
+            df: pd.DataFrame,
+            compression: str = 'uncompressed',
+            compression_level: int = None
+        ) -> str:
+        """
+        write a ticker x new dates dataframe as a partition
+
+        :param compression, compression_level: the codec ('uncompressed', 'lz4' or 'zstd') and its level
+        :return the partition file
+        """
+        df = df.sort_index(axis=1)
+        partition_dir = self.partition_dir(group, name)
+        os.makedirs(partition_dir, exist_ok=True)
+        file_path = os.path.join(partition_dir, f'{df.columns[0]}_{df.columns[-1]}')
+        feather.write_feather(
+            df.reset_index(), file_path + '.tmp', compression=compression, compression_level=compression_level
+        )
+        os.replace(file_path + '.tmp', file_path)
+        return file_path
+
+    def read(self, group: str, name: str, dates: List[str], tickers: List[str] = []) -> pd.DataFrame:
+        """
+        read dates held by partitions
+
+        :param dates: the dates to read, all held by partitions
+        :param tickers: the tickers to return. If empty, all tickers of the partitions
+        :return a ticker x date dataframe
+        """
+        date_to_file = self.partition_dates(group, name)
+        file_to_dates = {}
+        for date in dates:
+            file_to_dates.setdefault(date_to_file[date], []).append(date)
+
+        partition_dfs = [
+            pd.read_feather(file_path, columns=['index'] + file_dates).set_index('index')
+            for file_path, file_dates in file_to_dates.items()
+        ]
+        df = pd.concat(partition_dfs, axis=1)[list(dates)]
+        if len(tickers) > 0:
+            df = df.reindex(tickers)
+        return df
+
+    def clear(self, group: str, name: str) -> None:
+        """ drop all partitions of a feature """
+        for file_path in self.list_partitions(group, name):
+            self.date_handles.pop(file_path, None)
+            os.remove(file_path)
+        partition_dir = self.partition_dir(group, name)
+        if os.path.isdir(partition_dir) and len(os.listdir(partition_dir)) == 0:
+            os.rmdir(partition_dir)
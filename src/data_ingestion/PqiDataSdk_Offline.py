@@ -12,19 +12,116 @@ import os
 import pickle
 import numpy as np
 import pandas as pd 
+from pyarrow import feather
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict
 
+from src.data_ingestion.PanelStore import PanelStore, PANEL_PATH, slice_panel
+from src.data_ingestion.FeatureCache import feature_cache
+from src.data_ingestion.DataServer import connect_server
+from src.data_ingestion.ArrowService import ArrowServiceClient, SERVICE_TABLES
+from src.data_ingestion.RowIndex import RowIndex, META_PATH
+from src.data_ingestion.IndexMembership import IndexMembership
+from src.data_ingestion.PartitionStore import PartitionStore, PARTITION_PATH
+from src.data_ingestion.TradeCalendar import TradeCalendar
+from src.data_ingestion.TickerIndex import TickerIndex
+from src.data_ingestion.PanelStats import PanelStats, combine_stats
+from src.data_ingestion.FieldProjection import project_fields, field_report, declare_fields, check_declared, record_derived
+from src.data_ingestion.IOStats import io_stats
+from src.data_ingestion.AsyncWriter import AsyncWriter
+from src.data_ingestion.Manifest import ManifestStore
+from src.data_ingestion.DerivedStore import (
+    DerivedStore, DERIVED_PATH, SOURCE_FIELDS, RETURN_TYPES, 
+    adjust_prices, compute_return, required_fields
+)
+
 # Specify paths 
 RAW_PATH = 'data/raw'
 PARSED_PATH = 'data/parsed'
 FEATURE_PATH = 'data/features'
 
+# storage backend: 'feather' (default) or 'mmap' (memory-mapped panels, see PanelStore.py)
+# for 'mmap', run `python run.py convert_panel` once; files without a panel fall back to feather
+STORAGE_BACKEND = 'feather'
+
+# attach to the shared-memory data server (`python run.py data_server`, see DataServer.py) when it is running
+USE_DATA_SERVER = True
+
+# 'host:port' of an arrow data service (`python run.py data_service`, see ArrowService.py) to read 
+# everything from, instead of the local data. None to read locally
+DATA_SERVICE = None
+
+# record per-call I/O statistics (method, name, bytes, shape, time, cache hits), dumped to out/io_stats 
+# at exit, per process (see IOStats.py). Also enabled by the environment variable PQI_IO_STATS=1
+IO_STATS = False
+
+# number of threads decoding fields concurrently in get_eod_history (1 to read serially)
+READ_WORKERS = 8
+
+# background threads writing the features of save_eod_feature_async (0 to write synchronously), and the 
+# panels pending at most before a submit blocks (see AsyncWriter.py)
+WRITE_WORKERS = 2
+MAX_PENDING_WRITES = 4
+
+# float precision per source / destination, applied when saving features and when reading.
+# 'float32' halves RAM and I/O; check the error it introduces with get_precision_report first
+PRECISION_POLICY = {
+    'stock_eod_data': 'float64',
+    'index_eod_data': 'float64',
+    'fund_eod_data': 'float64',
+    'factor': 'float64',
+    'support_factor': 'float64',
+    'risk_factor': 'float64',
+    'risk_factor/class_factors': 'float64',
+    'ml_factor': 'float64',
+    'derived/returns': 'float64'
+}
+# feather codec and level per destination, applied when saving features: 'uncompressed', 'lz4' or 'zstd'
+# (level None: the codec default). Compare them on existing files with `python run.py bench_codec`
+COMPRESSION_POLICY = {
+    'factor': ('uncompressed', None),
+    'support_factor': ('uncompressed', None),
+    'risk_factor': ('uncompressed', None),
+    'risk_factor/class_factors': ('uncompressed', None),
+    'ml_factor': ('uncompressed', None),
+    'dynamic_ind': ('uncompressed', None)
+}
+
+# always kept at float64 (prices and adjustment factors are multiplied and chained)
+FULL_PRECISION_FIELDS = ['ClosePrice', 'OpenPrice', 'HighestPrice', 'LowestPrice', 'PreClosePrice', 'VWAP', 'AdjFactor']
+
 class PqiDataSdkOffline:
 
-    def __init__(self) -> None:
+    def __init__(self, backend: str = None, cache_max_bytes: int = None, data_service: str = None) -> None:
         """
         get a copy of available trade dates and tickers 
+
+        :param backend: 'feather' or 'mmap'. If None, use STORAGE_BACKEND
+        :param cache_max_bytes: memory ceiling of the process-wide feather cache (0 to disable,
+            the default). Worth enabling for rolling loops rereading overlapping date windows. 
+            If None, keep the current one (see FeatureCache.py)
+        :param data_service: 'host:port' of an arrow data service to read from. If None, use 
+            DATA_SERVICE; '' to read locally
         """
+        self.backend = STORAGE_BACKEND if backend is None else backend
+        self.panel_store = PanelStore(PANEL_PATH)
+        self.row_index = RowIndex(META_PATH)
+        self.partition_store = PartitionStore(PARTITION_PATH)
+        self.index_membership = IndexMembership(os.path.join(PARSED_PATH, 'index_stock_weight'), META_PATH)
+        self.derived_store = DerivedStore(PARSED_PATH, DERIVED_PATH, META_PATH)
+        self.panel_stats = PanelStats(META_PATH)
+        self.manifest_store = ManifestStore(META_PATH)
+        self.read_workers = READ_WORKERS
+        self.writer = AsyncWriter(WRITE_WORKERS, MAX_PENDING_WRITES)
+        self.server = connect_server() if USE_DATA_SERVER else None
+        data_service = DATA_SERVICE if data_service is None else data_service
+        self.service = ArrowServiceClient(data_service) if data_service else None
+        if cache_max_bytes is not None:
+            feature_cache.resize(cache_max_bytes)
+        if IO_STATS:
+            io_stats.enable()
+        if io_stats.enabled():
+            io_stats.register_exit()
         self.get_all_trade_dates()
         self.get_all_tickers()
 
@@ -32,6 +129,18 @@ class PqiDataSdkOffline:
         """ 
         get trade dates in this offline dateset 
         """
+        # remote 
+        if self.service is not None:
+            self.trade_dates = self.service.get_trade_dates()
+            self.calendar = TradeCalendar(self.trade_dates)
+            return
+
+        # attached to the data server 
+        if self.server is not None:
+            self.trade_dates = self.server.get_trade_dates()
+            self.calendar = TradeCalendar(self.trade_dates)
+            return
+
         # extract trade dates from file 
         trade_dates_path = os.path.join(PARSED_PATH, 'dates', 'dates.npy')
         with open(trade_dates_path, 'rb') as f:
@@ -39,46 +148,48 @@ class PqiDataSdkOffline:
         
         # append to self 
         self.trade_dates = trade_dates
+        self.calendar = TradeCalendar(trade_dates)
     
     def get_all_tickers(self):
         """
         get available tickers to trade (the cross-sectional snapshot at 20211231)
         """
         # extract tickers 
+        if self.service is not None:
+            tickers = self.service.get_tickers()
+            self.tickers = tickers
+            self.ticker_index = TickerIndex(tickers)
+            return
         tickers_path = os.path.join(PARSED_PATH, 'tickers', 'tickers.npy')
         with open(tickers_path, 'rb') as f:
             tickers = np.load(f, allow_pickle=True)
         
         # append to self
         self.tickers = tickers
+        self.ticker_index = TickerIndex(tickers)
 
     # ===================================
     # ---------- auxiliary --------------
     # ===================================
     def select_trade_dates(self, start_date: str, end_date: str) -> np.array:
         """ select a portion of trade dates """
-        start_idx = np.where(self.trade_dates >= start_date)[0][0]
-        end_idx = np.where(self.trade_dates <= end_date)[0][-1] + 1
+        start_idx, end_idx = self.calendar.span(start_date, end_date)
         selected_trade_dates = self.trade_dates[start_idx:end_idx]
         return selected_trade_dates
 
     def get_next_trade_date(self, date: str) -> str:
         """ get next trade date (if empty output '') """
-        cur_idx = np.where(self.trade_dates <= date)[0][-1]
-        if cur_idx < len(self.trade_dates) - 1:
-            next_day = self.trade_dates[cur_idx + 1]
-        else:
-            next_day = ''
-        return next_day
+        return self.calendar.next_date(date)
 
     def get_prev_trade_date(self, date: str) -> str:
         """ get previous trade dates """
-        cur_idx = np.where(self.trade_dates >= date)[0][0] 
-        if cur_idx > 0: 
-            prev_day = self.trade_dates[cur_idx - 1]
-        else:
-            prev_day = ''
-        return prev_day
+        return self.calendar.prev_date(date)
+
+    def shift_trade_dates(self, dates: List[str], n: int) -> np.ndarray:
+        """ 
+        shift dates by n trade days (vectorized, see TradeCalendar.shift) 
+        """
+        return self.calendar.shift(dates, n)
 
     def get_ticker_list(self):
         """ 
@@ -86,17 +197,55 @@ class PqiDataSdkOffline:
         """
         return self.tickers
 
+    # ===================================
+    # ------- integer coordinates -------
+    # ===================================
+    def get_ticker_ids(self, tickers: List[str]) -> np.ndarray:
+        """ 
+        ticker -> ticker_id (position in self.tickers), vectorized 
+        """
+        ticker_ids = self.ticker_index.ids(tickers)
+        if (ticker_ids < 0).any():
+            missing = np.asarray(tickers)[ticker_ids < 0]
+            raise KeyError(f'tickers {missing[:5].tolist()} not in the universe')
+        return ticker_ids
+
+    def get_ticker_labels(self, ticker_ids: np.ndarray) -> np.ndarray:
+        """ ticker_id -> ticker """
+        return self.ticker_index.labels(ticker_ids)
+
+    def get_date_ids(self, dates: List[str]) -> np.ndarray:
+        """ 
+        date -> date_id (position in the trade dates), vectorized 
+        """
+        date_ids = self.calendar.ordinals(dates)
+        if (date_ids < 0).any():
+            missing = np.asarray(dates)[date_ids < 0]
+            raise KeyError(f'dates {missing[:5].tolist()} not trade dates')
+        return date_ids
+
+    def get_date_labels(self, date_ids: np.ndarray) -> np.ndarray:
+        """ date_id -> date """
+        return self.calendar.date_at(date_ids)
+
     # ===================================
     # ---------- EOD History ------------
     # ===================================
 
+    def get_table(self, name: str) -> pd.DataFrame:
+        """
+        a plain parsed table by name ('ListDate' or 'SWClass')
+        """
+        if self.service is not None:
+            return self.service.get_table(name)
+        return pd.read_feather(os.path.join(PARSED_PATH, SERVICE_TABLES[name]))
+
     def get_ticker_list_date(self) -> Dict[str, str]:
         """
         get the list date of tickers
         :return the list date of each stock 
         """
-        list_date_path = os.path.join(PARSED_PATH, 'stock_basics', 'ListDate')
-        ser = pd.read_feather(list_date_path).set_index('ticker').squeeze()
+        ser = self.get_table('ListDate').set_index('ticker').squeeze()
         list_date_dict = ser.to_dict()
         return list_date_dict
         
@@ -105,8 +254,7 @@ class PqiDataSdkOffline:
         """
         return sw level 1 industry classification（申万一级行业分类）
         """
-        sw_path = os.path.join(PARSED_PATH, 'industry_class', 'SWClass')
-        df = pd.read_feather(sw_path).rename(columns={'ticker': 'con_code', 'class_code': 'index_code'})
+        df = self.get_table('SWClass').rename(columns={'ticker': 'con_code', 'class_code': 'index_code'})
         return df
 
     @staticmethod
@@ -120,13 +268,15 @@ class PqiDataSdkOffline:
             ticker_name_cn_dict = pickle.load(f)
         return ticker_name_cn_dict
 
+    @io_stats.instrument('source')
     def get_eod_history(
             self,
             tickers: List[str]=[],
             start_date: str='20160101',
             end_date: str='20180101',
             fields: List[str]=[],
-            source: str='stock'
+            source: str='stock',
+            stage: str=None
         ) -> Dict[str, pd.DataFrame]:
         """ 
         get eod_data_dict 
@@ -135,9 +285,13 @@ class PqiDataSdkOffline:
         :param start_date, end_date: the start and end_date of the feature 
         :param fields: the fields to read. If empty, read all.
         :param source: the source of eod to read. Supporting 'stock', 'fund', and 'index'
+        :param stage: the pipeline class loading the data. If given, fields must be declared, 
+            and the returned dict raises KeyError on any other field (see FieldProjection.py)
         :return a dictionary of pd.DataFrame
         """
         eod_data_dict = {}
+        if stage is not None and len(fields) == 0:
+            raise ValueError(f'{stage}: declare the {source} eod fields to load in REQUIRED_FIELDS')
 
         # specify path to read 
         eod_data_path = os.path.join(PARSED_PATH, f'{source}_eod_data')
@@ -152,17 +306,565 @@ class PqiDataSdkOffline:
 
         # select dates
         selected_trade_dates = self.select_trade_dates(start_date, end_date)
-        columns_to_read = np.insert(selected_trade_dates, 0, 'index').tolist()
 
-        # retrieve data
+        # retrieve data (fields decoded concurrently; pyarrow releases the GIL)
+        if self.read_workers > 1 and len(fields) > 1:
+            with ThreadPoolExecutor(max_workers=min(self.read_workers, len(fields))) as executor:
+                field_dfs = executor.map(
+                    lambda field: self.read_eod_field(field, source, selected_trade_dates, tickers, use_threads=False),
+                    fields
+                )
+                eod_data_dict = dict(zip(fields, field_dfs))
+        else:
+            for field in fields:
+                eod_data_dict[field] = self.read_eod_field(field, source, selected_trade_dates, tickers)
+
+        # precision policy
         for field in fields:
-            feature_df_path = os.path.join(eod_data_path, field)
-            feature_df = pd.read_feather(feature_df_path, columns=columns_to_read).set_index('index')
-            eod_data_dict[field] = feature_df.loc[tickers]
+            eod_data_dict[field] = self.apply_precision(eod_data_dict[field], f'{source}_eod_data', field)
         
+        if stage is not None:
+            return project_fields(stage, source, eod_data_dict)
         return eod_data_dict
 
+    @io_stats.instrument('source', 'field')
+    def read_eod_field(
+            self,
+            field: str,
+            source: str,
+            dates: List[str],
+            tickers: List[str],
+            use_threads: bool = True
+        ) -> pd.DataFrame:
+        """
+        read a single eod field from the fastest available backend
+
+        :param field: the field to read
+        :param source: the source of eod to read. Supporting 'stock', 'fund', and 'index'
+        :param dates: the dates to read
+        :param tickers: the tickers to return
+        :param use_threads: whether pyarrow may decode the columns of this file with its own threads
+        :return a ticker x date dataframe
+        """
+        group = f'{source}_eod_data'
+        feature_df_path = os.path.join(PARSED_PATH, group, field)
+        if self.service is not None:
+            return self.service.read(group, field, dates=dates, tickers=tickers)
+        if self.use_server(group, field):
+            return self.server.read(group, field, dates=dates, tickers=tickers)
+        if self.use_panel(group, field):
+            return self.panel_store.read_panel(group, field, dates=dates, tickers=tickers)
+        if self.use_pushdown((source, field, None), feature_df_path, group, field, tickers):
+            return self.row_index.read_rows(feature_df_path, group, field, tickers, dates=dates)
+        if self.use_cache():
+            return self.read_cached((source, field, None), feature_df_path, dates=dates, tickers=tickers)
+
+        columns_to_read = np.insert(dates, 0, 'index').tolist()
+        feature_df = feather.read_table(
+            feature_df_path, columns=columns_to_read, use_threads=use_threads
+        ).to_pandas(use_threads=use_threads).set_index('index')
+        return feature_df.loc[tickers]
+
     
+    # ===================================
+    # -------- Precision Policy ---------
+    # ===================================
+
+    @staticmethod
+    def get_precision(group: str, name: str) -> np.dtype:
+        """ the float dtype to hold a field / feature in (see PRECISION_POLICY) """
+        if name in FULL_PRECISION_FIELDS:
+            return np.dtype('float64')
+        return np.dtype(PRECISION_POLICY.get(group, 'float64'))
+
+    @staticmethod
+    def get_compression(des: str) -> tuple:
+        """ (codec, level) to write the features of a destination with (see COMPRESSION_POLICY) """
+        return COMPRESSION_POLICY.get(des, ('uncompressed', None))
+
+    def apply_precision(self, df: pd.DataFrame, group: str, name: str) -> pd.DataFrame:
+        """ cast a float dataframe to its policy precision (integer ones, e.g. industries, are left as is) """
+        dtype = self.get_precision(group, name)
+        if len(df.columns) == 0 or not all(np.issubdtype(x, np.floating) for x in df.dtypes.unique()):
+            return df
+        if all(x == dtype for x in df.dtypes.unique()):
+            return df
+        return df.astype(dtype)
+
+    def get_precision_report(
+            self,
+            des: str = 'factor',
+            feature_names: List[str] = None,
+            dtype: str = 'float32'
+        ) -> pd.DataFrame:
+        """
+        error introduced by holding features of a destination at a lower precision
+
+        :param des: the destination of the features
+        :param feature_names: features to check (without 'eod_'). If None, all in des
+        :param dtype: the precision to evaluate
+        :return a dataframe indexed by feature, with max_abs_err, max_rel_err and max_abs_value
+        """
+        if feature_names is None:
+            feature_dir = os.path.join(FEATURE_PATH, des)
+            feature_names = sorted([
+                x[4:] for x in os.listdir(feature_dir) 
+                if x.startswith('eod_') and os.path.isfile(os.path.join(feature_dir, x))
+            ])
+
+        report = {}
+        for feature_name in feature_names:
+            values = self.read_feature(des, f'eod_{feature_name}').to_numpy(dtype='float64')
+            with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+                abs_err = np.abs(values.astype(dtype).astype('float64') - values)
+                rel_err = abs_err / np.abs(values)
+            rel_err[~np.isfinite(rel_err)] = np.nan  # zeros and infs
+            report[feature_name] = {
+                'max_abs_err': np.nanmax(abs_err) if np.isfinite(abs_err).any() else np.nan,
+                'max_rel_err': np.nanmax(rel_err) if np.isfinite(rel_err).any() else np.nan,
+                'max_abs_value': np.nanmax(np.abs(values)) if np.isfinite(values).any() else np.nan
+            }
+        return pd.DataFrame(report).T
+
+    # ===================================
+    # -------- Storage Backend ----------
+    # ===================================
+
+    def use_server(self, group: str, name: str) -> bool:
+        """ whether to read from the shared-memory data server """
+        return self.server is not None and self.server.has(group, name)
+
+    def use_panel(self, group: str, name: str) -> bool:
+        """ whether to read from the memory-mapped panel store """
+        return self.backend == 'mmap' and self.panel_store.has_panel(group, name)
+
+    def use_pushdown(self, key: tuple, file_path: str, group: str, name: str, tickers: List[str]) -> bool:
+        """ 
+        whether to read a ticker subset through the row index (see RowIndex.py), 
+        unless the whole file is already cached 
+        """
+        return (
+            0 < len(tickers) < len(self.tickers) 
+            and not feature_cache.contains(key) 
+            and self.row_index.has_index(file_path, group, name)
+        )
+
+    def use_cache(self) -> bool:
+        """ whether feather reads go through the process-wide LRU cache """
+        return feature_cache.max_bytes > 0
+
+    def read_cached(
+            self,
+            key: tuple,
+            file_path: str,
+            dates: List[str] = [],
+            tickers: List[str] = []
+        ) -> pd.DataFrame:
+        """
+        read a feather file through the LRU cache. On a miss the whole file is loaded once; 
+        hits only slice it. The returned frame is read-only.
+
+        :param key: (source, name, des), see FeatureCache.py
+        :param file_path: the feather file to load on a miss
+        :param dates: the dates to read. If empty, read all dates available
+        :param tickers: the tickers to read. If empty, read all
+        :return a ticker x date dataframe
+        """
+        entry = feature_cache.get(key)
+        io_stats.note(cache_hits=int(entry is not None), cache_misses=int(entry is None))
+        if entry is None:
+            full_df = pd.read_feather(file_path).set_index('index')
+            if not full_df.columns.is_monotonic_increasing:
+                full_df = full_df.sort_index(axis=1)
+            entry = feature_cache.put(
+                key, full_df.index.to_numpy(), full_df.columns.to_numpy(dtype=str), full_df.to_numpy()
+            )
+        tickers_all, ticker_pos, dates_all, values = entry
+        return slice_panel(tickers_all, ticker_pos, dates_all, values, dates=dates, tickers=tickers, name=key[1])
+
+    @staticmethod
+    def get_cache_stats() -> dict:
+        """ hit / miss / eviction counters of the process-wide cache """
+        return feature_cache.stats()
+
+    @staticmethod
+    def declare_fields(stage: str, required_fields: Dict[str, List[str]]) -> None:
+        """
+        declare the eod fields a stage reads, per source (its REQUIRED_FIELDS), including those 
+        read through get_adj_price / get_returns only (see FieldProjection.py)
+        """
+        declare_fields(stage, required_fields)
+
+    @staticmethod
+    def get_field_report() -> pd.DataFrame:
+        """ bytes of eod fields loaded versus used, per stage (see FieldProjection.py) """
+        return field_report()
+
+    def read_feature_file(
+            self,
+            des: str,
+            file_name: str,
+            dates: List[str] = [],
+            tickers: List[str] = []
+        ) -> pd.DataFrame:
+        """
+        read the base file of a feature from the fastest available backend
+
+        :param des: the destination folder of the feature
+        :param file_name: f'eod_{feature_name}' or f'ind_{ind_name}'
+        :param dates: the dates to read. If empty, read all trade dates
+        :param tickers: the tickers to read. If empty, read all
+        :return a ticker x date dataframe
+        """
+        feature_path = os.path.join(FEATURE_PATH, des, file_name)
+        return self.read_file(feature_path, des, file_name, ('feature', file_name, des), dates=dates, tickers=tickers)
+
+    def read_file(
+            self,
+            file_path: str,
+            group: str,
+            name: str,
+            key: tuple,
+            dates: List[str] = [],
+            tickers: List[str] = []
+        ) -> pd.DataFrame:
+        """
+        read a ticker x date feather file (a feature or a derived panel) from the fastest available backend
+
+        :param file_path: the feather file
+        :param group, name: the panel / row index of the file
+        :param key: the cache key of the file, see FeatureCache.py
+        :param dates: the dates to read. If empty, read all trade dates
+        :param tickers: the tickers to read. If empty, read all
+        :return a ticker x date dataframe
+        """
+        # memory-mapped panel
+        if self.use_panel(group, name):
+            return self.panel_store.read_panel(group, name, dates=dates, tickers=tickers)
+
+        # ticker subset only
+        if self.use_pushdown(key, file_path, group, name, tickers):
+            return self.row_index.read_rows(file_path, group, name, tickers, dates=dates)
+
+        # cached
+        if self.use_cache():
+            return self.read_cached(key, file_path, dates=dates, tickers=tickers)
+
+        # specify columns 
+        columns_to_read = dates 
+        if len(columns_to_read) == 0:
+            columns_to_read = self.trade_dates
+        columns_to_read = np.insert(columns_to_read, 0, 'index').tolist()
+
+        # retrieve 
+        feature_df = pd.read_feather(file_path, columns=columns_to_read).set_index('index')
+        if len(tickers) > 0:
+            feature_df = feature_df.loc[tickers]
+        return feature_df
+
+    @io_stats.instrument('des', 'file_name')
+    def read_feature(
+            self,
+            des: str,
+            file_name: str,
+            dates: List[str] = [],
+            tickers: List[str] = []
+        ) -> pd.DataFrame:
+        """
+        read a feature, stitching its base file and its date partitions (see PartitionStore.py)
+
+        :param dates: the dates to read. If empty, all dates of the base file and the partitions
+        """
+        if self.service is not None:
+            return self.service.read(des, file_name, dates=dates, tickers=tickers)
+
+        date_to_partition = self.partition_store.partition_dates(des, file_name)
+        if len(date_to_partition) == 0:
+            return self.read_feature_file(des, file_name, dates=dates, tickers=tickers)
+
+        # split the dates between the base file and the partitions
+        feature_path = os.path.join(FEATURE_PATH, des, file_name)
+        if len(dates) == 0:
+            dates = sorted(set(self.partition_store.file_dates(feature_path)) | set(date_to_partition))
+        base_dates = [x for x in dates if x not in date_to_partition]
+        partition_dates = [x for x in dates if x in date_to_partition]
+
+        feature_dfs = []
+        if len(base_dates) > 0:
+            feature_dfs.append(self.read_feature_file(des, file_name, dates=base_dates))
+        if len(partition_dates) > 0:
+            feature_dfs.append(self.partition_store.read(des, file_name, partition_dates))
+        feature_df = pd.concat(feature_dfs, axis=1)[list(dates)]
+        feature_df.index.name = 'index'
+        if len(tickers) > 0:
+            feature_df = feature_df.reindex(tickers)
+        return feature_df
+
+    def write_feature_file(
+            self,
+            des: str,
+            file_name: str,
+            feature_df: pd.DataFrame,
+            mode: str = 'overwrite'
+        ) -> None:
+        """
+        write a feature
+
+        :param des: the destination folder of the feature
+        :param file_name: f'eod_{feature_name}' or f'ind_{ind_name}'
+        :param mode: 'overwrite' rewrites the base file (and drops its partitions);
+            'append' writes only the dates not stored yet, as a new partition
+        """
+        feature_path = os.path.join(FEATURE_PATH, des, file_name)
+        feature_df = self.apply_precision(feature_df, des, file_name)
+
+        # append: new dates only
+        if mode == 'append' and os.path.exists(feature_path):
+            stored_dates = set(self.partition_store.file_dates(feature_path)) 
+            stored_dates |= set(self.partition_store.partition_dates(des, file_name))
+            new_dates = [x for x in feature_df.columns if x not in stored_dates]
+            if len(new_dates) > 0:
+                partition_file = self.partition_store.append(
+                    des, file_name, feature_df[new_dates], *self.get_compression(des)
+                )
+                self.panel_stats.write(
+                    feature_df[new_dates], partition_file, *self.partition_stats_key(des, file_name, partition_file)
+                )
+            return
+        elif mode not in ['overwrite', 'append']:
+            raise ValueError(f'mode {mode} not supported, choose from overwrite and append')
+
+        self.row_index.write_feather(feature_df, feature_path, des, file_name, *self.get_compression(des))
+        self.panel_stats.write(feature_df, feature_path, des, file_name)
+        for partition_file in self.partition_store.list_partitions(des, file_name):
+            self.panel_stats.remove(*self.partition_stats_key(des, file_name, partition_file))
+        self.partition_store.clear(des, file_name)
+        feature_cache.invalidate(('feature', file_name, des))
+
+        # keep the panel in sync with the feather file
+        if self.backend == 'mmap':
+            self.panel_store.write_panel(des, file_name, feature_df)
+        else:
+            self.panel_store.remove_panel(des, file_name)
+
+    def compact_partitions(self) -> None:
+        """ fold the date partitions of all features back into their base files """
+        for des, file_name in self.partition_store.list_features():
+            feature_df = self.read_feature(des, file_name)
+            self.write_feature_file(des, file_name, feature_df)
+            print(f'compacted {des}/{file_name}: {feature_df.shape[1]} dates')
+
+    def get_feature_dates(self, des: str, file_name: str) -> List[str]:
+        """
+        the dates stored of a feature (base file and date partitions), from the file schemas only
+
+        :param des: the destination folder of the feature
+        :param file_name: f'eod_{feature_name}' or f'ind_{ind_name}'
+        :return a sorted list of dates, empty if the feature is not stored
+        """
+        if self.service is not None:
+            try:
+                date_stats, _ = self.service.get_feature_stats(des, file_name)
+            except FileNotFoundError:
+                return []
+            return sorted(date_stats.index)
+
+        feature_path = os.path.join(FEATURE_PATH, des, file_name)
+        if not os.path.exists(feature_path):
+            return []
+        stored_dates = set(self.partition_store.file_dates(feature_path))
+        stored_dates |= set(self.partition_store.partition_dates(des, file_name))
+        return sorted(stored_dates)
+
+    # ===================================
+    # ---------- Panel Stats ------------
+    # ===================================
+
+    @staticmethod
+    def partition_stats_key(des: str, file_name: str, partition_file: str) -> tuple:
+        """ (group, name) of the statistics sidecar of a date partition """
+        return os.path.join('partitions', des, file_name), os.path.basename(partition_file)
+
+    def get_feature_stats(self, des: str, file_name: str) -> tuple:
+        """
+        per-date and per-ticker statistics of a feature (base file and date partitions),
+        from the sidecars written on save (see PanelStats.py)
+
+        :param des: the destination folder of the feature
+        :param file_name: f'eod_{feature_name}' or f'ind_{ind_name}'
+        :return date_stats, ticker_stats: dataframes with columns count (non-nan), min, max, sum
+        """
+        if self.service is not None:
+            return self.service.get_feature_stats(des, file_name)
+
+        feature_path = os.path.join(FEATURE_PATH, des, file_name)
+        stats_list = [self.panel_stats.get_stats(feature_path, des, file_name)]
+        for partition_file in self.partition_store.list_partitions(des, file_name):
+            stats_list.append(
+                self.panel_stats.get_stats(partition_file, *self.partition_stats_key(des, file_name, partition_file))
+            )
+        return combine_stats(stats_list)
+
+    def get_eod_feature_stats(self, feature_name: str, des: str = 'factor') -> tuple:
+        """ per-date and per-ticker statistics of f'eod_{feature_name}', see get_feature_stats """
+        return self.get_feature_stats(des, f'eod_{feature_name}')
+
+    def get_valid_dates(
+            self,
+            feature_name: str,
+            des: str = 'factor',
+            dates: List[str] = [],
+            min_count: int = 1
+        ) -> List[str]:
+        """
+        dates on which a feature has at least min_count non-nan values, without reading the feature
+
+        :param dates: the candidate dates, in the order to return. If empty, all dates stored
+        :return a list of dates
+        """
+        date_stats, _ = self.get_eod_feature_stats(feature_name, des=des)
+        if len(dates) == 0:
+            dates = date_stats.index.tolist()
+        count = date_stats['count'].reindex(list(dates)).fillna(0).to_numpy()
+        return [date for date, n in zip(dates, count) if n >= min_count]
+
+    def get_valid_tickers(self, feature_name: str, des: str = 'factor', min_count: int = 1) -> List[str]:
+        """ tickers having at least min_count non-nan values of a feature, without reading the feature """
+        _, ticker_stats = self.get_eod_feature_stats(feature_name, des=des)
+        return ticker_stats.index[ticker_stats['count'] >= min_count].tolist()
+
+    # ===================================
+    # ---------- Derived Data -----------
+    # ===================================
+
+    def write_derived_file(self, kind: str, name: str, df: pd.DataFrame) -> None:
+        """ write a derived panel (chunked, with its row index) and keep the panel / cache in sync """
+        group = self.derived_store.group(kind)
+        file_path = self.derived_store.file_path(kind, name)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        df = self.apply_precision(df.rename_axis('index'), group, name)
+
+        self.row_index.write_feather(df, file_path, group, name)
+        self.panel_stats.write(df, file_path, group, name)
+        feature_cache.invalidate((group, name, None))
+        if self.backend == 'mmap':
+            self.panel_store.write_panel(group, name, df)
+        else:
+            self.panel_store.remove_panel(group, name)
+
+    def build_derived(self) -> None:
+        """
+        materialize adjusted prices and returns over the full history (see DerivedStore.py).
+        Run once per data refresh
+        """
+        stamp = self.derived_store.source_stamp()
+        self.derived_store.remove_stamp()
+        start_date, end_date = self.trade_dates[0], self.trade_dates[-1]
+        adj_factor = self.get_eod_history(start_date=start_date, end_date=end_date, fields=['AdjFactor'])['AdjFactor']
+
+        # adjusted prices, one field at a time (keep those the returns need)
+        return_fields = sorted({field for return_type in RETURN_TYPES for field in required_fields(return_type)})
+        adj_price_dict = {}
+        for field in [x for x in SOURCE_FIELDS if x != 'AdjFactor']:
+            price_df = self.get_eod_history(start_date=start_date, end_date=end_date, fields=[field])[field]
+            adj_price_df = adjust_prices({field: price_df, 'AdjFactor': adj_factor}, [field])[field]
+            self.write_derived_file('adj_price', field, adj_price_df)
+            if field in return_fields:
+                adj_price_dict[field] = adj_price_df
+            print(f'derived adj_price/{field}')
+
+        # returns
+        for return_type in RETURN_TYPES:
+            self.write_derived_file('returns', return_type, compute_return(adj_price_dict, return_type))
+            print(f'derived returns/{return_type}')
+
+        self.derived_store.write_stamp(stamp)
+
+    def read_derived(self, kind: str, name: str, dates: List[str], tickers: List[str]) -> pd.DataFrame:
+        """ read a derived panel """
+        group = self.derived_store.group(kind)
+        file_path = self.derived_store.file_path(kind, name)
+        return self.read_file(file_path, group, name, (group, name, None), dates=dates, tickers=tickers)
+
+    @io_stats.instrument('field')
+    def get_adj_price(
+            self,
+            field: str,
+            dates: List[str] = [],
+            tickers: List[str] = [],
+            stage: str = None
+        ) -> pd.DataFrame:
+        """
+        adjusted price (field * AdjFactor)
+
+        :param field: one of 'OpenPrice', 'ClosePrice', 'HighestPrice', 'LowestPrice', 'VWAP'
+        :param dates: the dates to read. If empty, all trade dates
+        :param tickers: the tickers to read. If empty, all
+        :param stage: the pipeline class reading it. If given, field and AdjFactor must be declared
+            (see declare_fields), and the read is counted in the field report
+        :return a ticker x date dataframe
+        """
+        fields = [field, 'AdjFactor']
+        if stage is not None:
+            check_declared(stage, 'stock', fields)
+        if self.service is not None:
+            adj_price = self.service.read('derived/adj_price', field, dates=dates, tickers=tickers)
+        elif self.derived_store.is_fresh():
+            adj_price = self.read_derived('adj_price', field, dates, tickers)
+        else:
+            # not built (or stale): from the eod data (counted as loaded by the stage)
+            dates = list(self.trade_dates if len(dates) == 0 else dates)
+            eod_data_dict = self.get_eod_history(
+                tickers=tickers, start_date=min(dates), end_date=max(dates), fields=fields, stage=stage
+            )
+            return adjust_prices(eod_data_dict, [field])[field][dates]
+        if stage is not None:
+            record_derived(stage, 'stock', f'derived/adj_price/{field}', fields, adj_price)
+        return adj_price
+
+    @io_stats.instrument('return_type')
+    def get_returns(
+            self,
+            return_type: str,
+            dates: List[str] = [],
+            tickers: List[str] = [],
+            stage: str = None
+        ) -> pd.DataFrame:
+        """
+        stock returns on adjusted prices (see DerivedStore.py for the definitions)
+
+        :param return_type: 'o2c', 'o2next_o', 'c2next_o', 'c2next_c', 'v2next_v' or 'c2c'
+        :param dates: the dates to read. If empty, all trade dates
+        :param tickers: the tickers to read. If empty, all
+        :param stage: the pipeline class reading it. If given, the price fields of the return type and 
+            AdjFactor must be declared (see declare_fields), and the read is counted in the field report
+        :return a ticker x date dataframe
+        """
+        if return_type not in RETURN_TYPES:
+            raise KeyError(f'return type {return_type} not supported, choose from {list(RETURN_TYPES)}')
+        fields = required_fields(return_type)
+        if stage is not None:
+            check_declared(stage, 'stock', fields + ['AdjFactor'])
+        if self.service is not None:
+            return_df = self.service.read('derived/returns', return_type, dates=dates, tickers=tickers)
+        elif self.derived_store.is_fresh():
+            return_df = self.apply_precision(
+                self.read_derived('returns', return_type, dates, tickers), 'derived/returns', return_type
+            )
+        else:
+            # not built (or stale): from the eod data, one trade date beyond each end (counted as loaded by the stage)
+            dates = list(self.trade_dates if len(dates) == 0 else dates)
+            start_date = self.calendar.shift_one(min(dates), -1)
+            end_date = self.calendar.shift_one(max(dates), 1)
+            eod_data_dict = self.get_eod_history(
+                tickers=tickers, start_date=start_date, end_date=end_date, fields=fields + ['AdjFactor'], stage=stage
+            )
+            return_df = compute_return(adjust_prices(eod_data_dict, fields), return_type)[dates]
+            return self.apply_precision(return_df, 'derived/returns', return_type)
+        if stage is not None:
+            record_derived(stage, 'stock', f'derived/returns/{return_type}', fields + ['AdjFactor'], return_df)
+        return return_df
+
     # ===================================
     # -------- EOD Feature IO -----------
     # ===================================
@@ -178,7 +880,8 @@ class PqiDataSdkOffline:
             self, 
             feature_name: str, 
             des: str='factor', 
-            dates: List[str]=[]
+            dates: List[str]=[],
+            tickers: List[str]=[]
         ) -> pd.DataFrame:
         """
         read feature by name 
@@ -186,38 +889,105 @@ class PqiDataSdkOffline:
         :param feature_name: the name fo the feature 
         :param des: the destination to retrieve factor. Supporting 'factor', 'support_factor', 'risk_factor', 'ml_factor'
         :param dates: the dates of the list. If empty, read all dates available
+        :param tickers: the tickers to read. If empty, read all
         :return a feature dataframe 
         """
-        feature_path = self.eod_feature_path_encoder(feature_name, des)
-
-        # specify columns 
-        columns_to_read = dates 
-        if len(columns_to_read) == 0:
-            columns_to_read = self.trade_dates
-        columns_to_read = np.insert(columns_to_read, 0, 'index').tolist()
-
-        # retrieve 
-        feature_df = pd.read_feather(feature_path, columns=columns_to_read).set_index('index')
-        return feature_df
+        feature_df = self.read_feature(des, f'eod_{feature_name}', dates=dates, tickers=tickers)
+        return self.apply_precision(feature_df, des, f'eod_{feature_name}')
 
 
     # TODO: how to avoid covering the original ones? 
-    def save_eod_feature(self, feature_name: str, feature_df: pd.DataFrame, des: str='factor') -> None:
+    def save_eod_feature(self, feature_name: str, feature_df: pd.DataFrame, des: str='factor', mode: str='overwrite') -> None:
         """ 
         save computed features. All named f'eod_{feature_name}'
         
         :param feature_name: the name of the feature 
         :param feature_df: dataframe
         :param des: the destination of the path. Supporting 'factor', 'support_factor', 'risk_factor', 'ml_factor'
+        :param mode: 'overwrite' the whole file, or 'append' the dates not stored yet (daily updates)
         """
-        feature_path = os.path.join(FEATURE_PATH, des, f'eod_{feature_name}')
-        feature_df.reset_index().to_feather(feature_path)
+        self.write_feature_file(des, f'eod_{feature_name}', feature_df, mode=mode)
+
+    def save_eod_feature_async(self, feature_name: str, feature_df: pd.DataFrame, des: str='factor', mode: str='overwrite') -> None:
+        """
+        save_eod_feature in the background: returns once queued (blocking while the queue is full).
+        feature_df must not be modified afterwards. Errors are raised by flush_writes
+        """
+        self.writer.submit(f'{des}/eod_{feature_name}', self.write_feature_file, des, f'eod_{feature_name}', feature_df, mode)
+
+    def flush_writes(self) -> dict:
+        """
+        wait for all the features queued by save_eod_feature_async to be written
+        :return the write stats of this process: panels, bytes, write_seconds, blocked_seconds, failed
+        """
+        self.writer.flush()
+        return self.writer.get_stats()
+
+    # ===================================
+    # -------- Output Manifests ---------
+    # ===================================
+
+    def get_field_versions(self, fields: List[str], source: str = 'stock') -> Dict[str, list]:
+        """
+        versions of eod fields, for the manifests of the outputs computed from them (see Manifest.py)
+
+        :param fields: the fields. If empty, all (as get_eod_history)
+        :param source: the source of eod. Supporting 'stock', 'fund', and 'index'
+        :return field -> [size, mtime_ns, precision] of its file; None when reading from a data service
+        """
+        if self.service is not None:
+            return None
+        group = f'{source}_eod_data'
+        if len(fields) == 0:
+            fields = sorted(os.listdir(os.path.join(PARSED_PATH, group)))
+        versions = {}
+        for field in fields:
+            stat = os.stat(os.path.join(PARSED_PATH, group, field))
+            versions[field] = [stat.st_size, stat.st_mtime_ns, str(self.get_precision(group, field))]
+        return versions
+
+    def get_table_version(self, name: str) -> list:
+        """ [size, mtime_ns] of a parsed table ('ListDate' or 'SWClass'); None when reading from a data service """
+        if self.service is not None:
+            return None
+        stat = os.stat(os.path.join(PARSED_PATH, SERVICE_TABLES[name]))
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def feature_files(self, des: str, file_name: str) -> List[str]:
+        """ the files of a feature: base file and date partitions """
+        return [os.path.join(FEATURE_PATH, des, file_name)] + self.partition_store.list_partitions(des, file_name)
+
+    def is_feature_current(self, feature_name: str, des: str, manifest: dict) -> bool:
+        """ whether f'eod_{feature_name}' was saved from manifest, and not rewritten since """
+        return self.manifest_store.is_current(des, f'eod_{feature_name}', manifest, self.feature_files(des, f'eod_{feature_name}'))
+
+    def get_feature_manifest(self, feature_name: str, des: str) -> dict:
+        """ the manifest f'eod_{feature_name}' was saved from, None if none is recorded """
+        stored = self.manifest_store.read(des, f'eod_{feature_name}')
+        return None if stored is None else stored['manifest']
+
+    def save_feature_manifest(self, feature_name: str, des: str, manifest: dict, written_after: int = None) -> bool:
+        """
+        record the manifest of f'eod_{feature_name}'
+
+        :param written_after: time.time_ns() before the feature was saved: if given, the manifest is recorded only
+            if a file of the feature was written since (a failed write leaves the files of an earlier run)
+        :return whether it was recorded
+        """
+        files = self.feature_files(des, f'eod_{feature_name}')
+        if written_after is not None:
+            mtimes = [os.stat(x).st_mtime_ns for x in files if os.path.exists(x)]
+            if len(mtimes) == 0 or max(mtimes) < written_after:
+                return False
+        self.manifest_store.write(des, f'eod_{feature_name}', manifest, files)
+        return True
 
     # ===================================
     # -------- Index Mask ---------------
     # ===================================
 
     # TODO: change corresponding parts in backtest and factor comb
+    @io_stats.instrument('index')
     def get_stock_weight(
             self,
             index: str,
@@ -225,47 +995,77 @@ class PqiDataSdkOffline:
         ) -> pd.DataFrame:
         """
         get stock weights of an given index within a timeframe 
-        :param index
+        :param index: index name (e.g. 'zz500') or code (e.g. '000905')
         :param list of trade dates
         :return: a dataframe, stock codes as index, dates as columns, and stock weights as values
         """
-        # convert name to code 
-        index_to_weight = {
-            'zz500': '000905',
-            'zz1000': '000852',
-            'zzall': '000985',
-            'sz50': '000016',
-            'hs300': '000300'
-        }
-        # specify path 
-        index_path = os.path.join(PARSED_PATH, 'index_stock_weight', index_to_weight[index])
-        # retrieve 
-        index_data = pd.read_feather(index_path).set_index("index")
-
         # select trade dates 
         if trade_dates is None:
             trade_dates = self.trade_dates  # all dates
+        code = self.index_membership.to_code(index)
+
+        # remote 
+        if self.service is not None:
+            return self.service.read('index_stock_weight', code, dates=trade_dates)
+
+        # attached to the data server 
+        if self.use_server('index_stock_weight', code):
+            return self.server.read('index_stock_weight', code, dates=trade_dates)
+
+        # specify path 
+        index_path = os.path.join(PARSED_PATH, 'index_stock_weight', code)
+        # retrieve 
+        index_data = pd.read_feather(index_path).set_index("index")
         df_selected = index_data.loc[:, trade_dates]
         return df_selected
 
+    @io_stats.instrument('index_list')
     def get_index_mask(
             self,
-            index_list: List[str]
-        ):
+            index_list: List[str],
+            trade_dates: List[str] = None
+        ) -> pd.DataFrame:
         """
         retrieve index member stock info, 1 if is a member, and nan otherwise
         :param index_list: a list of stock index codes 
+        :param trade_dates: the dates of the mask. If None, all trade dates
         :return a nan mask
         """
-        agg_index_mask = False
-        # read and combine different masks
+        if trade_dates is None:
+            trade_dates = self.trade_dates  # all dates
+        if self.service is not None:
+            mask = self.get_remote_index_mask(index_list, trade_dates)
+            return pd.DataFrame(np.where(mask.to_numpy(), 1., np.nan), index=mask.index, columns=mask.columns)
+        return self.index_membership.get_nan_mask(index_list, trade_dates)
+
+    def get_remote_index_mask(self, index_list: List[str], trade_dates: List[str]) -> pd.DataFrame:
+        """ boolean membership mask from the index weights of the data service (see IndexMembership.get_mask) """
+        agg_mask = None
         for index in index_list:
-            index_weight = self.get_stock_weight(index)
-            index_mask = index_weight.notna()
-            agg_index_mask = agg_index_mask | index_mask
-        # convert to 1 and nans
-        agg_index_mask = agg_index_mask.astype(int) / agg_index_mask.astype(int)
-        return agg_index_mask       
+            mask = self.get_stock_weight(index, trade_dates).notna()
+            agg_mask = mask if agg_mask is None else (agg_mask | mask)
+        return agg_mask.fillna(False).astype(bool)
+
+    def get_index_members(
+            self,
+            index_list: List[str],
+            start_date: str,
+            end_date: str = None
+        ) -> List[str]:
+        """
+        member stocks of any index in index_list, on start_date, or at any point in [start_date, end_date]
+        (bit-packed lookups, see IndexMembership.py)
+        :param index_list: a list of stock index codes 
+        :param start_date, end_date: the date (or range) to look up
+        :return sorted tickers
+        """
+        if self.service is not None:
+            dates = [start_date] if end_date is None else self.select_trade_dates(start_date, end_date)
+            mask = self.get_remote_index_mask(index_list, dates)
+            return sorted(mask.index[mask.any(axis=1)].astype(str))
+        if end_date is None:
+            return self.index_membership.members_on(index_list, start_date)
+        return self.index_membership.members_between(index_list, start_date, end_date)
 
     # ==========================================
     # -------- Dynamic Industyr IO -------------
@@ -282,7 +1082,8 @@ class PqiDataSdkOffline:
          self,
          ind_name: str,
          des: str = 'dynamic_ind',
-         dates: List[str] = []
+         dates: List[str] = [],
+         tickers: List[str] = []
      ) -> pd.DataFrame:
         """
         read ind info by name 
@@ -290,29 +1091,23 @@ class PqiDataSdkOffline:
         :param ind_name: the name fo the feature 
         :param des: the destination to retrieve factor. default to 'dynamic_ind'
         :param dates: the dates of the list. If empty, read all dates available
-        :return a feature dataframe 
+        :param tickers: the tickers to read. If empty, read all
+        :return a feature dataframe, int on the dates every ticker has a label. A ticker missing from
+            the base file or a partition (appended with a different universe), or not stored, is nan
         """
-        feature_path = self.ind_feature_path_encoder(ind_name, des)
+        ind_df = self.read_feature(des, f'ind_{ind_name}', dates=dates, tickers=tickers)
+        complete = ind_df.notna().all().to_numpy()
+        if complete.all():
+            return ind_df.astype(int)
+        return ind_df.astype({date: int for date in ind_df.columns[complete]})
 
-        # specify columns
-        columns_to_read = dates
-        if len(columns_to_read) == 0:
-            columns_to_read = self.trade_dates
-        columns_to_read = np.insert(columns_to_read, 0, 'index').tolist()
-
-        # retrieve
-        ind_df = pd.read_feather(
-            feature_path, columns=columns_to_read
-        ).set_index('index').astype(int)
-        return ind_df
-
-    def save_ind_feature(self, ind_name: str, ind_df: pd.DataFrame, des: str='dynamic_ind') -> None:
+    def save_ind_feature(self, ind_name: str, ind_df: pd.DataFrame, des: str='dynamic_ind', mode: str='overwrite') -> None:
         """ 
         save computed features. All named f'eod_{ind_name}'
         
         :param ind_name: the name of the feature 
         :param feature_df: dataframe
         :param des: the destination of the path. default to 'dynamic_ind'
+        :param mode: 'overwrite' the whole file, or 'append' the dates not stored yet (daily updates)
         """
-        feature_path = os.path.join(FEATURE_PATH, des, f'ind_{ind_name}')
-        ind_df.astype(int).reset_index().to_feather(feature_path)
+        self.write_feature_file(des, f'ind_{ind_name}', ind_df.astype(int), mode=mode)
@@ -0,0 +1,217 @@
+"""
+Row-level pushdown for feather files (ticker subsets)
+
+Feather files written through PqiDataSdkOffline are chunked into record batches of
+ROW_CHUNK_SIZE tickers (compressed per destination, see COMPRESSION_POLICY in
+PqiDataSdk_Offline.py) and get a row-offset index written alongside:
+
+    {META_PATH}/row_index/{group}/{name}.npz   tickers (file order), batch offsets, file stamp
+
+A ticker subset is then read by memory-mapping the file and taking only the batches
+holding the requested rows, and only the requested date columns of those batches.
+Nothing outside the subset is decoded (uncompressed batches are even zero-copy).
+
+The index records the size and mtime of the file it describes. A feather file rewritten
+by other means (e.g. pd.to_feather) no longer matches and is read in full as before.
+"""
+
+# load packages
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pyarrow import feather
+from typing import List, Tuple
+
+# Specify paths
+META_PATH = 'data/meta'
+
+# number of tickers per record batch
+ROW_CHUNK_SIZE = 128
+
+
+class RowIndex:
+
+    def __init__(self, meta_path: str = META_PATH) -> None:
+        self.meta_path = meta_path
+        self.index_handles = {}  # (group, name) -> (stamp, tickers, ticker_pos, offsets)
+
+    # ===================================
+    # ---------- path utils -------------
+    # ===================================
+
+    def index_path(self, group: str, name: str) -> str:
+        """ the row index of a feather file """
+        return os.path.join(self.meta_path, 'row_index', group, f'{name}.npz')
+
+    @staticmethod
+    def file_stamp(file_path: str) -> Tuple[int, int]:
+        """ (size, mtime_ns) of a file, to detect rewrites """
+        stat = os.stat(file_path)
+        return stat.st_size, stat.st_mtime_ns
+
+    # ===================================
+    # ------------ write ----------------
+    # ===================================
+
+    def write_feather(
+            self,
+            df: pd.DataFrame,
+            file_path: str,
+            group: str,
+            name: str,
+            compression: str = 'uncompressed',
+            compression_level: int = None
+        ) -> None:
+        """
+        write a ticker x date dataframe as a chunked feather file plus its row index
+
+        :param df: ticker as index, dates as columns
+        :param file_path: the feather file to write
+        :param group: source or destination folder of the file
+        :param name: the name of the file
+        :param compression, compression_level: the codec ('uncompressed', 'lz4' or 'zstd') and its level
+        """
+        feather.write_feather(
+            df.reset_index(), file_path, compression=compression, compression_level=compression_level,
+            chunksize=ROW_CHUNK_SIZE
+        )
+
+        # batch offsets (checked against the footer, which is cheap to read)
+        offsets = np.arange(0, len(df), ROW_CHUNK_SIZE)
+        with pa.memory_map(file_path, 'r') as source:
+            num_batches = pa.ipc.open_file(source).num_record_batches
+        if num_batches != len(offsets):
+            self.remove_index(group, name)
+            return
+
+        index_path = self.index_path(group, name)
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        size, mtime_ns = self.file_stamp(file_path)
+        with open(index_path, 'wb') as f:
+            np.savez(
+                f, tickers=df.index.astype(str).to_numpy(dtype=str), offsets=offsets,
+                stamp=np.array([size, mtime_ns], dtype=np.int64)
+            )
+        self.index_handles.pop((group, name), None)
+
+    def remove_index(self, group: str, name: str) -> None:
+        """ drop a row index """
+        self.index_handles.pop((group, name), None)
+        index_path = self.index_path(group, name)
+        if os.path.exists(index_path):
+            os.remove(index_path)
+
+    # ===================================
+    # ------------ read -----------------
+    # ===================================
+
+    def open_index(self, file_path: str, group: str, name: str) -> Tuple[np.ndarray, dict, np.ndarray]:
+        """
+        open (and memoize) the row index of a file
+        :return tickers, ticker -> row dict, batch offsets. None if missing or stale
+        """
+        key = (group, name)
+        index_path = self.index_path(group, name)
+        if not os.path.exists(index_path) or not os.path.exists(file_path):
+            self.index_handles.pop(key, None)
+            return None
+
+        stamp = self.file_stamp(file_path)
+        if key not in self.index_handles or self.index_handles[key][0] != stamp:
+            with np.load(index_path) as index_file:
+                if tuple(index_file['stamp'].tolist()) != stamp:
+                    self.index_handles.pop(key, None)
+                    return None
+                tickers = index_file['tickers']
+                offsets = index_file['offsets']
+            self.index_handles[key] = (stamp, tickers, dict(zip(tickers, range(len(tickers)))), offsets)
+        return self.index_handles[key][1:]
+
+    def has_index(self, file_path: str, group: str, name: str) -> bool:
+        """ whether a file has an up-to-date row index """
+        return self.open_index(file_path, group, name) is not None
+
+    def read_rows(
+            self,
+            file_path: str,
+            group: str,
+            name: str,
+            tickers: List[str],
+            dates: List[str] = None
+        ) -> pd.DataFrame:
+        """
+        read the requested tickers (and dates) only
+
+        :param file_path: the feather file, with an up-to-date row index
+        :param tickers: the tickers to read, in the order to return
+        :param dates: the dates to read. If None/empty, read all
+        :return a ticker x date dataframe
+        """
+        _, ticker_pos, offsets = self.open_index(file_path, group, name)
+        rows = np.array([ticker_pos[ticker] for ticker in tickers], dtype=int)
+        unique_rows = np.unique(rows)
+        batch_ids = np.searchsorted(offsets, unique_rows, side='right') - 1
+
+        with pa.memory_map(file_path, 'r') as source:
+            reader = pa.ipc.open_file(source)
+            schema = reader.schema
+
+            # columns
+            if dates is None or len(dates) == 0:
+                columns = [x for x in schema.names if x != 'index']
+            else:
+                columns = [str(x) for x in dates]
+            col_idx = [schema.get_field_index(x) for x in columns]
+            if -1 in col_idx:
+                missing = [x for x, idx in zip(columns, col_idx) if idx == -1]
+                raise KeyError(f'{name}: dates {missing[:5]} not in file')
+
+            # only the batches holding the requested rows
+            pieces = []
+            for batch_id in np.unique(batch_ids):
+                batch = reader.get_batch(int(batch_id))
+                local_rows = unique_rows[batch_ids == batch_id] - offsets[batch_id]
+                projected = pa.RecordBatch.from_arrays(
+                    [batch.column(idx) for idx in col_idx], names=columns
+                )
+                pieces.append(projected.take(pa.array(local_rows)))
+            values = pa.Table.from_batches(pieces).to_pandas().to_numpy()
+
+        # back to the requested order
+        values = values[np.searchsorted(unique_rows, rows)]
+        df = pd.DataFrame(values, index=pd.Index(tickers, name='index'), columns=columns)
+        return df
+
+
+# ===================================
+# ------- one-shot converter --------
+# ===================================
+
+def convert_feather_to_chunked(
+        parsed_path: str = 'data/parsed',
+        feature_path: str = 'data/features',
+        meta_path: str = META_PATH,
+        eod_sources: List[str] = ['stock', 'index', 'fund'],
+        feature_des: List[str] = ['factor', 'support_factor', 'risk_factor', 'risk_factor/class_factors', 'ml_factor', 'dynamic_ind']
+    ) -> None:
+    """
+    rewrite existing feather files in place as chunked files with row indices
+    (same content, readable by pd.read_feather as before)
+
+    :param eod_sources: eod sources to convert
+    :param feature_des: feature destinations to convert (missing folders are skipped)
+    """
+    row_index = RowIndex(meta_path)
+    folders = [(os.path.join(parsed_path, f'{source}_eod_data'), f'{source}_eod_data') for source in eod_sources]
+    folders += [(os.path.join(feature_path, des), des) for des in feature_des]
+
+    for folder, group in folders:
+        if not os.path.isdir(folder):
+            continue
+        file_names = [x for x in sorted(os.listdir(folder)) if os.path.isfile(os.path.join(folder, x))]
+        for file_name in file_names:
+            file_path = os.path.join(folder, file_name)
+            df = pd.read_feather(file_path).set_index('index')
+            row_index.write_feather(df, file_path, group, file_name)
+        print(f'chunked {len(file_names)} files in {folder}')
@@ -0,0 +1,299 @@
+"""
+Memory-aware process pool for batches of independent tasks (factor generation, batch backtests)
+
+    scheduler = MemoryAwareScheduler(memory_budget_gb=cfg.memory_budget_gb, max_workers=cfg.max_processes,
+                                     initializer=init_worker, initargs=(...))
+    results = scheduler.run(func, [(arg_1, arg_2), ...])  # per task, in order: (True, result) or (False, traceback)
+    scheduler.exit_results  # per worker: the result of finalizer(), if given
+
+- each worker records its baseline after the initializer: the memory it keeps resident between
+  tasks (its RSS without the shared pages: shared memory segments, mapped files);
+- the first `sample` tasks run on PROBE_WORKERS workers, each measuring its own peak memory
+  (the peak RSS during the task above the RSS before it, without the shared memory pages it touched);
+- the other tasks run on as many workers as fit the memory budget (per worker: the largest baseline
+  plus the largest peak measured times SAFETY_FACTOR), within max_workers (default: all cores);
+- a worker killed while running a task (e.g. by the OOM killer) breaks the pool: the unfinished
+  tasks are requeued on half the workers, and the workers are not scaled up again. A task killed
+  while running alone fails with a MemoryError.
+
+A pool is kept while its number of workers stays the same, and the initializer runs once in each
+worker of each pool: the probe pool, the sized pool, and the pool of each requeue. It should only
+attach to data loaded once by the parent (e.g. shared memory) rather than load it.
+
+The peak of each task is read from /proc/self/status (VmHWM, reset before each task through
+/proc/self/clear_refs, Linux >= 4.0). Elsewhere the growth of the lifetime peak of the worker is
+used, which understates a task smaller than an earlier one of the same worker.
+
+A finalizer runs in each worker when it exits, i.e. after the work its tasks left behind (e.g. the
+writes still queued after its last task, see AsyncWriter.py), and its result is sent back to the
+parent (see init_reporting_worker; also usable with a plain ProcessPoolExecutor).
+"""
+
+# load packages
+import os
+import time
+import resource
+import traceback
+import numpy as np
+import multiprocessing as mp
+from multiprocessing import util
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, List, Tuple
+
+# workers of the sampled tasks
+PROBE_WORKERS = 2
+
+# margin on the largest peak measured
+SAFETY_FACTOR = 1.25
+
+# share of the memory available at start used as the default budget
+MEMORY_FRACTION = 0.8
+
+# exit hook of the finalizer: before the exit flush of the write-behind queue (AsyncWriter.py, 20)
+FINALIZER_EXIT_PRIORITY = 30
+
+# per worker: the baseline bytes recorded by init_measured_worker
+worker_state = {}
+
+
+# ===================================
+# ---------- memory -----------------
+# ===================================
+
+def read_proc(path: str, keys: List[str]) -> dict:
+    """ the given 'Key:  value kB' entries of a /proc file, in bytes (empty if not readable) """
+    values = {}
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in keys:
+                    values[key] = int(value.split()[0]) * 1024
+    except OSError:
+        return {}
+    return values
+
+
+def available_memory() -> int:
+    """ bytes of memory available to new processes """
+    meminfo = read_proc('/proc/meminfo', ['MemAvailable'])
+    if 'MemAvailable' in meminfo:
+        return meminfo['MemAvailable']
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+
+
+def reset_peak() -> bool:
+    """ reset the peak RSS (VmHWM) of this process to its current RSS, if supported """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def resident_memory() -> int:
+    """ bytes resident in this process, without the shared pages (shared memory segments, mapped files) """
+    status = read_proc('/proc/self/status', ['VmRSS', 'RssFile', 'RssShmem'])
+    if 'VmRSS' in status:
+        return status['VmRSS'] - status.get('RssFile', 0) - status.get('RssShmem', 0)
+    # ru_maxrss (kB on linux, bytes on mac): the lifetime peak, an upper bound
+    unit = 1 if os.uname().sysname == 'Darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+
+
+def measured_call(func: Callable, args: tuple) -> Tuple[object, int, int]:
+    """
+    子进程: run a task and measure its peak memory
+    :return the result of func(*args), the peak bytes of the task, the baseline bytes of the worker (see init_measured_worker)
+    """
+    status_keys = ['VmRSS', 'VmHWM', 'RssShmem']
+    if reset_peak():
+        before = read_proc('/proc/self/status', status_keys)
+        result = func(*args)
+        after = read_proc('/proc/self/status', status_keys)
+        peak = after['VmHWM'] - before['VmRSS'] - (after.get('RssShmem', 0) - before.get('RssShmem', 0))
+    else:
+        # ru_maxrss: kB on linux, bytes on mac
+        unit = 1 if os.uname().sysname == 'Darwin' else 1024
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        result = func(*args)
+        peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) * unit
+    return result, max(int(peak), 0), worker_state.get('baseline', 0)
+
+
+# ===================================
+# ---------- worker exit ------------
+# ===================================
+
+def init_measured_worker(initializer: Callable, initargs: tuple, finalizer: Callable = None, exit_results=None) -> None:
+    """
+    子进程 (pool initializer): run initializer(*initargs) (see init_reporting_worker if exit_results is given),
+    then record the baseline of the worker: the memory it keeps resident between tasks
+    """
+    if exit_results is not None:
+        init_reporting_worker(initializer, initargs, finalizer, exit_results)
+    elif initializer is not None:
+        initializer(*initargs)
+    worker_state['baseline'] = resident_memory()
+
+
+def init_reporting_worker(initializer: Callable, initargs: tuple, finalizer: Callable, exit_results) -> None:
+    """
+    子进程 (pool initializer): run initializer(*initargs), and finalizer() when the worker exits
+    :param exit_results: a list shared with the parent (multiprocessing.Manager().list()), receiving the result of finalizer
+    """
+    if initializer is not None:
+        initializer(*initargs)
+    util.Finalize(None, report_at_exit, args=(finalizer, exit_results), exitpriority=FINALIZER_EXIT_PRIORITY)
+
+
+def report_at_exit(finalizer: Callable, exit_results) -> None:
+    """ 子进程 (exit hook): send the result of finalizer to the parent """
+    try:
+        exit_results.append(finalizer())
+    except:
+        traceback.print_exc()
+
+
+# ===================================
+# ---------- scheduler --------------
+# ===================================
+
+class MemoryAwareScheduler:
+
+    def __init__(
+            self,
+            memory_budget_gb: float = None,
+            max_workers: int = None,
+            sample: int = None,
+            initializer: Callable = None,
+            initargs: tuple = (),
+            finalizer: Callable = None
+        ) -> None:
+        """
+        :param memory_budget_gb: memory the workers may use together. None: MEMORY_FRACTION of the memory available now
+        :param max_workers: cap on the workers. None: all cores
+        :param sample: tasks measured before sizing the pool. None: twice PROBE_WORKERS
+        :param initializer, initargs: of each worker (see ProcessPoolExecutor)
+        :param finalizer: a picklable function called in each worker when it exits, results in exit_results
+        """
+        self.memory_budget = int(memory_budget_gb * 1024 ** 3) if memory_budget_gb else int(available_memory() * MEMORY_FRACTION)
+        self.max_workers = max_workers if max_workers else os.cpu_count()
+        self.sample = sample if sample else 2 * PROBE_WORKERS
+        self.initializer = initializer
+        self.initargs = initargs
+        self.finalizer = finalizer
+        self.exit_results = []  # per worker exited: the result of finalizer
+        self.peaks = []  # bytes, per task finished
+        self.baselines = []  # bytes, of the worker of each task finished
+        self.executor = None
+        self.workers = min(PROBE_WORKERS, self.max_workers)
+        self.requeued = 0
+
+    def size_workers(self) -> int:
+        """ workers fitting the memory budget, from the peaks measured """
+        if len(self.peaks) == 0:
+            return self.workers
+        per_worker = max(max(self.baselines) + max(self.peaks) * SAFETY_FACTOR, 1)
+        workers = int(max(1, min(self.max_workers, self.memory_budget // per_worker)))
+        print(
+            f'scheduler: baseline {max(self.baselines) / 1024 ** 2:.0f} MB per worker, '
+            f'peak {max(self.peaks) / 1024 ** 2:.0f} MB per task over {len(self.peaks)} tasks, '
+            f'budget {self.memory_budget / 1024 ** 3:.1f} GB, {self.max_workers} cores: {workers} workers'
+        )
+        return workers
+
+    def pool(self, exit_results=None) -> ProcessPoolExecutor:
+        """
+        the pool of self.workers workers: the current one if it has as many, else a new one
+        (its workers run the initializer again)
+        :param exit_results: the list shared with the workers receiving the results of the finalizer
+        """
+        if self.executor is not None and self.executor._max_workers != self.workers:
+            self.shutdown()
+        if self.executor is None:
+            initargs = (self.initializer, self.initargs, self.finalizer, exit_results)
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=init_measured_worker, initargs=initargs)
+        return self.executor
+
+    def shutdown(self) -> None:
+        """ shut the pool down, its workers exit """
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    def run_batch(self, func: Callable, args_list: List[tuple], indices: List[int], results: list, exit_results=None) -> List[int]:
+        """
+        run tasks on self.workers workers, filling results
+        :param exit_results: the list shared with the workers receiving the results of the finalizer
+        :return the indices of the tasks not finished because the pool broke (a worker was killed)
+        """
+        broken = []
+        executor = self.pool(exit_results)
+        futures = [(executor.submit(measured_call, func, args_list[i]), i) for i in indices]
+        for future, i in futures:
+            try:
+                result, peak, baseline = future.result()
+            except BrokenProcessPool:
+                broken.append(i)
+            except:
+                results[i] = (False, traceback.format_exc())
+            else:
+                results[i] = (True, result)
+                self.peaks.append(peak)
+                self.baselines.append(baseline)
+        if len(broken) > 0:
+            self.shutdown()
+        return broken
+
+    def run(self, func: Callable, args_list: List[tuple]) -> List[Tuple[bool, object]]:
+        """
+        run func(*args) for each args of args_list
+
+        :param func: a picklable function (module level, or a method of a picklable object)
+        :return per task, in order: (True, result) or (False, the traceback)
+        """
+        start = time.time()
+        results = [None] * len(args_list)
+        pending = list(range(len(args_list)))
+        sampled = False
+        manager = mp.Manager() if self.finalizer is not None else None
+        exit_results = manager.list() if manager is not None else None
+        try:
+            while len(pending) > 0:
+                if sampled:
+                    batch, rest = pending, []
+                else:
+                    batch, rest = pending[:self.sample], pending[self.sample:]
+
+                broken = self.run_batch(func, args_list, batch, results, exit_results)
+                if len(broken) > 0:
+                    if self.workers == 1:
+                        # tasks run in order on a single worker: the first unfinished one was killed
+                        results[broken[0]] = (False, 'MemoryError: the worker was killed running this task alone (out of memory?)')
+                        broken = broken[1:]
+                    self.workers = max(1, self.workers // 2)
+                    self.max_workers = self.workers
+                    self.requeued += len(broken)
+                    print(f'scheduler: a worker was killed, requeuing {len(broken)} tasks on {self.workers} workers')
+                elif not sampled:
+                    sampled = True
+                    self.workers = self.size_workers()
+                pending = broken + rest
+        finally:
+            self.shutdown()
+
+        # the workers have exited
+        if manager is not None:
+            self.exit_results = list(exit_results)
+            manager.shutdown()
+
+        if len(self.peaks) > 0:
+            print(
+                f'scheduler: {len(args_list)} tasks in {time.time() - start:.1f}s, '
+                f'peak per task median {np.median(self.peaks) / 1024 ** 2:.0f} MB / max {max(self.peaks) / 1024 ** 2:.0f} MB, '
+                f'{self.workers} workers, {self.requeued} requeued'
+            )
+        return results
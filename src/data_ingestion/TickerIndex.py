@@ -0,0 +1,69 @@
+"""
+Integer ticker ids
+
+Tickers are 6-digit zero-padded strings at the I/O boundary (feather files, csv, configs).
+Internally (shared memory, positional panels) they are referred to by ticker_id, the
+position of the ticker in the universe (PqiDataSdkOffline.tickers). Together with
+date_id (TradeCalendar.ordinals) this gives an integer coordinate system:
+
+    ticker_ids = ticker_index.ids(df.index)          # labels -> ids, vectorized
+    tickers = ticker_index.labels(ticker_ids)        # ids -> labels, a take
+
+so workers rebuild labels with one array take instead of str(x).zfill(6) per ticker.
+"""
+
+# load packages
+import numpy as np
+from typing import List, Union
+
+Tickers = Union[np.ndarray, List[str], List[int]]
+
+# width of a stock code
+TICKER_WIDTH = 6
+
+
+class TickerIndex:
+
+    def __init__(self, tickers: Tickers) -> None:
+        """
+        :param tickers: the universe, in id order
+        """
+        self.tickers = self.normalize(tickers)
+        self.ticker_pos = dict(zip(self.tickers.tolist(), range(len(self.tickers))))
+        self.sorter = np.argsort(self.tickers, kind='stable')
+
+    def __len__(self) -> int:
+        return len(self.tickers)
+
+    def __contains__(self, ticker) -> bool:
+        return str(ticker).zfill(TICKER_WIDTH) in self.ticker_pos
+
+    @staticmethod
+    def normalize(tickers: Tickers) -> np.ndarray:
+        """ zero-padded string labels from int or str codes (vectorized) """
+        tickers = np.asarray(tickers)
+        if tickers.dtype.kind in 'iuf':
+            tickers = tickers.astype(np.int64)
+        return np.char.zfill(tickers.astype(str), TICKER_WIDTH)
+
+    # ===================================
+    # ---------- ticker <-> id ----------
+    # ===================================
+
+    def id(self, ticker) -> int:
+        """ id of a ticker (-1 if not in the universe) """
+        return self.ticker_pos.get(str(ticker).zfill(TICKER_WIDTH), -1)
+
+    def ids(self, tickers: Tickers) -> np.ndarray:
+        """ ids of an array of tickers (-1 for tickers not in the universe) """
+        tickers = self.normalize(tickers)
+        if len(self.tickers) == 0:
+            return np.full(len(tickers), -1)
+        pos = np.searchsorted(self.tickers, tickers, sorter=self.sorter)
+        pos[pos == len(self.tickers)] = 0
+        ids = self.sorter[pos]
+        return np.where(self.tickers[ids] == tickers, ids, -1)
+
+    def labels(self, ids: Union[int, np.ndarray]) -> Union[str, np.ndarray]:
+        """ tickers of the given id(s) """
+        return self.tickers[ids]
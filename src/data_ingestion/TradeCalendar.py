@@ -0,0 +1,101 @@
+"""
+Trading calendar with O(1) date offsets
+
+Maps date <-> ordinal (position among the trade dates) with a hash map for single
+dates and searchsorted for arrays, so date arithmetic on whole ticker vectors
+(e.g. list date + 60 trade days for every stock) is a single array op:
+
+    calendar = TradeCalendar(trade_dates)
+    calendar.shift(list_dates, 60)          # vectorized
+    calendar.select('20150101', '20211231') # a slice of the trade dates
+
+Dates are 'YYYYMMDD' strings; int dates (as in the backtest calendar) are accepted too.
+Shared by PqiDataSdkOffline, backtest/tools/datatools.py and factor_combination/tools/DataTools.py.
+"""
+
+# load packages
+import numpy as np
+from typing import List, Tuple, Union
+
+Dates = Union[np.ndarray, List[str], List[int]]
+
+
+class TradeCalendar:
+
+    def __init__(self, trade_dates: Dates) -> None:
+        """
+        :param trade_dates: the trade dates (any order, str or int)
+        """
+        self.dates = np.unique(np.asarray(trade_dates).astype(str))
+        self.date_pos = dict(zip(self.dates.tolist(), range(len(self.dates))))
+
+    def __len__(self) -> int:
+        return len(self.dates)
+
+    def __contains__(self, date) -> bool:
+        return str(date) in self.date_pos
+
+    # ===================================
+    # ---------- date <-> ordinal -------
+    # ===================================
+
+    def ordinal(self, date) -> int:
+        """ position of a trade date (-1 if not a trade date) """
+        return self.date_pos.get(str(date), -1)
+
+    def ordinals(self, dates: Dates) -> np.ndarray:
+        """ positions of an array of dates (-1 for dates not in the calendar) """
+        dates = np.asarray(dates).astype(str)
+        pos = np.searchsorted(self.dates, dates)
+        pos[pos == len(self.dates)] = 0
+        return np.where(self.dates[pos] == dates, pos, -1) if len(self.dates) > 0 else np.full(len(dates), -1)
+
+    def date_at(self, ordinals: Union[int, np.ndarray]) -> Union[str, np.ndarray]:
+        """ trade date(s) at the given position(s) """
+        return self.dates[ordinals]
+
+    # ===================================
+    # ---------- arithmetic -------------
+    # ===================================
+
+    def shift(self, dates: Dates, n: int) -> np.ndarray:
+        """
+        the trade dates n days after (n < 0: before) each date, clamped to the calendar.
+        Dates not in the calendar are returned as they are
+
+        :param dates: an array of dates
+        :param n: number of trade days
+        :return an array of 'YYYYMMDD' strings, aligned with dates
+        """
+        dates = np.asarray(dates).astype(str)
+        pos = self.ordinals(dates)
+        shifted = self.dates[np.clip(pos + n, 0, len(self.dates) - 1)]
+        return np.where(pos >= 0, shifted, dates)
+
+    def shift_one(self, date, n: int) -> str:
+        """ the scalar version of shift """
+        pos = self.ordinal(date)
+        if pos < 0:
+            return str(date)
+        return str(self.dates[max(0, min(len(self.dates) - 1, pos + n))])
+
+    def span(self, start_date, end_date) -> Tuple[int, int]:
+        """ (start, stop) positions of the trade dates in [start_date, end_date] """
+        start_idx = int(np.searchsorted(self.dates, str(start_date), side='left'))
+        end_idx = int(np.searchsorted(self.dates, str(end_date), side='right'))
+        return start_idx, max(start_idx, end_idx)
+
+    def select(self, start_date, end_date) -> np.ndarray:
+        """ trade dates in [start_date, end_date] """
+        start_idx, end_idx = self.span(start_date, end_date)
+        return self.dates[start_idx:end_idx]
+
+    def next_date(self, date) -> str:
+        """ the first trade date after date ('' if none) """
+        pos = np.searchsorted(self.dates, str(date), side='right')
+        return str(self.dates[pos]) if pos < len(self.dates) else ''
+
+    def prev_date(self, date) -> str:
+        """ the last trade date before date ('' if none) """
+        pos = np.searchsorted(self.dates, str(date), side='left')
+        return str(self.dates[pos - 1]) if pos > 0 else ''
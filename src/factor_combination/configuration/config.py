@@ -9,7 +9,11 @@ import pandas as pd
 
 # load files 
 from src.data_ingestion.PqiDataSdk_Offline import PqiDataSdkOffline
-myconnector = PqiDataSdkOffline()
+
+# memory ceiling (bytes) of the feather cache: the features of the overlapping rolling 
+# train / test windows (DataTools.prepare_data) are read from disk once (0 to disable)
+cache_max_bytes = 2 * 1024 ** 3
+myconnector = PqiDataSdkOffline(cache_max_bytes=cache_max_bytes)
 
 # ------ test range ------------
 start_date = "20160101"  
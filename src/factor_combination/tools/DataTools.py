@@ -60,7 +60,8 @@ class DataTools:
         
         # others 
         self.date_list = self.get_trade_days()
-        self.calendar = np.array(sorted([int(x) for x in self.myconnector.select_trade_dates(start_date='20010101', end_date='21000101')]))
+        self.trade_calendar = self.myconnector.calendar
+        self.calendar = np.array(self.trade_calendar.dates.astype(int))
 
         # stock eod data 
         self.eod_data_dict = self.myconnector.get_eod_history(
@@ -179,34 +180,39 @@ class DataTools:
 
         return factor_dict
 
+    def get_adj_price(self, field: str) -> pd.DataFrame:
+        """ adjusted price (field * AdjFactor), materialized over the full history (see data_ingestion/DerivedStore.py) """
+        template = self.eod_data_dict['ClosePrice']
+        return self.myconnector.get_adj_price(field, dates=list(template.columns), tickers=list(template.index))
+
     def get_return_data(self) -> pd.DataFrame:
         """ obtain different returns """
         if not self.diy_return:
             self.price_df = pd.DataFrame()
             if self.return_type == 'open_to_open':
-                self.price_df = self.eod_data_dict['OpenPrice'] * self.eod_data_dict['AdjFactor']
+                self.price_df = self.get_adj_price('OpenPrice')
                 self.eod_data_dict["OpenToOpenReturn"] = self.price_df.shift(self.return_end_date, axis=1) / self.price_df.shift(self.return_start_date, axis=1) - 1
                 self.eod_data_dict["OpenToOpenReturn"] = self.eod_data_dict["OpenToOpenReturn"] - self.eod_data_dict[
                     "OpenToOpenReturn"].mean()
                 if not self.valid_y:
                     return self.eod_data_dict["OpenToOpenReturn"]
             elif self.return_type == 'close_to_close':
-                self.price_df = self.eod_data_dict['ClosePrice'] * self.eod_data_dict['AdjFactor']
+                self.price_df = self.get_adj_price('ClosePrice')
                 self.eod_data_dict['CloseToCloseReturn'] = self.price_df.shift(self.return_end_date, axis=1) / self.price_df.shift(self.return_start_date, axis=1) - 1
                 self.eod_data_dict['CloseToCloseReturn'] = self.eod_data_dict['CloseToCloseReturn'] - self.eod_data_dict[
                     'CloseToCloseReturn'].mean()
                 if not self.valid_y:
                     return self.eod_data_dict['CloseToCloseReturn']
             elif self.return_type == 'vwap_to_vwap':
-                self.price_df = self.eod_data_dict['VWAP'] * self.eod_data_dict['AdjFactor']
+                self.price_df = self.get_adj_price('VWAP')
                 self.eod_data_dict['VwapToVwapReturn'] = self.price_df.shift(self.return_end_date, axis=1) / self.price_df.shift(self.return_start_date, axis=1) - 1
                 self.eod_data_dict['VwapToVwapReturn'] = self.eod_data_dict['VwapToVwapReturn'] - self.eod_data_dict[
                     'VwapToVwapReturn'].mean()
                 if not self.valid_y:
                     return self.eod_data_dict['VwapToVwapReturn']
             elif self.return_type == 'close_to_open':
-                self.close_df = self.eod_data_dict['ClosePrice'] * self.eod_data_dict['AdjFactor']
-                self.open_df = self.eod_data_dict['OpenPrice'] * self.eod_data_dict['AdjFactor']
+                self.close_df = self.get_adj_price('ClosePrice')
+                self.open_df = self.get_adj_price('OpenPrice')
                 self.eod_data_dict['CloseToOpenReturn'] = self.open_df.shift(-1, axis=1) / self.close_df.shift(0, axis=1) - 1
                 self.eod_data_dict['CloseToOpenReturn'] = self.eod_data_dict['CloseToOpenReturn'] - self.eod_data_dict[
                     'CloseToOpenReturn'].mean()
@@ -305,14 +311,13 @@ class DataTools:
         # ticker_basic_df = self.myconnector.get_ticker_basic(tickers=self.stock_pool, source='stock')
         # issue_date_dict = ticker_basic_df['listDate'].to_dict()
         issue_date_dict = self.myconnector.get_ticker_list_date()
-        issue_status_df = pd.DataFrame(
-            np.ones_like(self.eod_data_dict['ClosePrice']),
-            index=self.eod_data_dict['ClosePrice'].index,
-            columns=self.eod_data_dict['ClosePrice'].columns
-        ).T
-        for ticker in self.stock_pool:
-            issue_status_df[ticker].loc[:self.get_previous_N_tradedate(issue_date_dict[ticker], -60)] = np.nan
-        return issue_status_df.T
+        close_df = self.eod_data_dict['ClosePrice']
+        # first tradable date of every stock in one shot: list date + 60 trade days
+        list_dates = [issue_date_dict[ticker] for ticker in close_df.index]
+        last_untradable = self.trade_calendar.shift(list_dates, 60)
+        dates = np.asarray(close_df.columns).astype(str)
+        issue_status = np.where(dates[None, :] <= last_untradable[:, None], np.nan, 1.)
+        return pd.DataFrame(issue_status, index=close_df.index, columns=close_df.columns)
 
     def get_suspend(self):
         """ determine if suspended """
@@ -327,22 +332,11 @@ class DataTools:
     def get_previous_N_tradedate(self, date, N=1):
         """
         get trade days N days ago 
-        :param date: must be a trade date
+        :param date: must be a trade date (if not in the calendar, return itself)
         :param N:
         :return:
         """
-        # find index
-        cur_date_idx = np.where(self.calendar == int(date))[0]
-        # if not in the current calendar, the solution is imperfect: just return itself.
-        if len(cur_date_idx) == 0:
-            return date
-
-        prev_date_idx = cur_date_idx[0] - N
-        # put in range
-        prev_date_idx_aligned = max(0, min(len(self.calendar) - 1, prev_date_idx))
-        # select date
-        pre_date = str(self.calendar[prev_date_idx_aligned])
-        return pre_date
+        return self.trade_calendar.shift_one(date, -N)
 
     def get_status(self, up_down):
         """
@@ -425,6 +419,21 @@ class DataTools:
         feature_df_stack = feature_df.stack(dropna=False).values
         return feature_df_stack
 
+    def read_valid_feature(self, feature_name, date_list):
+        """
+        read a feature on date_list, skipping I/O on the dates it has no value at all
+        (known from its statistics sidecar, see data_ingestion/PanelStats.py). Same result as read_eod_feature
+        """
+        date_list = list(date_list)
+        valid_date_list = self.myconnector.get_valid_dates(feature_name, dates=date_list)
+        if len(valid_date_list) == len(date_list):
+            return self.myconnector.read_eod_feature(feature_name, dates=date_list)
+        if len(valid_date_list) == 0:
+            _, ticker_stats = self.myconnector.get_eod_feature_stats(feature_name)
+            return pd.DataFrame(np.nan, index=ticker_stats.index, columns=date_list)
+        feature_df = self.myconnector.read_eod_feature(feature_name, dates=valid_date_list)
+        return feature_df.reindex(columns=date_list)
+
     def prepare_data(self, train_date_list, test_date_list):
         """
         convert factor dict to a 2d dataframe to get train and test X 
@@ -459,16 +468,16 @@ class DataTools:
             # test_date_list_selected = test_date_list[self.lag_date - 1 - lag:len(test_date_list) - lag]
 
             # train 
-            train_feature = self.myconnector.read_eod_feature(
-                feature_name, dates=train_date_list[self.lag_date - 1 - lag:len(train_date_list) - lag]
+            train_feature = self.read_valid_feature(
+                feature_name, train_date_list[self.lag_date - 1 - lag:len(train_date_list) - lag]
             )
             train_feature = train_feature + train_feature * 0  # remove inf 
             # self.train_data[feature] = train_feature.stack(dropna=False).values
             train_data_np.append(train_feature.stack(dropna=False).values)
             
             # test
-            test_feature = self.myconnector.read_eod_feature(
-                feature_name, dates=test_date_list[self.lag_date - 1 - lag:len(test_date_list) - lag]
+            test_feature = self.read_valid_feature(
+                feature_name, test_date_list[self.lag_date - 1 - lag:len(test_date_list) - lag]
             )
             test_feature = test_feature + test_feature * 0  # remove inf
             # self.test_data[feature] = test_feature.stack(dropna=False).values
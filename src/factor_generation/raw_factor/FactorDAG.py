@@ -0,0 +1,256 @@
+"""
+Dependency-aware factor generation: support factors, alpha factors and shared intermediates in one pass
+
+Factor functions (factor_gen / support_factor_gen) declare what they read besides the eod data:
+
+    @requires(('ret', [1]), lambda param_list: [('vol', [param_list[0]])])
+    def sharpe(stock_data_dict, param_list):
+        deps = stock_data_dict['deps']
+        return deps['ret_1'].rolling(param_list[0], axis=1).mean() / deps[f'vol_{param_list[0]}']
+
+A dependency is a (function name, param_list) pair, named like the factors ('_'.join(...)), and is
+- a support factor if the function is in config.support_factor_name_list (saved to support_factor),
+- an alpha factor if the function is in config.factor_name_list (saved to factor),
+- otherwise a shared intermediate (e.g. rolling returns): computed once, not saved.
+
+FactorDAG expands the configured factors with their dependencies (checking for cycles) and tracks
+a run: a node is ready once all its dependencies are done, and the output of a node is released
+once its last consumer is done (FactorGenerator.run_dag keeps the outputs with consumers in
+shared memory until then). A failed node fails the nodes depending on it.
+
+For incremental updates (config.incremental), factor functions also declare the history they need:
+
+    @lookback(lambda param_list: param_list[0])
+    def mom(stock_data_dict, param_list):
+        ...
+
+the number of trade dates before a date that its value depends on. The lookback of a node adds
+the largest one of its dependencies; nodes without one (e.g. expanding windows) need the full history.
+"""
+
+# load packages
+from typing import Callable, Dict, List, Tuple
+
+# kinds of nodes
+KINDS = ['support_factor', 'factor', 'intermediate']
+
+
+def requires(*deps) -> Callable:
+    """
+    declare the dependencies of a factor function
+
+    :param deps: (function name, param_list) pairs, or functions of the param_list of the factor
+        returning a list of such pairs
+    """
+    def decorator(func):
+        func.requires = deps
+        return func
+    return decorator
+
+
+def lookback(days) -> Callable:
+    """
+    declare the history a factor function needs
+
+    :param days: the number of trade dates before a date that the value on that date depends on,
+        or a function of the param_list of the factor returning it
+    """
+    def decorator(func):
+        func.lookback = days
+        return func
+    return decorator
+
+
+def factor_lookback(func: Callable, param_list: list) -> int:
+    """ the declared lookback of a factor function for param_list, None if not declared """
+    days = getattr(func, 'lookback', None)
+    if callable(days):
+        days = days(param_list)
+    return days
+
+
+def node_name(factor: str, param_list: list) -> str:
+    """ the name of a factor / intermediate, as saved """
+    return '_'.join([factor] + [str(x) for x in param_list])
+
+
+class FactorNode:
+
+    def __init__(self, factor: str, param_list: list, kind: str, source: str) -> None:
+        """
+        :param factor: the function name
+        :param param_list: the params forwarded to the function
+        :param kind: one of KINDS (also the destination of the saved factors)
+        :param source: 'sfg' or 'fg', the module holding the function
+        """
+        self.factor = factor
+        self.param_list = list(param_list)
+        self.kind = kind
+        self.source = source
+        self.name = node_name(factor, param_list)
+        self.deps = []  # names of the nodes read
+        self.consumers = set()  # names of the nodes reading this one
+        self.lookback = None  # declared by the function, not counting the dependencies
+
+
+class FactorDAG:
+
+    def __init__(self, sources: Dict[str, object], support_factors: Dict[str, list], factors: Dict[str, list]) -> None:
+        """
+        :param sources: 'sfg' / 'fg' -> the module of the support factor / alpha factor functions
+        :param support_factors, factors: function name -> param_lists to generate
+        """
+        self.sources = sources
+        self.support_factor_names = set(support_factors)
+        self.factor_names = set(factors)
+
+        # expand
+        self.nodes = {}
+        for factor_params in [support_factors, factors]:
+            for factor, param_lists in factor_params.items():
+                for param_list in param_lists:
+                    self.add(factor, param_list)
+        self.order = self.topological_order()
+
+        # run state
+        self.running = set()
+        self.done = set()
+        self.failed = set()
+        self.remaining = {name: len(node.consumers) for name, node in self.nodes.items()}
+
+    # ===================================
+    # ------------ build ----------------
+    # ===================================
+
+    def classify(self, factor: str) -> Tuple[str, str]:
+        """ kind and source of a function """
+        if factor in self.support_factor_names:
+            return 'support_factor', 'sfg'
+        if factor in self.factor_names:
+            return 'factor', 'fg'
+        for source in ['sfg', 'fg']:
+            if hasattr(self.sources[source], factor):
+                return 'intermediate', source
+        raise KeyError(f'{factor}: not a function of support_factor_gen or factor_gen')
+
+    def add(self, factor: str, param_list: list) -> str:
+        """ add a node and (recursively) its dependencies, return its name """
+        name = node_name(factor, param_list)
+        if name in self.nodes:
+            return name
+        kind, source = self.classify(factor)
+        node = FactorNode(factor, param_list, kind, source)
+        self.nodes[name] = node
+
+        func = getattr(self.sources[source], factor)
+        node.lookback = factor_lookback(func, param_list)
+        for dep in getattr(func, 'requires', ()):
+            dep_list = dep(param_list) if callable(dep) else [dep]
+            for dep_factor, dep_param_list in dep_list:
+                dep_name = self.add(dep_factor, dep_param_list)
+                if dep_name not in node.deps:
+                    node.deps.append(dep_name)
+                    self.nodes[dep_name].consumers.add(name)
+        return name
+
+    def topological_order(self) -> List[str]:
+        """ node names, dependencies first. Raise ValueError on a cycle """
+        pending = {name: len(node.deps) for name, node in self.nodes.items()}
+        order = [name for name, count in pending.items() if count == 0]
+        for name in order:
+            for consumer in sorted(self.nodes[name].consumers):
+                pending[consumer] -= 1
+                if pending[consumer] == 0:
+                    order.append(consumer)
+        if len(order) < len(self.nodes):
+            raise ValueError(f'dependency cycle among {sorted(set(self.nodes) - set(order))}')
+        return order
+
+    def ancestors(self, names: List[str]) -> List[str]:
+        """ the given nodes and all the nodes they depend on, dependencies first """
+        needed, stack = set(), list(names)
+        while stack:
+            name = stack.pop()
+            if name not in needed:
+                needed.add(name)
+                stack += self.nodes[name].deps
+        return [name for name in self.order if name in needed]
+
+    def restrict(self, names: List[str]) -> None:
+        """ keep only the given nodes (with all their dependencies, see ancestors), before a run """
+        keep = set(names)
+        self.nodes = {name: node for name, node in self.nodes.items() if name in keep}
+        for node in self.nodes.values():
+            node.consumers &= keep
+        self.order = [name for name in self.order if name in keep]
+        self.remaining = {name: len(node.consumers) for name, node in self.nodes.items()}
+
+    def lookbacks(self) -> Dict[str, int]:
+        """ node name -> history needed, including that of the dependencies (None: the full history) """
+        lookbacks = {}
+        for name in self.order:
+            node = self.nodes[name]
+            dep_lookbacks = [lookbacks[dep] for dep in node.deps]
+            if node.lookback is None or None in dep_lookbacks:
+                lookbacks[name] = None
+            else:
+                lookbacks[name] = node.lookback + max(dep_lookbacks, default=0)
+        return lookbacks
+
+    # ===================================
+    # ------------ run ------------------
+    # ===================================
+
+    def publishes(self, name: str) -> bool:
+        """ whether the output of a node is read by other nodes (and has to be shared) """
+        return len(self.nodes[name].consumers) > 0
+
+    def ready(self) -> List[FactorNode]:
+        """ the nodes not started yet whose dependencies are all done """
+        return [
+            self.nodes[name] for name in self.order
+            if name not in self.running and name not in self.done and name not in self.failed
+            and all(dep in self.done for dep in self.nodes[name].deps)
+        ]
+
+    def start(self, name: str) -> None:
+        self.running.add(name)
+
+    def is_finished(self) -> bool:
+        return len(self.done) + len(self.failed) == len(self.nodes)
+
+    def release(self, name: str) -> List[str]:
+        """ a node will not read its dependencies any more: return those no longer needed """
+        released = []
+        for dep in self.nodes[name].deps:
+            self.remaining[dep] -= 1
+            if self.remaining[dep] == 0 and dep in self.done:
+                released.append(dep)
+        return released
+
+    def finish(self, name: str) -> List[str]:
+        """
+        mark a node done
+        :return the names of the outputs released (their last consumer is done)
+        """
+        self.running.discard(name)
+        self.done.add(name)
+        return self.release(name)
+
+    def fail(self, name: str) -> Tuple[List[str], List[str]]:
+        """
+        mark a node and the nodes depending on it failed
+        :return the names of the dependent nodes skipped, the names of the outputs released
+        """
+        self.running.discard(name)
+        skipped, released, stack = [], [], [name]
+        while stack:
+            failed_name = stack.pop()
+            if failed_name in self.failed:
+                continue
+            self.failed.add(failed_name)
+            if failed_name != name:
+                skipped.append(failed_name)
+            released += self.release(failed_name)
+            stack += sorted(self.nodes[failed_name].consumers)
+        return skipped, released
@@ -6,6 +6,7 @@ import os
 import sys
 import time
 import getpass
+import hashlib
 import datetime
 import warnings
 import traceback
@@ -14,7 +15,9 @@ import numpy as np
 import pandas as pd
 
 import multiprocessing as mp 
+from multiprocessing import resource_tracker
 from multiprocessing.shared_memory import SharedMemory
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 from typing import List, Dict
 
@@ -28,11 +31,15 @@ sys.path.append(cur_dir)
 import config as config
 import factor_gen as fg
 import support_factor_gen as sfg
+from FactorDAG import FactorDAG, node_name
 
 # data source
 # PqiDataSdk offline 
 sys.path.append(os.path.join(cur_dir, '../..'))
 from data_ingestion.PqiDataSdk_Offline import PqiDataSdkOffline
+from data_ingestion.DataServer import attach_segment, unlink_segment
+from data_ingestion.TaskScheduler import MemoryAwareScheduler, init_reporting_worker
+from data_ingestion.Manifest import code_hash, manifest_digest, normalize
 ds = PqiDataSdkOffline()
 
 # from PqiDataSdk import * 
@@ -41,6 +48,26 @@ ds = PqiDataSdkOffline()
 
 # save constants 
 concat = pd.concat
+SOURCES = {'sfg': sfg, 'fg': fg}
+
+# per worker: the eod cube, attached once by init_eod_worker
+# {'index', 'columns', 'values': {eod_key: read-only ndarray}, 'segments': [attached shms]}
+worker_eod = {}
+
+# factors writing into their eod inputs: computed on private copies
+# (config.copy_eod_factors, plus those found on a read-only write in this worker)
+copy_eod_factors = set(config.copy_eod_factors)
+
+
+def init_eod_worker(generator) -> None:
+    """ pool initializer: attach the eod cube once per worker, as read-only views """
+    worker_eod.update(generator.attach_eod_views())
+
+
+def dag_shm_name(name: str) -> str:
+    """ the shared memory holding the output of a factor dag node for its consumers """
+    return f'dag_{name}_{user}'
+
 
 class FactorGenerator:
 
@@ -67,6 +94,28 @@ class FactorGenerator:
         self.name_list = config.support_factor_name_list if self.is_support_factor else config.factor_name_list
         self.param_lists = config.support_factor_params if self.is_support_factor else config.factor_params        
 
+        # support factors, alpha factors and their intermediates in one pass (see FactorDAG.py)
+        self.use_factor_dag = config.use_factor_dag
+
+        # incremental update: only the dates after those stored (see plan_incremental)
+        self.incremental = config.incremental
+        self.new_start_dates = {}  # factor name -> first date to save
+        self.full_rewrites = set()  # factor names redefined since they were stored: rewritten over the whole range
+        self.same_definition = set()  # factor names stored by the same code, params and dependencies
+
+        # skip the factors whose code, params, eod inputs and dates did not change (see build_manifests)
+        self.skip_unchanged = config.skip_unchanged
+        self.unchanged = set()  # factor names computed for their consumers only, not saved
+
+        # workers: sized to the memory budget from the peak memory of the first factors
+        self.max_workers = config.max_workers
+        self.memory_budget_gb = config.memory_budget_gb
+
+        # read from the data server instead of publishing per-run shms
+        self.use_server = ds.server is not None and all(
+            ds.use_server('stock_eod_data', field) for field in self.required_field_types_dict['eod']
+        )
+
 
 
     # ----------------------------------------------------------------
@@ -197,25 +246,27 @@ class FactorGenerator:
     def create_shm(self, to_share, name):
         """
         创建共享内存，将数据存入创建的共享内存
-        :param to_share: a dataframe 
+        :param to_share: a dataframe or an ndarray
         :param name: 读取用的名字
         """
-        to_share_np = to_share.to_numpy()
+        to_share_np = np.asarray(to_share)
         shm = SharedMemory(create=True, name=name, size=to_share_np.nbytes)
         shm_data = np.ndarray(to_share_np.shape, dtype=to_share_np.dtype, buffer=shm.buf)
         shm_data[:] = to_share_np[:]
+        return shm
 
     
     def save_eod_to_shms(self, eod_data_dict):
         """ 
         将eod所有字段存入shm，命名为eod_{字段}_{user}，同时也包括eod_column_{user} 和 eod_index_{user}
+        (index and columns are stored as ticker_id / date_id, see TickerIndex.py)
         :param eod_data_dict: get_eod_history的返回结果
         """
         # 保存不变的量
         self.eod_keys = list(eod_data_dict.keys())
         template = eod_data_dict['ClosePrice']
-        template_index = template.index.astype(int)
-        template_column = template.columns.astype(int)
+        template_index = ds.get_ticker_ids(template.index).astype('int64')
+        template_column = ds.get_date_ids(template.columns).astype('int64')
         close_price_record = template.to_numpy()
         self.template_shape = close_price_record.shape
 
@@ -240,6 +291,10 @@ class FactorGenerator:
         """ 
         清理所有shm
         """
+        # the data server owns its segments
+        if self.use_server:
+            return
+
         # 清理shm
         self.clean_each_shm('index')
         self.clean_each_shm('column')
@@ -250,86 +305,131 @@ class FactorGenerator:
     def process_each_eod_func(self, factor, param_list):
         """
         子进程: 
-            - 重构stock_data_dict
+            - 重构stock_data_dict (dataframes over the worker's read-only eod views, no copies)
             - 计算因子值
             - 返回因子值dataframe
+        a factor writing into its inputs fails on the read-only views; it is then computed 
+        again (and from then on in this worker) on private copies
         :param factor_name: the name of the factor (also a function in either factor_gen or support_factor_gen) 
         :param param_list: the param_list to be forwarded to the function 
-        :return the factor dataframe
+        :return the write report (see write_report)
         """
-        # 读取index和column
         start = time.time()
-        saved_index_shm = SharedMemory(name=f'eod_index_{user}')
-        saved_index_np = np.ndarray((self.template_shape[0], ), dtype='int', buffer=saved_index_shm.buf)
-        saved_column_shm = SharedMemory(name=f'eod_column_{user}')
-        saved_column_np = np.ndarray((self.template_shape[1], ), dtype='int', buffer=saved_column_shm.buf)
-
-        # 转换index和column为string
-        index = [str(x).zfill(6) for x in saved_index_np]
-        column = [str(x) for x in saved_column_np]
-
-        # 重构eod_data_dict
-        reassembled_eod_data_dict = {} 
-        for eod_key in self.eod_keys:
-            saved_shm = SharedMemory(name=f'eod_{eod_key}_{user}')
-            saved_np = np.ndarray(self.template_shape, dtype='float64', buffer=saved_shm.buf).copy()
-            saved_df = pd.DataFrame(saved_np, index=index, columns=column)
-            reassembled_eod_data_dict[eod_key] = saved_df
-        
+        blocked = ds.writer.get_stats()['blocked_seconds']
         factor_name = '_'.join([factor] + [str(x) for x in param_list])
-        
-        # 拼装stock_data_dict
-        stock_data_dict = {'eod': reassembled_eod_data_dict}
-        
+
         # 计算因子
-        factor_df = eval(f'{self.source}.{factor}(stock_data_dict, param_list)')
+        factor_df = self.compute_eod_factor(factor, param_list)
         factor_df = factor_df + factor_df * 0
-        ds.save_eod_feature(factor_name, factor_df, des=self.des)
+        self.save_factor(factor_name, factor_df, self.des)
         print(f'计算和储存因子{factor_name}', time.time() - start)
+        return self.write_report(blocked)
 
 
-    def run_eod(self):
-        """ 运行eod类因子生成 """
-        # 读取eod数据
-        start = time.time()
-        eod_data_dict = self.get_eod()
-        print('读取eod数据耗时', time.time() - start)
+    def compute_eod_factor(self, factor, param_list, source=None, deps=None) -> pd.DataFrame:
+        """
+        子进程: 计算单个因子 on the read-only eod views. A factor writing into its inputs fails on them; 
+        it is then computed again (and from then on in this worker) on private copies
+        :param source: 'fg' or 'sfg' (default: self.source)
+        :param deps: dependency name -> dataframe (factor dag), passed as stock_data_dict['deps']
+        """
+        source = self.source if source is None else source
+        try:
+            return self.call_factor(factor, param_list, source, deps, copy=factor in copy_eod_factors)
+        except ValueError as e:
+            if factor in copy_eod_factors or 'read-only' not in str(e):
+                raise
+            copy_eod_factors.add(factor)
+            print(f'{factor} writes into its eod inputs, computing it on copies')
+            return self.call_factor(factor, param_list, source, deps, copy=True)
+
+
+    def call_factor(self, factor, param_list, source, deps, copy) -> pd.DataFrame:
+        """
+        子进程: 拼装stock_data_dict, 计算因子
+        :param copy: give the factor private copies of the data instead of the shared views
+        """
+        stock_data_dict = {'eod': self.reassemble_eod_data_dict(copy=copy)}
+        if deps is not None:
+            stock_data_dict['deps'] = {name: df.copy() if copy else df for name, df in deps.items()}
+        return eval(f'{source}.{factor}(stock_data_dict, param_list)')
+
 
-        # 存入shared memory
-        self.save_eod_to_shms(eod_data_dict)
-        print('SHM Ready')
+    def reassemble_eod_data_dict(self, copy=False) -> Dict[str, pd.DataFrame]:
+        """
+        子进程: eod_data_dict over the worker's eod cube (see init_eod_worker).
+        Fresh dataframes per factor (so that added columns etc. do not leak into the next one),
+        sharing the index, columns and read-only values
+        :param copy: copy the values (writable)
+        """
+        if len(worker_eod) == 0:
+            # not started through run_eod (e.g. called directly)
+            worker_eod.update(self.attach_eod_views())
+        index, columns = worker_eod['index'], worker_eod['columns']
+        return {
+            eod_key: pd.DataFrame(values.copy() if copy else values, index=index, columns=columns, copy=False)
+            for eod_key, values in worker_eod['values'].items()
+        }
 
-        # 等待共享内存完全建立（即便已经print了shm ready，共享内存并未完全存入，需手动等待）
-        time.sleep(1)
 
-        # 生成多进程
-        process_list = []
-        factor_names = []
-        failed_messages = []
-        failed_factor_list = []
-        start = time.time()
-        pool = mp.Pool(processes=8)
-        for factor in self.name_list:
-            factor_param_list = self.param_lists[factor]
-            for param_list in factor_param_list:
-                process_list.append(pool.apply_async(self.process_each_eod_func, args=(factor, param_list)))
-                factor_names.append('_'.join([factor] + [str(x) for x in param_list]))
-
-        # 等待进程完全传入
-        time.sleep(1)
-        # 运行多进程
-        for i in range(len(process_list)):
-            try:
-                process_list[i].get()
-            except:
-                failed_messages.append(traceback.format_exc())
-                failed_factor_list.append(factor_names[i])
-                
-        pool.close()
-        pool.join()
-        print('完成多进程', time.time() - start)
+    def attach_eod_views(self) -> Dict:
+        """
+        子进程 (once per worker): read-only views of the eod cube, from save_eod_to_shms 
+        or the data server, with the string index and columns built once
+        :return {'index', 'columns', 'values': {eod_key: read-only ndarray}, 'segments': [attached shms]}
+        """
+        # attached to the data server: views of the served segments
+        if self.use_server:
+            eod_data_dict = self.get_eod()
+            template = eod_data_dict['ClosePrice']
+            values = {}
+            for eod_key, df in eod_data_dict.items():
+                values[eod_key] = df.to_numpy().view()
+                values[eod_key].flags.writeable = False
+            return {'index': template.index, 'columns': template.columns, 'values': values, 'segments': []}
 
-        # log加入未成功的factors
+        # 读取index和column
+        saved_index_shm = attach_segment(f'eod_index_{user}')
+        saved_index_np = np.ndarray((self.template_shape[0], ), dtype='int64', buffer=saved_index_shm.buf)
+        saved_column_shm = attach_segment(f'eod_column_{user}')
+        saved_column_np = np.ndarray((self.template_shape[1], ), dtype='int64', buffer=saved_column_shm.buf)
+
+        # ticker_id / date_id 转换回string
+        index = pd.Index(ds.get_ticker_labels(saved_index_np))
+        columns = pd.Index(ds.get_date_labels(saved_column_np))
+
+        # the segments stay attached for the life of the worker
+        values, segments = {}, [saved_index_shm, saved_column_shm]
+        for eod_key in self.eod_keys:
+            saved_shm = attach_segment(f'eod_{eod_key}_{user}')
+            saved_np = np.ndarray(self.template_shape, dtype='float64', buffer=saved_shm.buf)
+            saved_np.flags.writeable = False
+            values[eod_key] = saved_np
+            segments.append(saved_shm)
+        return {'index': index, 'columns': columns, 'values': values, 'segments': segments}
+
+
+    def prepare_eod(self):
+        """ 读取eod数据并存入shared memory (unless served by the data server) """
+        # data server running (python run.py data_server): workers attach to it directly
+        if self.use_server:
+            print('SHM Ready (data server)')
+        else:
+            # 读取eod数据
+            start = time.time()
+            eod_data_dict = self.get_eod()
+            print('读取eod数据耗时', time.time() - start)
+
+            # 存入shared memory
+            self.save_eod_to_shms(eod_data_dict)
+            print('SHM Ready')
+
+            # 等待共享内存完全建立（即便已经print了shm ready，共享内存并未完全存入，需手动等待）
+            time.sleep(1)
+
+
+    def log_failed_factors(self, failed_factor_list, failed_messages):
+        """ log加入未成功的factors """
         if failed_factor_list: 
             curr_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             with open('src/factor_generator/log/failed_factors.txt', 'a') as f:
@@ -339,12 +439,423 @@ class FactorGenerator:
                     f.write(failed_message + '\n')
                     print(failed_message)
                 f.write('\n')
+
+
+    def run_eod(self):
+        """ 运行eod类因子生成 """
+        tasks = [(factor, param_list) for factor in self.name_list for param_list in self.param_lists[factor]]
+        dag = self.build_dag() if self.skip_unchanged or self.incremental else None
+        manifests = self.build_manifests(dag)
+        if manifests is not None:
+            current = self.current_factors(manifests, [(node_name(*task), self.des) for task in tasks])
+            tasks = [task for task in tasks if node_name(*task) not in current]
+        if self.incremental:
+            if manifests is not None:
+                self.plan_rewrites(manifests, [(node_name(*task), self.des) for task in tasks])
+            lookbacks = dag.lookbacks()
+            up_to_date = self.plan_incremental([
+                (node_name(*task), self.des, lookbacks[node_name(*task)]) for task in tasks
+            ])
+            tasks = [task for task in tasks if node_name(*task) not in up_to_date]
+        if len(tasks) == 0:
+            print('all factors up to date')
+            return
+        self.prepare_eod()
+
+        # 生成多进程: concurrency sized from the peak memory of the first factors (see TaskScheduler.py)
+        failed_messages = []
+        failed_factor_list = []
+        start = time.time()
+        written_after = time.time_ns()
+        scheduler = MemoryAwareScheduler(
+            memory_budget_gb=self.memory_budget_gb, max_workers=self.max_workers,
+            initializer=init_eod_worker, initargs=(self,), finalizer=self.final_write_report
+        )
+        results = scheduler.run(self.process_each_eod_func, tasks)
+        for task, (succeeded, result) in zip(tasks, results):
+            if not succeeded:
+                failed_messages.append(result)
+                failed_factor_list.append(node_name(*task))
+        print('完成多进程', time.time() - start)
+        self.collect_write_reports(
+            [result for succeeded, result in results if succeeded] + scheduler.exit_results, failed_factor_list, failed_messages
+        )
+        if manifests is not None:
+            self.save_manifests(
+                manifests, [(node_name(*task), self.des) for task, (succeeded, _) in zip(tasks, results) if succeeded], written_after
+            )
+
+        # log加入未成功的factors
+        self.log_failed_factors(failed_factor_list, failed_messages)
         
         # 清理shm
         start = time.time()
         self.clean_all_shm()
         print(f'完成共享内存清理, 耗时{time.time() - start}')
     
+    # --------------------- manifests ------------------------------
+
+    def build_manifests(self, dag) -> Dict[str, dict]:
+        """
+        the manifest of each node (see data_ingestion/Manifest.py): the code of its function (and of the 
+        functions of its module it calls), its params, the versions of the eod fields and the tickers, 
+        the date range, and the manifests of its dependencies. 'definition' digests the code and params of the node 
+        and of its dependencies only (what a stored history depends on, see plan_rewrites)
+        :return node name -> manifest. None if not skipping unchanged factors, or the eod versions are unknown (data service)
+        """
+        if not self.skip_unchanged:
+            return None
+        input_versions = ds.get_field_versions(self.required_field_types_dict['eod'], source='stock')
+        if input_versions is None:
+            print('manifests: eod versions unknown (data service), computing all factors')
+            return None
+        tickers_hash = hashlib.sha256(','.join(self.tickers).encode()).hexdigest()
+        code_hashes, definitions, manifests = {}, {}, {}
+        for name in dag.order:
+            node = dag.nodes[name]
+            func = getattr(SOURCES[node.source], node.factor)
+            if func not in code_hashes:
+                code_hashes[func] = code_hash(func)
+            definitions[name] = manifest_digest({
+                'code': code_hashes[func], 'params': node.param_list, 'deps': [definitions[dep] for dep in node.deps]
+            })
+            manifests[name] = {
+                'code': code_hashes[func],
+                'params': node.param_list,
+                'inputs': input_versions,
+                'tickers': tickers_hash,
+                'dates': [config.start_date, self.end_date],
+                'deps': [manifest_digest(manifests[dep]) for dep in node.deps],
+                'definition': definitions[name]
+            }
+        return manifests
+
+
+    def current_factors(self, manifests, factors) -> List[str]:
+        """
+        :param factors: (factor name, des) pairs
+        :return the names of the factors saved from their current manifest (and not rewritten since)
+        """
+        current = [name for name, des in factors if ds.is_feature_current(name, des, manifests[name])]
+        print(f'manifests: {len(current)} factors unchanged, {len(factors) - len(current)} to compute')
+        return current
+
+
+    def save_manifests(self, manifests, factors, written_after):
+        """
+        record the manifests of the factors saved by this run
+        :param factors: (factor name, des) pairs of the factors computed without error
+        :param written_after: time.time_ns() before the run (a factor whose write failed keeps no manifest)
+        Incremental: an append is recorded only over a history stored by the same definition (see plan_rewrites)
+        """
+        for name, des in factors:
+            appended = name in self.new_start_dates and name in self.same_definition
+            if self.incremental and name not in self.full_rewrites and not appended:
+                continue
+            if not ds.save_feature_manifest(name, des, manifests[name], written_after=written_after):
+                print(f'manifests: {des}/{name} not written by this run, no manifest recorded')
+
+    # --------------------- incremental ----------------------------
+
+    def plan_rewrites(self, manifests, factors):
+        """
+        incremental: the factors whose definition (code, params, those of their dependencies) differs from their 
+        stored manifest have a stale history: they are rewritten over the whole range instead of appended to.
+        Sets self.full_rewrites and self.same_definition (the others have no manifest: appended, none recorded)
+        :param factors: (factor name, des) pairs
+        """
+        for name, des in factors:
+            stored = ds.get_feature_manifest(name, des)
+            if stored is None:
+                continue
+            if stored.get('definition') != normalize(manifests[name])['definition']:
+                self.full_rewrites.add(name)
+            else:
+                self.same_definition.add(name)
+        if len(self.full_rewrites) > 0:
+            print(f'incremental: {len(self.full_rewrites)} factors redefined, rewritten in full: {sorted(self.full_rewrites)}')
+
+
+    def plan_incremental(self, factors) -> List[str]:
+        """
+        incremental update: load only [new_start - lookback, end_date], where new_start is the first 
+        date after those stored of a factor. Factors without a declared lookback, and those
+        rewritten in full (see plan_rewrites), get the full history.
+        Sets self.start_date (the eod data loaded) and self.new_start_dates
+        :param factors: (factor name, des, lookback) of the factors saved
+        :return the names of the factors up to date
+        """
+        trade_dates = ds.select_trade_dates(config.start_date, self.end_date)
+        load_start = trade_dates[-1]
+        up_to_date = []
+        for factor_name, des, days in factors:
+            if factor_name in self.full_rewrites:
+                load_start = trade_dates[0]
+                continue
+            stored_dates = ds.get_feature_dates(des, f'eod_{factor_name}')
+            new_dates = trade_dates[trade_dates > stored_dates[-1]] if len(stored_dates) > 0 else trade_dates
+            if len(new_dates) == 0:
+                up_to_date.append(factor_name)
+                continue
+            self.new_start_dates[factor_name] = new_dates[0]
+            factor_start = trade_dates[0] if days is None else ds.shift_trade_dates([new_dates[0]], -days)[0]
+            load_start = min(load_start, factor_start)
+        self.start_date = max(load_start, trade_dates[0])
+        print(
+            f'incremental: {len(self.new_start_dates)} factors to update, {len(self.full_rewrites)} to rewrite, '
+            f'{len(up_to_date)} up to date, loading from {self.start_date}'
+        )
+        return up_to_date
+
+
+    def save_factor(self, factor_name, factor_df, des):
+        """
+        子进程: 储存因子, in the background (the worker computes the next factor meanwhile, see AsyncWriter.py). 
+        Incremental: append the new dates only (the earlier ones are lookback), or rewrite all if redefined
+        """
+        if factor_name in self.unchanged:
+            return
+        if not self.incremental or factor_name in self.full_rewrites:
+            ds.save_eod_feature_async(factor_name, factor_df, des=des)
+        elif factor_name in self.new_start_dates:
+            new_dates = [x for x in factor_df.columns if x >= self.new_start_dates[factor_name]]
+            ds.save_eod_feature_async(factor_name, factor_df[new_dates], des=des, mode='append')
+
+
+    def write_report(self, blocked) -> Dict:
+        """
+        子进程: the seconds blocked on writes since blocked (the worker's total before the task), and the 
+        writes failed since the last report (writes still pending after the worker's last task are
+        reported by final_write_report)
+        :return {'blocked_seconds': float, 'write_errors': [(des/eod_name, traceback)]}
+        """
+        return {
+            'blocked_seconds': ds.writer.get_stats()['blocked_seconds'] - blocked,
+            'write_errors': ds.writer.take_errors()
+        }
+
+
+    def final_write_report(self) -> Dict:
+        """
+        子进程 (when the worker exits, see TaskScheduler.init_reporting_worker): wait for the writes 
+        still pending after the worker's last task, and report them as write_report does
+        """
+        blocked = ds.writer.get_stats()['blocked_seconds']
+        ds.writer.wait()
+        return self.write_report(blocked)
+
+
+    def collect_write_reports(self, reports, failed_factor_list, failed_messages):
+        """ add the failed writes of the workers' reports to the failed factors, print the time blocked on writes """
+        blocked_seconds = 0
+        for report in reports:
+            blocked_seconds += report['blocked_seconds']
+            for name, message in report['write_errors']:
+                failed_factor_list.append(name)
+                failed_messages.append(message)
+        print(f'写入阻塞 (blocked on writes, all workers) {blocked_seconds:.2f}s')
+
+
+    def check_incremental(self, sample=5, n_dates=20, seed=0) -> pd.DataFrame:
+        """
+        consistency check of the incremental updates: recompute a sample of the factors over the full 
+        history [config.start_date, end_date] (in this process) and compare with the stored values
+        :param sample: number of factors checked (chosen at random)
+        :param n_dates: number of the last stored dates compared
+        :return per factor: des, dates compared, max abs diff, mismatched dates, ok
+        """
+        dag = self.build_dag()
+        stored = [name for name in dag.order if dag.nodes[name].kind != 'intermediate']
+        checked = sorted(np.random.default_rng(seed).choice(stored, min(sample, len(stored)), replace=False))
+
+        # full recompute, dependencies first
+        eod_data_dict = ds.get_eod_history(
+            tickers=self.tickers,
+            start_date=config.start_date,
+            end_date=self.end_date,
+            fields=self.required_field_types_dict['eod'],
+            source='stock'
+        )
+        outputs = {}
+        for name in dag.ancestors(checked):
+            node = dag.nodes[name]
+            stock_data_dict = {
+                'eod': {eod_key: df.copy() for eod_key, df in eod_data_dict.items()},
+                'deps': {dep: outputs[dep] for dep in node.deps}
+            }
+            factor_df = getattr(SOURCES[node.source], node.factor)(stock_data_dict, node.param_list)
+            outputs[name] = factor_df + factor_df * 0
+
+        # compare
+        rows = []
+        for name in checked:
+            des, full_df = dag.nodes[name].kind, outputs[name]
+            full_dates = set(full_df.columns)
+            dates = [x for x in ds.get_feature_dates(des, f'eod_{name}') if x in full_dates][-n_dates:]
+            stored_values = ds.read_feature(des, f'eod_{name}', dates=dates, tickers=list(full_df.index)).to_numpy(dtype='float64')
+            full_values = full_df[dates].to_numpy(dtype='float64')
+            mismatched = ~np.isclose(stored_values, full_values, rtol=1e-5, atol=1e-8, equal_nan=True)
+            diff = np.abs(stored_values - full_values)
+            rows.append({
+                'factor': name,
+                'des': des,
+                'dates': len(dates),
+                'max_abs_diff': float(np.nanmax(diff)) if (~np.isnan(diff)).any() else 0.,
+                'mismatched_dates': int(mismatched.any(axis=0).sum()),
+                'ok': len(dates) > 0 and not mismatched.any()
+            })
+        return pd.DataFrame(rows, columns=['factor', 'des', 'dates', 'max_abs_diff', 'mismatched_dates', 'ok']).set_index('factor')
+
+    # --------------------- factor dag ----------------------------
+
+    def build_dag(self) -> FactorDAG:
+        """ the factors to generate (support and alpha ones with use_factor_dag) and their dependencies """
+        if self.use_factor_dag:
+            return FactorDAG(
+                SOURCES,
+                {factor: config.support_factor_params[factor] for factor in config.support_factor_name_list},
+                {factor: config.factor_params[factor] for factor in config.factor_name_list}
+            )
+        factor_params = {factor: self.param_lists[factor] for factor in self.name_list}
+        if self.is_support_factor:
+            return FactorDAG(SOURCES, factor_params, {})
+        return FactorDAG(SOURCES, {}, factor_params)
+
+
+    def process_dag_node(self, node, publish):
+        """
+        子进程: compute one node of the factor dag
+            - stock_data_dict = {'eod': eod_data_dict, 'deps': {dependency name: read-only dataframe}}
+            - support / alpha factors are saved, intermediates are not
+            - if publish (the node has consumers), the output is shared as dag_{name}_{user}, 
+              aligned to the eod cube, until run_dag releases it
+        :param node: a FactorNode
+        :param publish: whether to share the output
+        :return the write report (see write_report)
+        """
+        start = time.time()
+        blocked = ds.writer.get_stats()['blocked_seconds']
+        if len(worker_eod) == 0:
+            worker_eod.update(self.attach_eod_views())
+        index, columns = worker_eod['index'], worker_eod['columns']
+
+        # 读取dependencies
+        deps, segments = {}, []
+        for dep in node.deps:
+            saved_shm = attach_segment(dag_shm_name(dep))
+            saved_np = np.ndarray((len(index), len(columns)), dtype='float64', buffer=saved_shm.buf)
+            saved_np.flags.writeable = False
+            deps[dep] = pd.DataFrame(saved_np, index=index, columns=columns, copy=False)
+            segments.append(saved_shm)
+
+        try:
+            # 计算因子
+            factor_df = self.compute_eod_factor(node.factor, node.param_list, source=node.source, deps=deps)
+            factor_df = factor_df + factor_df * 0
+            if node.kind != 'intermediate':
+                self.save_factor(node.name, factor_df, node.kind)
+            if publish:
+                aligned = factor_df.reindex(index=index, columns=columns).astype('float64')
+                shm = self.create_shm(aligned, dag_shm_name(node.name))
+                # owned by the parent, not unlinked at the exit of this worker
+                resource_tracker.unregister(shm._name, 'shared_memory')
+                shm.close()
+        finally:
+            deps.clear()
+            for saved_shm in segments:
+                try:
+                    saved_shm.close()
+                except BufferError:
+                    pass  # still referenced by the factor output, closed with it
+        print(f'计算和储存{node.kind} {node.name}', time.time() - start)
+        return self.write_report(blocked)
+
+
+    def run_dag(self):
+        """ 
+        运行eod类因子生成: support factors, alpha factors and their intermediates in one pass.
+        Ready nodes run in parallel; the outputs read by other nodes stay in shared memory 
+        until their last consumer is done (see FactorDAG.py)
+        """
+        dag = self.build_dag()
+        print(f'factor dag: {len(dag.nodes)} nodes')
+        stored = [(name, node.kind) for name, node in dag.nodes.items() if node.kind != 'intermediate']
+        manifests = self.build_manifests(dag)
+        if manifests is not None:
+            # unchanged nodes still run if a changed one depends on them, but save nothing
+            current = set(self.current_factors(manifests, stored))
+            dag.restrict(dag.ancestors([name for name, _ in stored if name not in current]))
+            self.unchanged = current & set(dag.nodes)
+            stored = [(name, kind) for name, kind in stored if name in dag.nodes and name not in current]
+        if self.incremental:
+            if manifests is not None:
+                self.plan_rewrites(manifests, stored)
+            lookbacks = dag.lookbacks()
+            # nodes up to date still run (their consumers may not be), but save nothing
+            self.plan_incremental([
+                (name, node.kind, lookbacks[name]) for name, node in dag.nodes.items() if node.kind != 'intermediate'
+            ])
+        if len(dag.nodes) == 0:
+            print('all factors up to date')
+            return
+        self.prepare_eod()
+
+        # left over by an interrupted run
+        for name in dag.nodes:
+            unlink_segment(dag_shm_name(name))
+
+        failed_messages = []
+        failed_factor_list = []
+        write_reports = []
+        start = time.time()
+        written_after = time.time_ns()
+        running = {}
+        # the write reports of the workers at exit (see final_write_report)
+        manager = mp.Manager()
+        exit_reports = manager.list()
+        try:
+            with ProcessPoolExecutor(
+                max_workers=self.max_workers or os.cpu_count(), initializer=init_reporting_worker, 
+                initargs=(init_eod_worker, (self,), self.final_write_report, exit_reports)
+            ) as executor:
+                while not dag.is_finished():
+                    for node in dag.ready():
+                        dag.start(node.name)
+                        running[executor.submit(self.process_dag_node, node, dag.publishes(node.name))] = node.name
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        name = running.pop(future)
+                        try:
+                            write_reports.append(future.result())
+                        except:
+                            failed_messages.append(traceback.format_exc())
+                            failed_factor_list.append(name)
+                            skipped, released = dag.fail(name)
+                            for skipped_name in skipped:
+                                failed_messages.append(f'skipped: depends on {name}')
+                                failed_factor_list.append(skipped_name)
+                        else:
+                            released = dag.finish(name)
+                        for released_name in released:
+                            unlink_segment(dag_shm_name(released_name))
+        finally:
+            for name in dag.nodes:
+                unlink_segment(dag_shm_name(name))
+            write_reports.extend(exit_reports)
+            manager.shutdown()
+        print('完成多进程', time.time() - start)
+        self.collect_write_reports(write_reports, failed_factor_list, failed_messages)
+        if manifests is not None:
+            self.save_manifests(manifests, [(name, kind) for name, kind in stored if name in dag.done], written_after)
+
+        # log加入未成功的factors
+        self.log_failed_factors(failed_factor_list, failed_messages)
+
+        # 清理shm
+        start = time.time()
+        self.clean_all_shm()
+        print(f'完成共享内存清理, 耗时{time.time() - start}')
+
     # ---------------------------------------------
     # -------------------- 总体运行 ----------------
     # ---------------------------------------------
@@ -354,7 +865,10 @@ class FactorGenerator:
         # EOD
         if 'eod' in self.required_data_types:
             try: 
-                self.run_eod()
+                if self.use_factor_dag:
+                    self.run_dag()
+                else:
+                    self.run_eod()
             except Exception as e:
                 print(e)
                 print(traceback.format_exc())
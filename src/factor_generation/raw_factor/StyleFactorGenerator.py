@@ -5,7 +5,10 @@ Barra 风格因子生成项目（从原RiskPlot中分离出来)
 
 # load files 
 from src.data_ingestion.PqiDataSdk_Offline import PqiDataSdkOffline
+from src.data_ingestion.FieldProjection import print_field_report
+from src.data_ingestion.Manifest import code_hash, file_stamps
 from src.factor_generation.raw_factor import style_factor_config as cfg
+from src.factor_generation.tools import operators as op
 
 # load packages
 import os
@@ -24,9 +27,119 @@ import statsmodels.api as sm
 
 USER = getpass.getuser()
 
+# kernels up to this length are applied lag by lag, longer ones by fft (see rolling_kernel_mean)
+DIRECT_MAX_KERNEL = 16
+
+
+# ==================================
+# ------ weighted windows ----------
+# ==================================
+
+def kernel_convolve(values: np.ndarray, lag_weights: np.ndarray, method: str = 'auto') -> np.ndarray:
+    """
+    causal convolution along the dates: out[:, t] = sum_k lag_weights[k] * values[:, t - k] (0 before the first date)
+
+    :param values: ticker x date array without nan
+    :param lag_weights: the weight of the value k dates before, k = 0, ..., window - 1
+    :param method: 'fft', 'direct' (one pass per lag) or 'auto' (direct up to DIRECT_MAX_KERNEL lags)
+    """
+    n_dates, window = values.shape[1], len(lag_weights)
+    if method == 'auto':
+        method = 'direct' if window <= DIRECT_MAX_KERNEL else 'fft'
+    if method == 'direct':
+        out = np.zeros(values.shape)
+        for lag, weight in enumerate(lag_weights[:n_dates]):
+            out[:, lag:] += weight * values[:, :n_dates - lag]
+        return out
+    if method != 'fft':
+        raise ValueError(f'method {method} not supported, choose from auto, fft and direct')
+    # zero-padded to a length without wrap-around, rounded up to a power of 2
+    n_fft = 1 << int(np.ceil(np.log2(n_dates + window - 1)))
+    spectrum = np.fft.rfft(values, n=n_fft, axis=1) * np.fft.rfft(lag_weights, n=n_fft)
+    return np.fft.irfft(spectrum, n=n_fft, axis=1)[:, :n_dates]
+
+
+def rolling_kernel_mean(df: pd.DataFrame, kernel: np.ndarray, min_periods: int = None, method: str = 'auto') -> pd.DataFrame:
+    """
+    rolling weighted mean along the dates with a fixed kernel: kernel[-1] weighs the current date, kernel[0] the
+    oldest one, as rolling(len(kernel), axis=1).apply(lambda s: s @ kernel / kernel.sum(), raw=True)
+
+    nan and +-inf values are missing, as in pandas rolling (which turns +-inf into nan before windowing, so an inf
+    does not propagate): nan where the window holds fewer than min_periods (default: all) valid values,
+    otherwise the mean of the valid values, the kernel renormalized over them
+    :param df: ticker x date dataframe
+    :param kernel: 1d array of weights, its length is the window
+    :param method: see kernel_convolve
+    """
+    values = df.to_numpy(dtype=np.float64)
+    kernel = np.asarray(kernel, dtype=np.float64)
+    window = len(kernel)
+    min_periods = window if min_periods is None else min_periods
+    valid = np.isfinite(values)
+
+    weighted_sum = kernel_convolve(np.where(valid, values, 0.), kernel[::-1], method=method)
+    # counts by prefix sums (exact), the weights of the valid values only where some are missing
+    count = np.cumsum(valid, axis=1)
+    count[:, window:] -= count[:, :-window].copy()
+    weight_sum = np.full(values.shape, kernel.sum())
+    partial = (count >= min_periods) & (count < window)
+    if partial.any():
+        weight_sum[partial] = kernel_convolve(valid.astype(np.float64), kernel[::-1], method=method)[partial]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = weighted_sum / weight_sum
+    out[count < max(min_periods, 1)] = np.nan
+    return pd.DataFrame(out, index=df.index, columns=df.columns)
+
+
+# rolling statistics (along the dates) of rolling_stats
+ROLLING_STATS = {'mean': op.ts_mean, 'std': op.ts_std, 'max': op.ts_max, 'min': op.ts_min}
+
+
+def rolling_stats(df: pd.DataFrame, windows: list, stats: list, min_periods: int = None) -> dict:
+    """
+    rolling statistics of a panel for several windows at once: {stat: {window: ticker x date dataframe}},
+    as {stat: {w: df.rolling(w, axis=1).stat()}}. Each statistic takes one pass over the panel for all
+    windows (prefix sums for mean / std, van Herk / Gil-Werman blocks for max / min, see tools/operators)
+
+    nan and +-inf values are missing, as in pandas rolling (which turns +-inf into nan before windowing): nan where
+    the window holds fewer than min_periods (default: all) valid values
+    :param stats: names among ROLLING_STATS
+    """
+    unknown = [x for x in stats if x not in ROLLING_STATS]
+    if len(unknown) > 0:
+        raise ValueError(f'stats {unknown} not supported, choose from {list(ROLLING_STATS)}')
+    values = df.to_numpy(dtype=np.float64)
+    windows = [int(w) for w in windows]
+    result = {}
+    for stat in stats:
+        stacked = ROLLING_STATS[stat](values, windows, min_periods=min_periods)
+        result[stat] = {
+            w: pd.DataFrame(stacked[i], index=df.index, columns=df.columns) for i, w in enumerate(windows)
+        }
+    return result
+
 
 class StyleFactorGenerator(object):
 
+    # eod fields read, per source (see data_ingestion/FieldProjection.py)
+    REQUIRED_FIELDS = {
+        'stock': [
+            'ClosePrice', 'OpenPrice', 'PreClosePrice', 'TotalMarketValue', 'TurnoverRate', 
+            'HighestPrice', 'LowestPrice', 'AdjFactor'
+        ],
+        'index': ['ClosePrice', 'OpenPrice']
+    }
+
+    # read through get_adj_price / get_returns only, not loaded with the eod history
+    ADJUSTED_ONLY_FIELDS = ['HighestPrice', 'LowestPrice', 'AdjFactor']
+
+    # derived panels read (see data_ingestion/DerivedStore.py)
+    DERIVED_PANELS = [
+        ('adj_price', 'OpenPrice'), ('adj_price', 'ClosePrice'), ('adj_price', 'HighestPrice'), ('adj_price', 'LowestPrice'),
+        ('returns', 'o2next_o'), ('returns', 'c2next_o'), ('returns', 'o2c'), ('returns', 'c2c')
+    ]
+
     # ======================
     # ------ init ----------
     # ======================
@@ -61,6 +174,9 @@ class StyleFactorGenerator(object):
         self.ind_ret_df_dict = {}
         self.plain_ret_df_dict = {}
 
+        # what the outputs are computed from, before reading it (see data_ingestion/Manifest.py)
+        self.manifest = self.build_manifest()
+
         # load data
         self.load_data()
 
@@ -73,21 +189,81 @@ class StyleFactorGenerator(object):
         self.date_list = list(self.Open.columns)
 
 
+    # ==========================
+    # ------ manifest ----------
+    # ==========================
+
+    @staticmethod
+    def output_files() -> list:
+        """ all the files written under saving_path (risk factors, class factors, returns, indicators) """
+        files = []
+        for root, _, file_names in os.walk(cfg.saving_path):
+            files += [os.path.join(root, x) for x in file_names if not x.endswith('.tmp')]
+        return sorted(files)
+
+    @classmethod
+    def build_manifest(cls) -> dict:
+        """
+        the manifest of the outputs: the code of this module (and of the project modules it uses, e.g. the operators), 
+        the config, the versions of the eod fields, derived panels, index weights and industry table read. 
+        None if unknown (data service)
+        """
+        stock_versions = cfg.ds.get_field_versions(cls.REQUIRED_FIELDS['stock'], source='stock')
+        index_versions = cfg.ds.get_field_versions(cls.REQUIRED_FIELDS['index'], source='index')
+        sw_version = cfg.ds.get_table_version('SWClass')
+        if stock_versions is None or index_versions is None or sw_version is None:
+            return None
+        index_weight_files = [os.path.join(cfg.index_weight_path, x) for x in sorted(set(cfg.index_list) | {'000016', '000300', '000905', '000852'})]
+        return {
+            'code': code_hash(cls),
+            'params': {
+                key: value for key, value in vars(cfg).items() 
+                if not key.startswith('_') and isinstance(value, (str, int, float, bool, list, dict))
+            },
+            'inputs': {'stock': stock_versions, 'index': index_versions, 'SWClass': sw_version},
+            'index_weights': file_stamps(index_weight_files),
+            'derived': file_stamps([cfg.ds.derived_store.file_path(kind, name) for kind, name in cls.DERIVED_PANELS])
+        }
+
+    @classmethod
+    def is_up_to_date(cls) -> bool:
+        """ whether the outputs were computed from the current manifest, and not rewritten since """
+        manifest = cls.build_manifest()
+        return manifest is not None and cfg.ds.manifest_store.is_current(
+            'risk_factor', cls.__name__, manifest, cls.output_files()
+        )
+
+    def save_manifest(self):
+        """
+        record the manifest of the outputs written (after flush_saving)
+        """
+        if self.manifest is not None:
+            self.myconnector.manifest_store.write('risk_factor', type(self).__name__, self.manifest, self.output_files())
+
+    # ==========================
+    # ------ load data ---------
+    # ==========================
+
     def load_data(self):
         """
         load index and stock data 
         """
+        self.myconnector.declare_fields(type(self).__name__, self.REQUIRED_FIELDS)
         self.eod_data_dict = self.myconnector.get_eod_history(
             tickers=self.all_stocks, 
             start_date=self.start_date,
-            end_date=self.end_date
+            end_date=self.end_date,
+            fields=[x for x in self.REQUIRED_FIELDS['stock'] if x not in self.ADJUSTED_ONLY_FIELDS],
+            stage=type(self).__name__
         )
 
         self.idx_dict = self.myconnector.get_eod_history(
             tickers=self.idx_list, 
             start_date=self.start_date,
             end_date=self.end_date, 
-            source='index'
+            fields=self.REQUIRED_FIELDS['index'],
+            source='index',
+            stage=type(self).__name__
         )
 
     def compute_returns(self):
@@ -101,14 +277,22 @@ class StyleFactorGenerator(object):
         self.idx_ret_df_dict['o2next_o'] = self.idx_dict['OpenPrice'].shift(-1, axis=1) / self.idx_dict['OpenPrice'] - 1
         self.idx_ret_df_dict['c2next_o'] = self.idx_dict['OpenPrice'].shift(-1, axis=1) / self.idx_dict['ClosePrice'] - 1
 
-        # stock returns 
+        # stock returns (materialized over the full history, see data_ingestion/DerivedStore.py)
         self.ret_df_dict = {}
         self.return_type_list = ['o2next_o', 'c2next_o', 'o2c']
-        self.Open = self.eod_data_dict["OpenPrice"] * self.eod_data_dict["AdjFactor"]
-        self.Close = self.eod_data_dict["ClosePrice"] * self.eod_data_dict["AdjFactor"]
-        self.ret_df_dict['o2next_o'] = self.Open.shift(-1, axis=1) / self.Open - 1
-        self.ret_df_dict['c2next_o'] = self.Open.shift(-1, axis=1) / self.Close - 1
-        self.ret_df_dict['o2c'] = self.Close / self.Open - 1
+        self.Open = self.get_adj_price('OpenPrice')
+        self.Close = self.get_adj_price('ClosePrice')
+        for return_type in self.return_type_list:
+            self.ret_df_dict[return_type] = self.myconnector.get_returns(
+                return_type, dates=list(self.Open.columns), tickers=list(self.Open.index), stage=type(self).__name__
+            )
+
+    def get_adj_price(self, field: str) -> pd.DataFrame:
+        """ adjusted price over the loaded tickers and dates """
+        template = self.eod_data_dict['ClosePrice']
+        return self.myconnector.get_adj_price(
+            field, dates=list(template.columns), tickers=list(template.index), stage=type(self).__name__
+        )
 
     # =================================
     # ------ compute factors ----------
@@ -201,23 +385,16 @@ class StyleFactorGenerator(object):
         """
         compute style factors (subclasses, to be aggregated to major classes later)
         """
-        # exponential kernel 
-        def exp_kernel_to_apply(s, kernel=None):
-            """
-            exponential decay kernl kernel
-            :param s: series (a time series)
-            :parma kernel: a numpy array 
-            """
-            return s @ kernel / kernel.sum()
-        
-        close_price = self.eod_data_dict['ClosePrice'] * self.eod_data_dict['AdjFactor']  # close price 自动ffill, 所以无需手动填nan
-        close_price_return = close_price / close_price.shift(1, axis=1) - 1 
+        # close price 自动ffill, 所以无需手动填nan
+        close_price_return = self.myconnector.get_returns(
+            'c2c', dates=list(self.Close.columns), tickers=list(self.Close.index), stage=type(self).__name__
+        )
 
         # reversal (same as mom, 反向因子)
         reversal_hallife = 5
         reversal_one_minus_alpha = np.exp(-np.log(2) / reversal_hallife)  # from pandas documentation 
         reversal_kernel = reversal_one_minus_alpha ** np.array(range(39, -1, -1))
-        rev_40 = close_price_return.rolling(40, axis=1).apply(exp_kernel_to_apply, args=(reversal_kernel, ), raw=True)
+        rev_40 = rolling_kernel_mean(close_price_return, reversal_kernel)
         rev_40 = rev_40 + (self.eod_data_dict['OpenPrice'] - self.eod_data_dict['OpenPrice'])  # add back mask
         self.style_class_dict['Reversal'] = {'rev_40': rev_40}
 
@@ -225,89 +402,45 @@ class StyleFactorGenerator(object):
         momentum_halflife = 126   # CNE6 
         momentum_one_minus_alpha = np.exp(-np.log(2) / momentum_halflife) 
         momentum_kernel = momentum_one_minus_alpha ** np.array(range(251, -1, -1))
-        mom_252 = close_price_return.shift(
-            21,                 # get rid of short term momentum
-            axis=1          
-        ).rolling(
-            252,                # long term
-            axis=1
-        ).apply(
-            exp_kernel_to_apply, 
-            args=(momentum_kernel, ), 
-            raw=True
+        mom_252 = rolling_kernel_mean(
+            close_price_return.shift(
+                21,             # get rid of short term momentum
+                axis=1
+            ),
+            momentum_kernel     # long term (252)
         )
         mom_252 = mom_252 + (self.eod_data_dict['OpenPrice'] - self.eod_data_dict['OpenPrice'])  # add back mask
         self.style_class_dict["Momentum"] = {'mom_252': mom_252}
                                             
         # Volatility (high_low 和 std均为反向因子)
-        highest_price = self.eod_data_dict['HighestPrice'] * self.eod_data_dict['AdjFactor']
-        lowest_price = self.eod_data_dict['LowestPrice'] * self.eod_data_dict['AdjFactor']
-        high_low_5 = highest_price.rolling(5, axis=1).max() / lowest_price.rolling(5, axis=1).min()
-        high_low_10 = highest_price.rolling(10, axis=1).max() / lowest_price.rolling(10, axis=1).min()
-        high_low_20 = highest_price.rolling(20, axis=1).max() / lowest_price.rolling(20, axis=1).min()
-        high_low_40 = highest_price.rolling(40, axis=1).max() / lowest_price.rolling(40, axis=1).min()
-        high_low_120 = highest_price.rolling(120, axis=1).max() / lowest_price.rolling(120, axis=1).min()
-        high_low_252 = highest_price.rolling(252, axis=1).max() / lowest_price.rolling(252, axis=1).min()
+        volatility_windows = [5, 10, 20, 40, 120, 252]
+        highest_price = self.get_adj_price('HighestPrice')
+        lowest_price = self.get_adj_price('LowestPrice')
+        highest_max = rolling_stats(highest_price, volatility_windows, ['max'])['max']
+        lowest_min = rolling_stats(lowest_price, volatility_windows, ['min'])['min']
 
         close_over_preclose = self.eod_data_dict['ClosePrice'] / self.eod_data_dict['PreClosePrice']
         close_over_preclose += (self.eod_data_dict['OpenPrice'] - self.eod_data_dict['OpenPrice'])
-        std_5 = close_over_preclose.rolling(5, axis=1).std()
-        std_10 = close_over_preclose.rolling(10, axis=1).std()
-        std_20 = close_over_preclose.rolling(20, axis=1).std()
-        std_40 = close_over_preclose.rolling(40, axis=1).std()
-        std_120 = close_over_preclose.rolling(120, axis=1).std()
-        std_252 = close_over_preclose.rolling(252, axis=1).std()
-
-        self.style_class_dict["Volatility"] = {
-            'high_low_5': high_low_5,
-            'high_low_10': high_low_10,
-            'high_low_20': high_low_20,
-            'high_low_40': high_low_40,
-            'high_low_120': high_low_120,
-            'high_low_252': high_low_252,
-            'std_5': std_5,
-            'std_10': std_10,
-            'std_20': std_20,
-            'std_40': std_40,
-            'std_120': std_120,
-            'std_252': std_252
-        }
+        close_over_preclose_std = rolling_stats(close_over_preclose, volatility_windows, ['std'])['std']
+
+        volatility_dict = {}
+        for w in volatility_windows:
+            volatility_dict[f'high_low_{w}'] = highest_max[w] / lowest_min[w]
+        for w in volatility_windows:
+            volatility_dict[f'std_{w}'] = close_over_preclose_std[w]
+        self.style_class_dict["Volatility"] = volatility_dict
           
         # Turnover (Turnover 均为反向因子)
+        turnover_windows = [1, 5, 10, 20, 40, 120, 252]
         turnover = self.eod_data_dict['TurnoverRate']
-        turnover_1 = turnover.rolling(1, axis=1).mean()
-        turnover_5 = turnover.rolling(5, axis=1).mean()
-        turnover_10 = turnover.rolling(10, axis=1).mean()
-        turnover_20 = turnover.rolling(20, axis=1).mean()
-        turnover_40 = turnover.rolling(40, axis=1).mean()
-        turnover_120 = turnover.rolling(120, axis=1).mean()
-        turnover_252 = turnover.rolling(252, axis=1).mean()
-        self.style_class_dict["Turnover"] = {
-            'turnover_1': turnover_1,
-            'turnover_5': turnover_5,
-            'turnover_10': turnover_10,
-            'turnover_20': turnover_20,
-            'turnover_40': turnover_40,
-            'turnover_120': turnover_120,
-            'turnover_252': turnover_252
-        }
+        turnover_mean = rolling_stats(turnover, turnover_windows, ['mean'])['mean']
+        self.style_class_dict["Turnover"] = {f'turnover_{w}': turnover_mean[w] for w in turnover_windows}
 
         # Weighted Momentum (weighted momentum 均为反向因子)
-        w_mom_1 = (turnover * (close_over_preclose - 1)).rolling(1, axis=1).mean() / turnover_1
-        w_mom_5 = (turnover * (close_over_preclose - 1)).rolling(5, axis=1).mean() / turnover_5
-        w_mom_10 = (turnover * (close_over_preclose - 1)).rolling(10, axis=1).mean() / turnover_10
-        w_mom_20 = (turnover * (close_over_preclose - 1)).rolling(20, axis=1).mean() / turnover_20
-        w_mom_40 = (turnover * (close_over_preclose - 1)).rolling(40, axis=1).mean() / turnover_40
-        w_mom_120 = (turnover * (close_over_preclose - 1)).rolling(120, axis=1).mean() / turnover_120
-        w_mom_252 = (turnover * (close_over_preclose - 1)).rolling(252, axis=1).mean() / turnover_252
+        weighted_return = turnover * (close_over_preclose - 1)
+        weighted_return_mean = rolling_stats(weighted_return, turnover_windows, ['mean'])['mean']
         self.style_class_dict["WeightedMomentum"] = {
-            'w_mom_1': w_mom_1,
-            'w_mom_5': w_mom_5,
-            'w_mom_10': w_mom_10,
-            'w_mom_20': w_mom_20,
-            'w_mom_40': w_mom_40,
-            'w_mom_120': w_mom_120,
-            'w_mom_252': w_mom_252
+            f'w_mom_{w}': weighted_return_mean[w] / turnover_mean[w] for w in turnover_windows
         }
 
         # Size (size为反向因子)
@@ -506,7 +639,7 @@ class StyleFactorGenerator(object):
 
     def saving_df(self):
         """
-        save risk factors (subclasses)
+        save risk factors (subclasses), in the background (see flush_saving)
         """
         # data = {}
         # for class_name in self.style_class_dict.keys():
@@ -517,7 +650,7 @@ class StyleFactorGenerator(object):
         for class_name in self.style_class_dict.keys():
             for key in self.style_class_dict[class_name].keys():
                 subclass_risk_factor_df = self.style_class_dict[class_name][key]
-                self.myconnector.save_eod_feature(
+                self.myconnector.save_eod_feature_async(
                     f'{class_name}_{key}',
                     subclass_risk_factor_df,
                     des='risk_factor'
@@ -525,7 +658,7 @@ class StyleFactorGenerator(object):
 
     def saving_merged_df(self):
         """
-        save risk factors (aggregated)
+        save risk factors (aggregated), in the background: written while the factor returns are computed
         """
         # data = {}
         # for key in self.class_factor_dict.keys():
@@ -541,12 +674,26 @@ class StyleFactorGenerator(object):
         # save
         for key in self.class_factor_dict.keys():
             class_factor_df = self.class_factor_dict[key]
-            self.myconnector.save_eod_feature(
+            self.myconnector.save_eod_feature_async(
                 key,
                 class_factor_df, 
                 des='risk_factor/class_factors'
             )
         
+    def flush_saving(self):
+        """
+        wait for the risk factors queued by saving_df and saving_merged_df to be written
+        """
+        t0 = time.time()
+        write_stats = self.myconnector.flush_writes()
+        print("Flushing Writes takes ", time.time() - t0)
+        print(
+            "Written {} panels ({:.0f} MB) in {:.2f}s of background writes, blocked on writes {:.2f}s".format(
+                write_stats['panels'], write_stats['bytes'] / 1024 ** 2, 
+                write_stats['write_seconds'], write_stats['blocked_seconds']
+            )
+        )
+
     # TODO: what is this for? Is this even necessary? 
     def save_idx_weight(self):
         """
@@ -617,6 +764,9 @@ class StyleFactorGenerator(object):
         self.save_fac_ret()
         self.saving_df()
         print("Saving Returns takes", time.time() - t0)
+        self.flush_saving()
+        self.save_manifest()
+        print_field_report([type(self).__name__])
 
 
     # ==================================
@@ -631,8 +781,8 @@ class StyleFactorGenerator(object):
             fac = self.class_factor_dict[fac_name]
             upper = fac.quantile(0.95)
             lower = fac.quantile(0.05)
-            fac[fac > upper] = np.nan
-            fac[fac < lower] = np.nan
+            # not in place: the saved class factors may still be queued for writing
+            fac = fac.mask((fac > upper) | (fac < lower))
             fac = (fac - fac.mean()) / fac.std()
             self.class_factor_dict_adj[fac_name] = fac.fillna(0)
 
@@ -32,6 +32,17 @@ required_field_types_dict = {
 
 # pick factor type 
 is_support_factor = False  # true for support factor，false for alpha factors
+use_factor_dag = False  # True: support factors, alpha factors and their dependencies in one pass (ignores is_support_factor)
+incremental = False  # True: compute and append only the dates after those stored (factors declare their lookback, see FactorDAG.py)
+skip_unchanged = True  # True: skip the factors whose code, params, eod data and dates did not change since saved (see data_ingestion/Manifest.py)
+
+# factors writing into their eod inputs (workers share read-only eod data; these get private copies.
+# others doing so are detected on their first write and computed again on copies)
+copy_eod_factors = []
+
+# workers (see data_ingestion/TaskScheduler.py): sized from the peak memory of the first factors
+max_workers = None  # cap on the workers (None: all cores)
+memory_budget_gb = None  # memory the workers may use together (None: 80% of the memory available at start)
 
 # others 
 # for ff3 
@@ -0,0 +1,118 @@
+"""
+Benchmark the numpy operators (operators.py) against their pandas equivalents
+
+    python run.py bench_ops --tickers 1000 --dates 500 --windows 5 20 60
+
+on random ticker x date data with nan values. For each operator, all windows are computed by
+pandas (rolling on the transposed frame, as rolling(..., axis=1); rolling.apply where the factor
+functions use it) and by the operator in one call, and the seconds, the speedup and the max abs
+difference are reported (with the number of entries where only one of them is nan).
+"""
+
+# load packages
+import time
+import numpy as np
+import pandas as pd
+from typing import Callable, List
+
+from src.factor_generation.tools import operators as op
+
+
+def pct_rank_last(s: np.ndarray) -> float:
+    """ rank of the last value of a window (pandas rank(pct=True)) """
+    return (np.sum(s < s[-1]) + (np.sum(s == s[-1]) + 1) / 2) / len(s)
+
+
+def pandas_ops(df: pd.DataFrame, other: pd.DataFrame, windows: List[int], halflife: float) -> dict:
+    """ operator name -> function computing all windows with pandas """
+    dft, othert = df.T, other.T
+    return {
+        'ts_mean': lambda: [dft.rolling(w).mean().T for w in windows],
+        'ts_std': lambda: [dft.rolling(w).std().T for w in windows],
+        'ts_max': lambda: [dft.rolling(w).max().T for w in windows],
+        'ts_min': lambda: [dft.rolling(w).min().T for w in windows],
+        'ts_corr': lambda: [dft.rolling(w).corr(othert).T for w in windows],
+        'ts_rank': lambda: [dft.rolling(w).apply(pct_rank_last, raw=True).T for w in windows],
+        'decay_linear': lambda: [
+            dft.rolling(w).apply(lambda s, k=np.arange(1, w + 1): s @ k / k.sum(), raw=True).T for w in windows
+        ],
+        'ewm_kernel': lambda: [
+            dft.rolling(w).apply(lambda s, k=op.exp_kernel(halflife, w)[::-1]: s @ k / k.sum(), raw=True).T for w in windows
+        ],
+        'delta': lambda: [df - df.shift(w, axis=1) for w in windows],
+        'cs_rank': lambda: [df.rank(axis=0, pct=True)],
+        'cs_zscore': lambda: [(df - df.mean()) / df.std()]
+    }
+
+
+def numpy_ops(values: np.ndarray, other: np.ndarray, windows: List[int], halflife: float) -> dict:
+    """ operator name -> function computing all windows with the operators """
+    return {
+        'ts_mean': lambda: op.ts_mean(values, windows),
+        'ts_std': lambda: op.ts_std(values, windows),
+        'ts_max': lambda: op.ts_max(values, windows),
+        'ts_min': lambda: op.ts_min(values, windows),
+        'ts_corr': lambda: op.ts_corr(values, other, windows),
+        'ts_rank': lambda: op.ts_rank(values, windows),
+        'decay_linear': lambda: op.decay_linear(values, windows),
+        'ewm_kernel': lambda: op.ewm_kernel(values, halflife, windows),
+        'delta': lambda: np.stack([op.delta(values, w) for w in windows]),
+        'cs_rank': lambda: op.cs_rank(values)[None],
+        'cs_zscore': lambda: op.cs_zscore(values)[None]
+    }
+
+
+def timed(func: Callable, repeat: int):
+    """ best seconds over repeat runs, and the result """
+    best = np.inf
+    for _ in range(repeat):
+        start = time.time()
+        result = func()
+        best = min(best, time.time() - start)
+    return best, result
+
+
+def bench_operators(
+        n_tickers: int = 1000,
+        n_dates: int = 500,
+        windows: List[int] = [5, 20, 60],
+        nan_ratio: float = 0.01,
+        halflife: float = 5,
+        repeat: int = 3,
+        seed: int = 0
+    ) -> pd.DataFrame:
+    """
+    :param n_tickers, n_dates: size of the random panel
+    :param windows: the windows of each time-series operator
+    :param nan_ratio: share of nan values
+    :param halflife: of ewm_kernel
+    :param repeat: runs per measure (the best is kept; pandas rolling.apply runs once)
+    :return a dataframe indexed by operator: pandas_s, numpy_s, speedup, max_abs_diff, nan_mismatch
+    """
+    rng = np.random.default_rng(seed)
+    values = np.cumsum(rng.normal(0, 0.02, (n_tickers, n_dates)), axis=1)
+    values[rng.random(values.shape) < nan_ratio] = np.nan
+    other = values + rng.normal(0, 0.02, values.shape)
+    df = pd.DataFrame(values, index=[str(x).zfill(6) for x in range(n_tickers)])
+    other_df = pd.DataFrame(other, index=df.index)
+
+    pandas_funcs = pandas_ops(df, other_df, windows, halflife)
+    numpy_funcs = numpy_ops(values, other, windows, halflife)
+    records = []
+    for name, pandas_func in pandas_funcs.items():
+        uses_apply = name in ['ts_rank', 'decay_linear', 'ewm_kernel']
+        pandas_s, expected = timed(pandas_func, 1 if uses_apply else repeat)
+        numpy_s, result = timed(numpy_funcs[name], repeat)
+
+        expected = np.stack([x.to_numpy(dtype=np.float64) for x in expected])
+        diff = np.abs(expected - result)
+        records.append({
+            'operator': name,
+            'pandas_s': round(pandas_s, 4),
+            'numpy_s': round(numpy_s, 4),
+            'speedup': round(pandas_s / max(numpy_s, 1e-9), 1),
+            'max_abs_diff': float(np.nanmax(diff)) if (~np.isnan(diff)).any() else 0.,
+            'nan_mismatch': int((np.isnan(expected) != np.isnan(result)).sum())
+        })
+        print(records[-1])
+    return pd.DataFrame(records).set_index('operator')
@@ -0,0 +1,377 @@
+"""
+Time-series and cross-sectional operators on ticker x date arrays
+
+NumPy versions of the pandas rolling(..., axis=1) / rolling.apply idioms of the factor functions
+(factor_gen, support_factor_gen, StyleFactorGenerator), without a new dataframe per call:
+
+    from src.factor_generation.tools import operators as op
+
+    close = eod_data_dict['ClosePrice']
+    mom_20 = op.delta(close.values, 20) / op.delay(close.values, 20)
+    std_5, std_20, std_60 = op.ts_std(ret.values, [5, 20, 60])
+    factor_df = pd.DataFrame(op.cs_rank(mom_20), index=close.index, columns=close.columns)
+
+Conventions
+- inputs are 2d arrays (ticker x date; a dataframe is taken as its values) with the dates along
+  axis 1; the value on date t is computed from the dates t - window + 1, ..., t;
+- nan (and +-inf) values are skipped; a window holding fewer than min_periods valid values
+  gives nan. min_periods defaults to the window, as in pandas rolling: a window with any nan
+  gives nan;
+- window may be a list of windows, computed in one pass over the data (shared prefix sums,
+  block extrema, lags) and stacked as (len(windows), tickers, dates);
+- out: a float64 array of the shape of the result to write into (and return), to reuse buffers.
+
+Cross-sectional operators (cs_*) work on each date, along axis 0.
+"""
+
+# load packages
+import numpy as np
+from typing import Callable, List, Tuple, Union
+
+Windows = Union[int, List[int]]
+
+# sum of squared deviations of a window (relative to that of the row) treated as 0: constant windows
+VAR_TOLERANCE = 1e-12
+
+
+# ===================================
+# ---------- helpers ----------------
+# ===================================
+
+def as_array(x) -> np.ndarray:
+    """ x as a 2d float64 array (the values of a dataframe) """
+    x = np.asarray(x, dtype=np.float64)
+    if x.ndim != 2:
+        raise ValueError(f'expected a ticker x date 2d array, got {x.ndim}d')
+    return x
+
+
+def prepare_out(out: np.ndarray, shape: Tuple[int, ...]) -> np.ndarray:
+    """ a new result array, or check the one given """
+    if out is None:
+        return np.empty(shape, dtype=np.float64)
+    if out.shape != tuple(shape) or out.dtype != np.float64:
+        raise ValueError(f'out must be a float64 array of shape {tuple(shape)}, got {out.dtype} {out.shape}')
+    return out
+
+
+def window_list(window: Windows) -> Tuple[List[int], bool]:
+    """ the windows as a list, and whether a single one was given """
+    single = np.ndim(window) == 0
+    windows = [int(window)] if single else [int(w) for w in window]
+    if len(windows) == 0 or min(windows) < 1:
+        raise ValueError(f'windows must be positive integers, got {window}')
+    return windows, single
+
+
+def min_count(window: int, min_periods: int) -> int:
+    """ valid values required in a window """
+    return window if min_periods is None else max(1, min(min_periods, window))
+
+
+def run_windows(window: Windows, shape: Tuple[int, ...], out: np.ndarray, func: Callable) -> np.ndarray:
+    """ func(w, out_w) for each window, into out (stacked for a list of windows) """
+    windows, single = window_list(window)
+    out = prepare_out(out, shape if single else (len(windows),) + tuple(shape))
+    for i, w in enumerate(windows):
+        func(w, out if single else out[i])
+    return out
+
+
+def prefix_sum(x: np.ndarray) -> np.ndarray:
+    """ cumulative sums along the dates, with a leading 0 column """
+    prefix = np.zeros((x.shape[0], x.shape[1] + 1))
+    np.cumsum(x, axis=1, out=prefix[:, 1:])
+    return prefix
+
+
+def window_sum(prefix: np.ndarray, window: int) -> np.ndarray:
+    """ sums over the trailing windows from a prefix sum (over the dates available on the first dates) """
+    n_dates = prefix.shape[1] - 1
+    head = min(window, n_dates)
+    # slices rather than a gather of the window starts: one pass over the memory
+    sums = np.empty((prefix.shape[0], n_dates))
+    np.subtract(prefix[:, 1:head + 1], prefix[:, :1], out=sums[:, :head])
+    np.subtract(prefix[:, head + 1:], prefix[:, 1:n_dates - head + 1], out=sums[:, head:])
+    return sums
+
+
+def centered(x: np.ndarray, valid: np.ndarray) -> np.ndarray:
+    """ valid values minus the mean of their row (0 elsewhere), for the precision of the prefix sums """
+    count = valid.sum(axis=1, keepdims=True)
+    filled = np.where(valid, x, 0.)
+    row_mean = filled.sum(axis=1, keepdims=True) / np.maximum(count, 1)
+    return np.where(valid, filled - row_mean, 0.)
+
+
+# ===================================
+# ---------- time series ------------
+# ===================================
+
+def delay(x, n: int, out: np.ndarray = None) -> np.ndarray:
+    """ the value n dates before (n < 0: after), nan where out of range """
+    x = as_array(x)
+    out = prepare_out(out, x.shape)
+    n_dates = x.shape[1]
+    n = max(-n_dates, min(n, n_dates))
+    if n >= 0:
+        out[:, n:] = x[:, :n_dates - n]
+        out[:, :n] = np.nan
+    else:
+        out[:, :n_dates + n] = x[:, -n:]
+        out[:, n_dates + n:] = np.nan
+    return out
+
+
+def delta(x, n: int, out: np.ndarray = None) -> np.ndarray:
+    """ x minus its value n dates before """
+    x = as_array(x)
+    out = delay(x, n, out=out)
+    np.subtract(x, out, out=out)
+    return out
+
+
+def ts_sum(x, window: Windows, min_periods: int = None, out: np.ndarray = None) -> np.ndarray:
+    """ rolling sum of the valid values """
+    x = as_array(x)
+    valid = np.isfinite(x)
+    value_prefix = prefix_sum(np.where(valid, x, 0.))
+    count_prefix = prefix_sum(valid)
+
+    def compute(w, o):
+        o[:] = window_sum(value_prefix, w)
+        o[window_sum(count_prefix, w) < min_count(w, min_periods)] = np.nan
+    return run_windows(window, x.shape, out, compute)
+
+
+def ts_mean(x, window: Windows, min_periods: int = None, out: np.ndarray = None) -> np.ndarray:
+    """ rolling mean of the valid values """
+    x = as_array(x)
+    valid = np.isfinite(x)
+    value_prefix = prefix_sum(np.where(valid, x, 0.))
+    count_prefix = prefix_sum(valid)
+
+    def compute(w, o):
+        count = window_sum(count_prefix, w)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            np.divide(window_sum(value_prefix, w), count, out=o)
+        o[count < min_count(w, min_periods)] = np.nan
+    return run_windows(window, x.shape, out, compute)
+
+
+def ts_std(x, window: Windows, min_periods: int = None, ddof: int = 1, out: np.ndarray = None) -> np.ndarray:
+    """ rolling standard deviation of the valid values (ddof=1 as in pandas) """
+    x = as_array(x)
+    valid = np.isfinite(x)
+    c = centered(x, valid)
+    value_prefix = prefix_sum(c)
+    square_prefix = prefix_sum(c * c)
+    count_prefix = prefix_sum(valid)
+
+    def compute(w, o):
+        count = window_sum(count_prefix, w)
+        value_sum = window_sum(value_prefix, w)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            square_dev = window_sum(square_prefix, w) - value_sum * value_sum / count
+            # at the rounding error of the prefix sums: constant windows
+            square_dev[square_dev <= VAR_TOLERANCE * square_prefix[:, -1:]] = 0.
+            np.sqrt(square_dev / (count - ddof), out=o)
+        o[(count < min_count(w, min_periods)) | (count - ddof <= 0)] = np.nan
+    return run_windows(window, x.shape, out, compute)
+
+
+def ts_corr(x, y, window: Windows, min_periods: int = None, out: np.ndarray = None) -> np.ndarray:
+    """ rolling correlation of x and y over the dates where both are valid (nan for constant windows) """
+    x, y = as_array(x), as_array(y)
+    valid = np.isfinite(x) & np.isfinite(y)
+    cx, cy = centered(x, valid), centered(y, valid)
+    count_prefix = prefix_sum(valid)
+    x_prefix, y_prefix = prefix_sum(cx), prefix_sum(cy)
+    xx_prefix, yy_prefix, xy_prefix = prefix_sum(cx * cx), prefix_sum(cy * cy), prefix_sum(cx * cy)
+
+    def compute(w, o):
+        count = window_sum(count_prefix, w)
+        x_sum, y_sum = window_sum(x_prefix, w), window_sum(y_prefix, w)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            cov = window_sum(xy_prefix, w) - x_sum * y_sum / count
+            x_var = window_sum(xx_prefix, w) - x_sum * x_sum / count
+            y_var = window_sum(yy_prefix, w) - y_sum * y_sum / count
+            np.divide(cov, np.sqrt(np.maximum(x_var, 0.) * np.maximum(y_var, 0.)), out=o)
+        np.clip(o, -1., 1., out=o)
+        # variances at the rounding error of the prefix sums: constant windows
+        constant = (x_var <= VAR_TOLERANCE * xx_prefix[:, -1:]) | (y_var <= VAR_TOLERANCE * yy_prefix[:, -1:])
+        o[(count < max(2, min_count(w, min_periods))) | constant] = np.nan
+    return run_windows(window, x.shape, out, compute)
+
+
+def rolling_extremum(x: np.ndarray, window: int, ufunc: np.ufunc, fill: float, out: np.ndarray) -> None:
+    """
+    rolling max / min by van Herk / Gil-Werman: with the dates cut into blocks of the window,
+    a window is covered by the suffix of one block and the prefix of the next, so each value
+    costs 3 comparisons whatever the window
+    """
+    n_tickers, n_dates = x.shape
+    n_padded = -(-n_dates // window) * window
+    padded = np.full((n_tickers, n_padded), fill)
+    padded[:, :n_dates] = x
+    blocks = padded.reshape(n_tickers, -1, window)
+    prefix = ufunc.accumulate(blocks, axis=2).reshape(n_tickers, n_padded)
+    suffix = ufunc.accumulate(blocks[:, :, ::-1], axis=2)[:, :, ::-1].reshape(n_tickers, n_padded)
+
+    head = min(window - 1, n_dates)
+    out[:, :head] = ufunc.accumulate(padded[:, :head], axis=1)  # windows cut by the first date
+    ufunc(suffix[:, :n_dates - head], prefix[:, head:n_dates], out=out[:, head:])
+
+
+def ts_max(x, window: Windows, min_periods: int = None, out: np.ndarray = None) -> np.ndarray:
+    """ rolling max of the valid values """
+    x = as_array(x)
+    valid = np.isfinite(x)
+    filled = np.where(valid, x, -np.inf)
+    count_prefix = prefix_sum(valid)
+
+    def compute(w, o):
+        rolling_extremum(filled, w, np.maximum, -np.inf, o)
+        o[window_sum(count_prefix, w) < min_count(w, min_periods)] = np.nan
+    return run_windows(window, x.shape, out, compute)
+
+
+def ts_min(x, window: Windows, min_periods: int = None, out: np.ndarray = None) -> np.ndarray:
+    """ rolling min of the valid values """
+    x = as_array(x)
+    valid = np.isfinite(x)
+    filled = np.where(valid, x, np.inf)
+    count_prefix = prefix_sum(valid)
+
+    def compute(w, o):
+        rolling_extremum(filled, w, np.minimum, np.inf, o)
+        o[window_sum(count_prefix, w) < min_count(w, min_periods)] = np.nan
+    return run_windows(window, x.shape, out, compute)
+
+
+def ts_rank(x, window: Windows, min_periods: int = None, out: np.ndarray = None) -> np.ndarray:
+    """
+    rank of the value of each date among the valid values of its window, as a fraction
+    (average rank of ties / count, as pandas rank(pct=True)). nan where the value is not valid
+    """
+    x = as_array(x)
+    windows, single = window_list(window)
+    out = prepare_out(out, x.shape if single else (len(windows),) + x.shape)
+    valid = np.isfinite(x)
+    n_dates = x.shape[1]
+
+    # one pass over the lags of the largest window, taking each window on the way
+    less = np.zeros(x.shape)
+    equal = np.zeros(x.shape)  # other values equal to the current one
+    count = valid.astype(np.float64)
+    for lag in range(max(windows)):
+        if 0 < lag < n_dates:
+            current, lagged, lagged_valid = x[:, lag:], x[:, :n_dates - lag], valid[:, :n_dates - lag]
+            less[:, lag:] += lagged_valid & (lagged < current)
+            equal[:, lag:] += lagged_valid & (lagged == current)
+            count[:, lag:] += lagged_valid
+        for i, w in enumerate(windows):
+            if w == lag + 1:
+                o = out if single else out[i]
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    np.divide(less + 1 + equal / 2, count, out=o)
+                o[~valid | (count < min_count(w, min_periods))] = np.nan
+    return out
+
+
+def ts_weighted_mean(x, weights: np.ndarray, min_periods: int = None, out: np.ndarray = None) -> np.ndarray:
+    """
+    rolling weighted mean, weights[k] for the value k dates before (renormalized over the valid values)
+
+    :param weights: 1d array, its length is the window
+    """
+    x = as_array(x)
+    weights = np.asarray(weights, dtype=np.float64)
+    out = prepare_out(out, x.shape)
+    valid = np.isfinite(x)
+    filled = np.where(valid, x, 0.)
+    n_dates = x.shape[1]
+
+    weighted_sum = np.zeros(x.shape)
+    weight_sum = np.zeros(x.shape)
+    count = np.zeros(x.shape)
+    for lag, weight in enumerate(weights[:n_dates]):
+        weighted_sum[:, lag:] += weight * filled[:, :n_dates - lag]
+        weight_sum[:, lag:] += weight * valid[:, :n_dates - lag]
+        count[:, lag:] += valid[:, :n_dates - lag]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        np.divide(weighted_sum, weight_sum, out=out)
+    out[count < min_count(len(weights), min_periods)] = np.nan
+    return out
+
+
+def decay_linear(x, window: Windows, min_periods: int = None, out: np.ndarray = None) -> np.ndarray:
+    """ rolling mean with linearly decaying weights (window for the current date, ..., 1 for the oldest) """
+    x = as_array(x)
+    return run_windows(
+        window, x.shape, out,
+        lambda w, o: ts_weighted_mean(x, np.arange(w, 0, -1), min_periods=min_periods, out=o)
+    )
+
+
+def exp_kernel(halflife: float, window: int) -> np.ndarray:
+    """ exponential decay weights of the lags 0, ..., window - 1 """
+    one_minus_alpha = np.exp(-np.log(2) / halflife)  # from pandas documentation
+    return one_minus_alpha ** np.arange(window)
+
+
+def ewm_kernel(x, halflife: float, window: Windows, min_periods: int = None, out: np.ndarray = None) -> np.ndarray:
+    """
+    rolling exponentially weighted mean over a finite window
+    (s @ kernel / kernel.sum() in rolling(window).apply of StyleFactorGenerator)
+    """
+    x = as_array(x)
+    return run_windows(
+        window, x.shape, out,
+        lambda w, o: ts_weighted_mean(x, exp_kernel(halflife, w), min_periods=min_periods, out=o)
+    )
+
+
+# ===================================
+# -------- cross section ------------
+# ===================================
+
+def cs_rank(x, out: np.ndarray = None) -> np.ndarray:
+    """ rank of each ticker among the valid values of its date, as a fraction (pandas rank(pct=True)) """
+    x = as_array(x)
+    out = prepare_out(out, x.shape)
+    valid = np.isfinite(x)
+    n_tickers = x.shape[0]
+
+    # sort each date (invalid last), average the positions of ties, scatter back
+    filled = np.where(valid, x, np.inf)
+    order = np.argsort(filled, axis=0, kind='mergesort')
+    sorted_x = np.take_along_axis(filled, order, axis=0)
+    position = np.broadcast_to(np.arange(n_tickers, dtype=np.float64)[:, None], x.shape)
+    is_first = np.ones(x.shape, dtype=bool)
+    is_first[1:] = sorted_x[1:] != sorted_x[:-1]
+    is_last = np.ones(x.shape, dtype=bool)
+    is_last[:-1] = is_first[1:]
+    first = np.maximum.accumulate(np.where(is_first, position, 0.), axis=0)
+    last = np.minimum.accumulate(np.where(is_last, position, n_tickers - 1.)[::-1], axis=0)[::-1]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        np.put_along_axis(out, order, ((first + last) / 2 + 1) / valid.sum(axis=0), axis=0)
+    out[~valid] = np.nan
+    return out
+
+
+def cs_zscore(x, ddof: int = 1, out: np.ndarray = None) -> np.ndarray:
+    """ (x - mean) / std of the valid values of each date (nan for constant dates) """
+    x = as_array(x)
+    out = prepare_out(out, x.shape)
+    valid = np.isfinite(x)
+    count = valid.sum(axis=0)
+    filled = np.where(valid, x, 0.)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = filled.sum(axis=0) / count
+        deviation = np.where(valid, filled - mean, 0.)
+        std = np.sqrt((deviation * deviation).sum(axis=0) / (count - ddof))
+        np.divide(deviation, std, out=out)
+    out[~valid | ~(std > 0)] = np.nan
+    return out
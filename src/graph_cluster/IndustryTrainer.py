@@ -45,8 +45,8 @@ class IndustryTrainer:
         clustering_type: str = None,
         filter_mode: int = None
     ) -> None:
-        # init dataserver
-        self.ds = PqiDataSdkOffline()
+        # init dataserver (cached: the rolling train windows overlap)
+        self.ds = PqiDataSdkOffline(cache_max_bytes=cfg.cache_max_bytes)
         # load config
         if graph_type is None:
             self.graph_type = cfg.graph_type
@@ -70,8 +70,8 @@ class IndustryTrainer:
 
         self.stock_pool = cfg.stock_pool
 
-        # read index mask
-        self.index_mask = self.ds.get_index_mask([self.stock_pool])
+        # index membership (bit-packed, see data_ingestion/IndexMembership.py)
+        self.index_membership = self.ds.index_membership
 
         # select graph model
         self.select_graph_model()
@@ -136,25 +136,19 @@ class IndustryTrainer:
         print(
             f'======== Training {train_dates[0]} - {train_dates[-1]}  ========')
         start = time.time()
-        # read train data
-        eod_data_dict = self.ds.get_eod_history(
-            start_date=train_dates[0], end_date=train_dates[-1],
-            fields=['ClosePrice', 'AdjFactor']
-        )
-        close_df = eod_data_dict['ClosePrice'] * eod_data_dict['AdjFactor']
-        return_df = close_df / close_df.shift(1, axis=1) - 1
+        # read train data (close to close returns, materialized over the full history, see data_ingestion/DerivedStore.py)
+        return_df = self.ds.get_returns('c2c', dates=list(train_dates))
 
         # prune return df (subset to selected stock pool, e.g. zz1000)
         # index_mask_selected = self.index_mask[train_dates]
         # * select all stocks ever in the pool, including test. Note that this is not future-gazing,
         # * since whenever a new stock is added to the pool, a retrain is necessary.
-        index_mask_selected = self.index_mask[list(
-            train_dates) + list(test_dates)]
-        member_stock_mask = index_mask_selected.loc[index_mask_selected.notna().any(
-            axis=1)]
-        member_stock_list = member_stock_mask.index.tolist()
+        member_stock_list = sorted(
+            set(self.index_membership.members_between([self.stock_pool], train_dates[0], train_dates[-1])) | 
+            set(self.index_membership.members_between([self.stock_pool], test_dates[0], test_dates[-1]))
+        )
         nonmember_stock_list = list(
-            set(close_df.index) - set(member_stock_list))
+            set(return_df.index) - set(member_stock_list))
         member_stock_return_df = return_df.loc[member_stock_list]
 
         # count number of stocks in test dates but not in train pool
@@ -319,25 +313,19 @@ class MultiIndustryTrainer(IndustryTrainer):
         print(
             f'======== Training {train_dates[0]} - {train_dates[-1]}  ========')
         start = time.time()
-        # read train data
-        eod_data_dict = self.ds.get_eod_history(
-            start_date=train_dates[0], end_date=train_dates[-1],
-            fields=['ClosePrice', 'AdjFactor']
-        )
-        close_df = eod_data_dict['ClosePrice'] * eod_data_dict['AdjFactor']
-        return_df = close_df / close_df.shift(1, axis=1) - 1
+        # read train data (close to close returns, materialized over the full history, see data_ingestion/DerivedStore.py)
+        return_df = self.ds.get_returns('c2c', dates=list(train_dates))
 
         # prune return df (subset to selected stock pool, e.g. zz1000)
         # index_mask_selected = self.index_mask[train_dates]
         # * select all stocks ever in the pool, including test. Note that this is not future-gazing,
         # * since whenever a new stock is added to the pool, a retrain is necessary.
-        index_mask_selected = self.index_mask[list(
-            train_dates) + list(test_dates)]
-        member_stock_mask = index_mask_selected.loc[index_mask_selected.notna().any(
-            axis=1)]
-        member_stock_list = member_stock_mask.index.tolist()
+        member_stock_list = sorted(
+            set(self.index_membership.members_between([self.stock_pool], train_dates[0], train_dates[-1])) | 
+            set(self.index_membership.members_between([self.stock_pool], test_dates[0], test_dates[-1]))
+        )
         nonmember_stock_list = list(
-            set(close_df.index) - set(member_stock_list))
+            set(return_df.index) - set(member_stock_list))
         member_stock_return_df = return_df.loc[member_stock_list]
 
         # count number of stocks in test dates but not in train pool
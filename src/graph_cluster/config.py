@@ -19,6 +19,10 @@ fig_save_path = 'out/graph_fig/'
 # discard points with 60% nan in a single correlation period
 na_threshold = 0.6
 
+# memory ceiling (bytes) of the feather cache: the overlapping train windows are
+# read from disk once (0 to disable, see data_ingestion/FeatureCache.py)
+cache_max_bytes = 2 * 1024 ** 3
+
 # ===========================
 #       graph specifics 
 # ===========================
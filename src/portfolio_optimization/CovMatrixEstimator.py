@@ -24,12 +24,16 @@ warnings.filterwarnings('ignore')
 
 # initialize dataserver 
 from src.data_ingestion.PqiDataSdk_Offline import PqiDataSdkOffline
+from src.data_ingestion.FieldProjection import print_field_report
 
 # load files 
 import src.portfolio_optimization.config as cfg
 
 
 class CovMatrixEstimator:
+    # eod fields read, per source (see data_ingestion/FieldProjection.py)
+    REQUIRED_FIELDS = {'stock': ['FloatMarketValue']}
+
     def __init__(self):
         # 数据存放
         self.factor_return_df_dict = {}  # 存放大类风格因子收益率
@@ -86,7 +90,8 @@ class CovMatrixEstimator:
             tickers=self.all_stocks, 
             start_date=self.start_date,
             end_date=self.end_date,
-            fields=['FloatMarketValue']
+            fields=self.REQUIRED_FIELDS['stock'],
+            stage=type(self).__name__
         )
         self.date_list = list(self.eod_data_dict['FloatMarketValue'].columns)
         self.tickers = list(self.eod_data_dict["FloatMarketValue"].index) 
@@ -99,12 +104,12 @@ class CovMatrixEstimator:
         ret_save_path = os.path.join(self.ret_read_path, self.dynamic_ind_name)
         factor_return = pd.read_feather('{}/Factor_return_{}_'.format(ret_save_path, return_type)).set_index('index')
         idio_return = pd.read_feather('{}/Idio_return_{}_'.format(ret_save_path, return_type)).set_index('index')
-        factor_return.index = factor_return.index.astype(int)
+        # dates stay str labels, as in the sdk
+        factor_return.index = factor_return.index.astype(str)
+        idio_return.index = idio_return.index.astype(str)
 
         # algin tickers
-        idio_return.index = [str(x) for x in idio_return.index]
         idio_return = (idio_return.T + (self.eod_data_dict['FloatMarketValue'] - self.eod_data_dict['FloatMarketValue'])).T  
-        idio_return.index = [int(x) for x in idio_return.index]
         return factor_return, idio_return
 
 
@@ -117,8 +122,7 @@ class CovMatrixEstimator:
     def get_cov_dates(self):
         """ get dates (take intersection) """ 
         factor_ret = self.factor_return_df_dict[self.return_type_list[0]]
-        date_list_ret = [str(x) for x in list(factor_ret.index)]
-        self.date_list_cov = list(set(date_list_ret) & set(self.date_list))
+        self.date_list_cov = list(set(factor_ret.index) & set(self.date_list))
         self.date_list_cov.sort()
 
 
@@ -173,10 +177,8 @@ class CovMatrixEstimator:
         # idio_return_df = self.idio_return_df_dict[return_type]
 
         # 数据准备
-        date_list_cov_int = [int(x) for x in self.date_list_cov]
-
-        factor_return_df = self.factor_return_df_dict[return_type].loc[date_list_cov_int,:] 
-        idio_return_df = self.idio_return_df_dict[return_type].loc[date_list_cov_int,:]
+        factor_return_df = self.factor_return_df_dict[return_type].loc[self.date_list_cov,:] 
+        idio_return_df = self.idio_return_df_dict[return_type].loc[self.date_list_cov,:]
         temp_factor_cov = {}
         temp_idio_var = {}
         # date_list = factor_return_df.index
@@ -293,17 +295,22 @@ class CovMatrixEstimator:
         adj_factor_cov = {}
 
         # 将每一期raw估计的协方差矩阵放入子进程蒙特卡洛
+        # all-nan periods (no factor returns in the window) are kept as they are, without a round trip to the pool
         pool = mp.Pool(processes=8)
         process_list = []
         for current_t in dates:
-            process_list.append(pool.apply_async(
+            if np.isnan(temp_factor_cov[current_t]).all():
+                adj_factor_cov[current_t] = temp_factor_cov[current_t]
+                continue
+            process_list.append((current_t, pool.apply_async(
                 self.eigen_adj_est_each_period, 
                 args=(temp_factor_cov[current_t], self.factor_num, self.h, self.alpha)
-                )
+                ))
             )
         time.sleep(1)
-        for i in range(len(process_list)):
-            adj_factor_cov[dates[i]] = process_list[i].get()
+        for current_t, process in process_list:
+            adj_factor_cov[current_t] = process.get()
+        adj_factor_cov = {current_t: adj_factor_cov[current_t] for current_t in dates}  # date order
         pool.close()
         pool.join()
         self.factor_cov_raw_dict[return_type] = adj_factor_cov
@@ -386,12 +393,11 @@ class CovMatrixEstimator:
         weight_vol = weight_vol / weight_vol.sum()  # 预先归一化
         
         date_list_vol_cal = list(temp_idio_var.keys())
-        date_list_vol_cal_int = [int(x) for x in date_list_vol_cal]
-        factor_return_df = self.factor_return_df_dict[return_type].loc[date_list_vol_cal_int,:] 
+        factor_return_df = self.factor_return_df_dict[return_type].loc[date_list_vol_cal,:] 
         factor_return_nextday = factor_return_df.shift(-1)
         factor_return_nextday_np = factor_return_nextday.to_numpy()
 
-        idio_return_df = self.idio_return_df_dict[return_type].loc[date_list_vol_cal_int,:] 
+        idio_return_df = self.idio_return_df_dict[return_type].loc[date_list_vol_cal,:] 
         idio_return_nextday = idio_return_df.shift(-1)
         idio_return_nextday_np = idio_return_nextday.to_numpy()
 
@@ -469,7 +475,6 @@ class CovMatrixEstimator:
         
         idio_return = self.idio_return_df_dict[return_type]
         idio_return_df = idio_return.T
-        idio_return_df.columns = [str(x) for x in idio_return_df.columns]
         sig_u = (idio_return_df.rolling(self.h_struc, min_periods= self.min_o, axis = 1).quantile(0.75) - idio_return_df.rolling(self.h_struc, min_periods= self.min_o, axis = 1).quantile(0.25)) / 1.35
         z_u = abs(idio_return_df.rolling(self.h_struc, min_periods= self.min_o, axis = 1).std() / sig_u - 1)
         gamma = z_u.applymap(lambda x: min(np.exp(1 - x), 1))
@@ -637,3 +642,4 @@ class CovMatrixEstimator:
         t0 = time.time()
         self.save_cov()
         print("储存数据耗时", time.time() - t0)
+        print_field_report([type(self).__name__])
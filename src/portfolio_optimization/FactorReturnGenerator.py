@@ -25,11 +25,16 @@ warnings.filterwarnings('ignore')
 
 # initialize dataserver 
 from src.data_ingestion.PqiDataSdk_Offline import PqiDataSdkOffline
+from src.data_ingestion.IndexMembership import IndexMembership
+from src.data_ingestion.FieldProjection import print_field_report
 
 # load config
 import src.portfolio_optimization.config as cfg
 
 class FactorReturnGenerator(object):
+    # eod fields read, per source (see data_ingestion/FieldProjection.py)
+    REQUIRED_FIELDS = {'stock': ['ClosePrice', 'FloatMarketValue']}
+
     def __init__(self):
         # dates
         self.start_date = cfg.start_date
@@ -59,7 +64,9 @@ class FactorReturnGenerator(object):
         self.eod_data_dict = self.myconnector.get_eod_history(
             tickers=self.all_stocks, 
             start_date=self.start_date, 
-            end_date=self.end_date
+            end_date=self.end_date,
+            fields=self.REQUIRED_FIELDS['stock'],
+            stage=type(self).__name__
         )
         self.trade_dates = self.myconnector.select_trade_dates(
             start_date=self.start_date, 
@@ -72,18 +79,14 @@ class FactorReturnGenerator(object):
         # mode for return calculations 收益率回看模式
         self.ret_df_dict = {}    
         self.return_type_list = cfg.return_type_list
-        self.Open = self.eod_data_dict["OpenPrice"] * self.eod_data_dict["AdjFactor"]
-        self.Close = self.eod_data_dict["ClosePrice"] * self.eod_data_dict["AdjFactor"]
-
-        if 'o2next_o' in self.return_type_list:
-            self.ret_df_dict['o2next_o'] = self.Open.shift(-1, axis=1) / self.Open - 1
-        if 'c2next_o' in self.return_type_list:
-            self.ret_df_dict['c2next_o'] = self.Open.shift(-1, axis=1) / self.Close - 1
-        if 'o2c' in self.return_type_list:
-            self.ret_df_dict['o2c'] = self.Close / self.Open - 1
-        if 'c2next_c' in self.return_type_list:
-            self.ret_df_dict['c2next_c'] = self.Close / self.Close.shift(1, axis=1) - 1   # * 目前用这个，实际上是last_ctoc
-            #self.ret_df_dict['c2next_c'] = self.Close.shift(-1, axis = 1) / self.Close - 1
+
+        # materialized over the full history (see data_ingestion/DerivedStore.py)
+        # * c2next_c 目前用c2c，实际上是last_ctoc
+        stored_return_type = {'o2next_o': 'o2next_o', 'c2next_o': 'c2next_o', 'o2c': 'o2c', 'c2next_c': 'c2c'}
+        for return_type in self.return_type_list:
+            self.ret_df_dict[return_type] = self.myconnector.get_returns(
+                stored_return_type[return_type], dates=self.date_list, tickers=self.tickers
+            )
 
         # 不同收益率与因子对齐需要shift的天数 
         # self.shift_step_dict = {'o2next_o': 1, 'c2next_o': 1, 'o2c': 0}
@@ -171,14 +174,9 @@ class FactorReturnGenerator(object):
         :param index_list: 一个装有指数的列表，支持组合指数
         :return 指数mask
         """
-        agg_index_mask = False
-        # 读入和拼接多个index
-        for index in index_list:
-            index_weight = self.get_stock_weight(index)
-            index_mask = index_weight.notna()
-            agg_index_mask = agg_index_mask | index_mask
-        # 将dataframe转换为1和nan的矩阵
-        agg_index_mask = agg_index_mask.astype(int) / agg_index_mask.astype(int)
+        # 由bit-packed的成分股索引直接生成1和nan的矩阵
+        index_membership = IndexMembership(cfg.index_member_stock_path)
+        agg_index_mask = index_membership.get_nan_mask(index_list, self.trade_dates)
         return agg_index_mask        
 
     # ====================== calc ret =========================
@@ -213,8 +211,19 @@ class FactorReturnGenerator(object):
 
         # TODO: add dynamic industry here 
 
+        # dates on which the returns, and the sizes and every style factor, have some value (style
+        # factors from their statistics sidecars); on any other date the regression sample is empty
+        valid_ret_dates = set(ret_df.columns[ret_df.notna().any(axis=0)])
+        size_df = self.eod_data_dict['FloatMarketValue']
+        valid_x_dates = set(size_df.columns[size_df.notna().any(axis=0)])
+        for class_name in self.class_factor_dict_adj.keys():
+            valid_x_dates &= set(self.myconnector.get_valid_dates(class_name, des='risk_factor/class_factors', dates=self.date_list))
+
         has_value_dates = []  # store dates that have values # * for local data only 
         for t in range(len(self.date_list) - shift_step):            
+            if self.date_list[t + shift_step] not in valid_ret_dates or self.date_list[t] not in valid_x_dates:
+                continue  # empty sample, filled back with nan below
+
             # prepare data
             Y = ret_df.iloc[:, t + shift_step]
             #dt = fac.columns.tolist()[t+shift_step]
@@ -327,3 +336,4 @@ class FactorReturnGenerator(object):
         t0 = time.time()
         self.save_ret()
         print("Storing takes 储存数据耗时", time.time() - t0)
+        print_field_report([type(self).__name__])
@@ -23,11 +23,17 @@ solvers.options['show_progress'] = False
 
 # initialize dataserver 
 from src.data_ingestion.PqiDataSdk_Offline import PqiDataSdkOffline
+from src.data_ingestion.IndexMembership import IndexMembership
+from src.data_ingestion.TickerIndex import TickerIndex
+from src.data_ingestion.FieldProjection import print_field_report
 
 # load config
 import src.portfolio_optimization.config as cfg
 
 class WeightOptimizer():
+    # eod fields read, per source (see data_ingestion/FieldProjection.py)
+    REQUIRED_FIELDS = {'stock': ['ClosePrice']}
+
     def __init__(self):
         # basics 
         self.start_date = cfg.start_date
@@ -77,7 +83,9 @@ class WeightOptimizer():
         self.eod_data_dict = self.myconnector.get_eod_history(
             tickers=self.all_stocks, 
             start_date=self.start_date,
-            end_date=self.end_date
+            end_date=self.end_date,
+            fields=self.REQUIRED_FIELDS['stock'],
+            stage=type(self).__name__
         )
         self.trade_dates = self.myconnector.select_trade_dates(
             start_date=self.start_date, 
@@ -126,6 +134,8 @@ class WeightOptimizer():
         self.input_signal = pd.read_feather(
             os.path.join(cfg.input_signal_path, cfg.input_signal_df_name)
         ).set_index('index')
+        # zero-padded ticker labels once here, not per date in cal_sigma_holding
+        self.input_signal.index = TickerIndex.normalize(self.input_signal.index)
 
 
     def read_factor_data(self,feature_name, tickers, date_list):
@@ -251,14 +261,9 @@ class WeightOptimizer():
         :param index_list: 一个装有指数的列表，支持组合指数
         :return 指数mask
         """
-        agg_index_mask = False
-        # 读入和拼接多个index
-        for index in index_list:
-            index_weight = self.get_stock_weight(index)
-            index_mask = index_weight.notna()
-            agg_index_mask = agg_index_mask | index_mask
-        # 将dataframe转换为1和nan的矩阵
-        agg_index_mask = agg_index_mask.astype(int) / agg_index_mask.astype(int)
+        # 由bit-packed的成分股索引直接生成1和nan的矩阵
+        index_membership = IndexMembership(cfg.index_member_stock_path)
+        agg_index_mask = index_membership.get_nan_mask(index_list, self.trade_dates)
         return agg_index_mask   
 
     # =====================================================
@@ -287,7 +292,7 @@ class WeightOptimizer():
             current_date_input_signal = self.input_signal[date]
             
             # 当日持仓股票
-            holding_stock_list = [x.zfill(6) for x in [str(x) for x in list(current_date_input_signal[current_date_input_signal > 1e-6].index)]]  # !!!
+            holding_stock_list = list(self.input_signal.index[current_date_input_signal.to_numpy() > 1e-6])
             self.holding_stock_list_dict[date] = holding_stock_list
 
             # 当日指数成分股
@@ -1029,5 +1034,6 @@ class WeightOptimizer():
         t0 = time.time()
         self.save_opt_signal()
         print("储存数据耗时", time.time() - t0)
+        print_field_report([type(self).__name__])
 
 